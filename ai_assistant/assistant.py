@@ -1,37 +1,62 @@
+import asyncio
+import copy
 import datetime
+import json
+import os
 import sys
+import time
 import termcolor as tc
 import toml
-import vertexai
-
-from typing import List, Dict
-from vertexai.generative_models._generative_models import (
-    HarmBlockThreshold,
-    HarmCategory,
-    Content,
-    Part
-)
-from vertexai.language_models._language_models import MultiCandidateTextGenerationResponse
-from vertexai.preview.generative_models import (
-    GenerativeModel,
-    Tool,
-)
-from vertexai.preview.language_models import ChatSession
 
+from typing import Any, Callable, List, Dict, Optional, Tuple, Type, Union
+
+from ai_assistant.backends.base import ChatSession, ModelBackend, ResponseBlockedError, UsageStats
+from ai_assistant.backends.caching import CachingBackend
+from ai_assistant.backends.replay import RecordingBackend, ReplayBackend
+from ai_assistant.backends.resilient import ModelCallError, ResilientBackend
+from ai_assistant.cache import CACHES, DiskCache, hash_text
+from ai_assistant.checkpoint import Checkpoint
+from ai_assistant.history import HistoryManager
+from ai_assistant.snapshots import SNAPSHOTS
+from ai_assistant.speculation import Speculator
 from ai_assistant.tools.base import ToolInterface, FinalAnswerTool
+from ai_assistant.tools.registry import get_tool, get_tools
+from ai_assistant.tracing import TRACER, trace
+from ai_assistant.workspace import WORKSPACE
 
 
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
-}
+# The backend used unless another is specified in the settings
+DEFAULT_BACKEND = 'gemini'
 MODEL_CONFIG = {
     'max_output_tokens': 8192,
     'temperature': 0,
     'top_p': 0.5,
 }
+# The settings files parsed so far, with their modification times, so that a long-running process
+# starting many sessions parses a file only when it changes
+SETTINGS_CACHE: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+# The Gemini backends created so far, by their arguments, so that their clients are reused by the
+# later sessions of the same process
+GEMINI_BACKENDS: Dict[str, ModelBackend] = {}
+
+
+def load_settings(settings_file: str) -> Dict[str, Any]:
+    """
+    Parse a settings file, unless parsed already since it last changed.
+
+    :param settings_file: The settings file.
+    :return: The settings, grouped by section; a copy, which can be changed freely.
+    """
+
+    path = os.path.abspath(settings_file)
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = SETTINGS_CACHE.get(path)
+
+    if cached is None or cached[0] != mtime_ns:
+        with open(path, 'r', encoding='utf-8') as in_file:
+            cached = SETTINGS_CACHE[path] = (mtime_ns, toml.load(in_file))
+
+    return copy.deepcopy(cached[1])
 
 
 def get_today() -> str:
@@ -52,27 +77,78 @@ class Assistant:
 
     SETTINGS_FILE_NAME: str = 'settings.toml'
 
-    def __init__(self, tools: List[ToolInterface], verbose: bool = True):
+    def __init__(
+            self,
+            tools: List[Union[str, Type[ToolInterface]]],
+            verbose: bool = True,
+            settings_file: str = None,
+            settings_overrides: Dict[str, Dict[str, Any]] = None
+    ):
+        """
+        :param tools: The tools available to the assistant, either the classes or their names, e.g.,
+         `WriteFileTool`. The module of a tool given by name is imported only then.
+        :param verbose: Whether to print the details of every step.
+        :param settings_file: The settings file to use instead of `settings.toml`.
+        :param settings_overrides: Settings that take precedence over those in the settings file,
+         grouped by section, e.g., `{'Assistant': {'prompt_file': 'prompts/prompt_01_simple.txt'}}`.
+        """
+
         print('Initializing AI Assistant...', end='')
 
-        self.tools = Tool(
-            function_declarations=[
-                tool.function_declaration for tool in tools
-            ]
-        )
+        tools = get_tools(tools)
+        # The declarations of the functions the model can call
+        self.tools: List[Dict[str, Any]] = [tool.function_declaration for tool in tools]
         self.tools_by_name: Dict[str, ToolInterface] = {
             tool.name: tool for tool in tools
         }
         self.max_steps: int = 15
         self.verbose: bool = verbose
         self.debug: bool = False
-        self.model = None
+        # Whether to stream the responses, running every function call as soon as it arrives
+        self.streaming: bool = False
+        self.backend: ModelBackend = None
         self.prompt = None
         self.prompt_comment_symbol = '#>#'
+        self.settings_file: str = settings_file or Assistant.SETTINGS_FILE_NAME
+        self.settings_overrides: Dict[str, Dict[str, Any]] = settings_overrides or {}
+        # The arguments of the `HistoryManager` of every session; `None` to always send the full history
+        self.history_settings: Optional[Dict[str, Any]] = {}
+        # Where to export the trace of every session, if tracing is enabled
+        self.trace_jsonl_file: Optional[str] = None
+        self.trace_chrome_file: Optional[str] = None
+        self.trace_summary: bool = True
+        # Where the state of the session is saved after every step, if enabled, and whether to resume from there
+        self.checkpoint_file: Optional[str] = None
+        self.resume: bool = False
+        # The arguments of the `ResilientBackend` wrapping the model backend; `None` to call the model directly
+        self.resilience_settings: Optional[Dict[str, Any]] = {}
+        self.resilient_backend: Optional[ResilientBackend] = None
+        # Where the model responses are cached, and the maximum size of the cache in MB; `None` if disabled
+        self.response_cache_dir: Optional[str] = None
+        self.response_cache_size_mb: float = 256
+        # The arguments of `WorkspaceIndex.reset`; `None` not to index the working directory
+        self.workspace_settings: Optional[Dict[str, Any]] = {}
+        # The maximum number of files in the summary of the workspace sent to the model; 0 for none
+        self.workspace_summary_entries: int = 40
+        # The arguments of `SnapshotStore.reset`; `None` not to snapshot the working directory before every step
+        self.snapshot_settings: Optional[Dict[str, Any]] = None
+        # Runs the function calls of several alternative responses in sandboxes, if enabled
+        self.speculator: Optional[Speculator] = None
+        # The temperature of the most varied of the alternative responses
+        self.variant_temperature: float = 1.0
+        # Called with the name and the details of every event of a session, e.g., after every step
+        self.on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None
+
+        self.system_prompt: str = self.make_system_prompt()
 
         self.configure()
 
-        self.system_prompt: str = (
+    def make_system_prompt(self) -> str:
+        """
+        :return: The system prompt, which names the tools available.
+        """
+
+        return (
             f'Today is {get_today()}. You are an AI assistant.'
             ' Answer users questions or help attain the specified objectives as best as you can.'
             ' You have a set of tools to help generate the solution.'
@@ -87,14 +163,25 @@ class Assistant:
             ' the subsequent steps should try to fix it before reaching the final answer.'
         )
 
+    def add_tool(self, tool: Type[ToolInterface]):
+        """
+        Make another tool available to the model, e.g., as enabled by the settings.
+        """
+
+        self.tools.append(tool.function_declaration)
+        self.tools_by_name[tool.name] = tool
+        self.system_prompt = self.make_system_prompt()
+
     def configure(self):
         """
-        Set some of the configurations of the Assistant and the Gemini Pro LLM.
+        Set some of the configurations of the Assistant and the model backend.
         """
 
         try:
-            with open(Assistant.SETTINGS_FILE_NAME, 'r', encoding='utf-8') as in_file:
-                data = toml.load(in_file)
+            data = load_settings(self.settings_file)
+
+            for section, params in self.settings_overrides.items():
+                data.setdefault(section, {}).update(params)
 
             if 'Assistant' in data.keys():
                 params = data['Assistant']
@@ -107,6 +194,8 @@ class Assistant:
                     self.max_steps = params['max_steps']
                 if 'prompt_comment_symbol' in params:
                     self.prompt_comment_symbol = params['prompt_comment_symbol']
+                if 'streaming' in params:
+                    self.streaming = params['streaming']
 
                 if 'prompt_file' in params:
                     try:
@@ -134,7 +223,119 @@ class Assistant:
                         )
                         sys.exit(1)
 
+            if 'Cache' in data.keys():
+                params = data['Cache']
+
+                # The caches of the tools not in use do not exist
+                if 'lint_cache_size' in params and 'Lint' in CACHES:
+                    CACHES['Lint'].resize(params['lint_cache_size'])
+                if 'Execution' in CACHES:
+                    CACHES['Execution'].resize(
+                        params.get('execution_cache_size', 32) if params.get('execution_cache', False) else 0
+                    )
+                if params.get('response_cache', False):
+                    self.response_cache_dir = params.get('response_cache_dir') or '~/.cache/gemini_senpai/responses'
+                    self.response_cache_size_mb = params.get('response_cache_size_mb', self.response_cache_size_mb)
+
+            if 'History' in data.keys():
+                params = data['History']
+
+                if params.get('enabled', True):
+                    self.history_settings = {
+                        key: params[key]
+                        for key in ('token_budget', 'keep_recent_turns', 'max_tool_output_chars')
+                        if key in params
+                    }
+                else:
+                    self.history_settings = None
+
+            if 'Resilience' in data.keys():
+                params = data['Resilience']
+
+                if params.get('enabled', True):
+                    self.resilience_settings = {
+                        key: params[key]
+                        for key in (
+                            'timeout', 'max_retries', 'backoff_base', 'backoff_max', 'retry_blocked',
+                            'hedge_percentile', 'hedge_min_samples',
+                        )
+                        if key in params
+                    }
+                    # The processes of a batch share the quota
+                    if params.get('requests_per_minute'):
+                        self.resilience_settings['requests_per_minute'] = (
+                            params['requests_per_minute'] / max(1, params.get('num_processes', 1))
+                        )
+                else:
+                    self.resilience_settings = None
+
+            if 'Workspace' in data.keys():
+                params = data['Workspace']
+
+                if params.get('enabled', True):
+                    self.workspace_settings = {
+                        key: params[key] for key in ('watch', 'max_files', 'exclude') if key in params
+                    }
+                    if 'summary_entries' in params:
+                        self.workspace_summary_entries = params['summary_entries']
+                else:
+                    self.workspace_settings = None
+
+            if 'Snapshots' in data.keys():
+                params = data['Snapshots']
+
+                if params.get('enabled', False):
+                    self.snapshot_settings = {
+                        key: params[key] for key in ('dir_name', 'max_files', 'max_mb') if key in params
+                    }
+                    # Let the model roll back the files too
+                    if 'RollbackTool' not in self.tools_by_name:
+                        self.add_tool(get_tool('RollbackTool'))
+
+            if 'Speculation' in data.keys():
+                params = data['Speculation']
+
+                if params.get('enabled', False) and Speculator.is_supported():
+                    self.speculator = Speculator(
+                        self.tools_by_name,
+                        **{
+                            key: params[key]
+                            for key in ('num_variants', 'max_files', 'max_mb', 'timeout')
+                            if key in params
+                        }
+                    )
+                    if 'variant_temperature' in params:
+                        self.variant_temperature = params['variant_temperature']
+
+            if 'Tracing' in data.keys():
+                params = data['Tracing']
+
+                if 'enabled' in params:
+                    TRACER.enabled = params['enabled']
+                if 'summary' in params:
+                    self.trace_summary = params['summary']
+                self.trace_jsonl_file = params.get('jsonl_file') or None
+                self.trace_chrome_file = params.get('chrome_trace_file') or None
+
+            if 'Checkpoint' in data.keys():
+                params = data['Checkpoint']
+
+                if params.get('enabled', False):
+                    self.checkpoint_file = params.get('file') or '.senpai_checkpoint.json.gz'
+                    self.resume = params.get('resume', False)
+
+            for tool in self.tools_by_name.values():
+                if tool.name in data.keys():
+                    tool.configure(data[tool.name])
+
             model_config = MODEL_CONFIG.copy()
+            backend_name = DEFAULT_BACKEND
+            record_file = None
+            model_name = 'gemini-pro'
+            use_system_instruction = False
+
+            if 'Assistant' in data.keys() and 'backend' in data['Assistant']:
+                backend_name = data['Assistant']['backend']
 
             if 'Gemini' in data.keys():
                 params = data['Gemini']
@@ -147,41 +348,137 @@ class Assistant:
                     model_config['top_k'] = params['top_k']
                 if 'top_p' in params:
                     model_config['top_p'] = params['top_p']
+                if 'record_file' in params and params['record_file']:
+                    record_file = params['record_file']
+                if 'model_name' in params:
+                    model_name = params['model_name']
+                if 'system_instruction' in params:
+                    use_system_instruction = params['system_instruction']
 
-            self.model = GenerativeModel(
-                model_name='gemini-pro',
-                generation_config=model_config,
-                safety_settings=SAFETY_SETTINGS,
-                tools=[self.tools],
-            )
+            if backend_name == ReplayBackend.name:
+                params = data.get('Replay', {})
+
+                if 'recording_file' not in params:
+                    tc.cprint(
+                        f'\n* Error: The replay backend requires `recording_file` in the [Replay] settings.'
+                        f'\nExiting...',
+                        Assistant.COLOR_ERROR
+                    )
+                    sys.exit(1)
+
+                self.backend = self.make_resilient(
+                    ReplayBackend.from_file(params['recording_file'], params.get('latency', 0.0))
+                )
+            elif backend_name == DEFAULT_BACKEND:
+                system_instruction = self.system_prompt if use_system_instruction else None
+                self.backend = self.make_cached(
+                    self.make_resilient(
+                        self.create_gemini_backend(
+                            model_config,
+                            model_name=model_name,
+                            system_instruction=system_instruction,
+                            variant_temperature=self.variant_temperature
+                        )
+                    ),
+                    {
+                        'backend': backend_name,
+                        'model_name': model_name,
+                        'generation_config': model_config,
+                        'tools': self.tools,
+                        'system_instruction': system_instruction,
+                    }
+                )
+
+                # Only the responses finally used are recorded
+                if record_file:
+                    self.backend = RecordingBackend(self.backend, record_file)
+            else:
+                tc.cprint(
+                    f'\n* Error: Unknown backend `{backend_name}` specified in the settings.'
+                    f' Will use {DEFAULT_BACKEND}.',
+                    Assistant.COLOR_ERROR
+                )
 
             if self.debug:
                 tc.cprint(f'Using tools:\n{self.tools}', Assistant.COLOR_DEBUG)
         except FileNotFoundError:
             tc.cprint(
-                f'\n* Error: The {Assistant.SETTINGS_FILE_NAME} file ws not found. Will use the default settings.',
+                f'\n* Error: The {self.settings_file} file ws not found. Will use the default settings.',
                 Assistant.COLOR_ERROR
             )
         except Exception as ex:
             msg = (
-                f'\n* An exception occurred while reading the {Assistant.SETTINGS_FILE_NAME} file: {ex}.'
+                f'\n* An exception occurred while reading the {self.settings_file} file: {ex}.'
                 f'\nWill use the default settings.'
             )
             tc.cprint(msg, Assistant.COLOR_ERROR)
         finally:
-            if self.model is None:
-                self.model = GenerativeModel(
-                    model_name='gemini-pro',
-                    generation_config=MODEL_CONFIG,
-                    safety_settings=SAFETY_SETTINGS,
-                    tools=[self.tools],
-                )
+            if self.backend is None:
+                self.backend = self.make_resilient(self.create_gemini_backend(MODEL_CONFIG))
+
+    def make_resilient(self, backend: ModelBackend) -> ModelBackend:
+        """
+        Wrap a backend with timeouts, retries, rate limiting, and hedging, as per the settings.
+
+        :param backend: The backend.
+        :return: The wrapped backend, or the backend itself if disabled.
+        """
+
+        if self.resilience_settings is None:
+            return backend
+
+        self.resilient_backend = ResilientBackend(backend, verbose=self.verbose, **self.resilience_settings)
+        return self.resilient_backend
+
+    def make_cached(self, backend: ModelBackend, config: Dict[str, Any]) -> ModelBackend:
+        """
+        Wrap a backend with the persistent response cache, if enabled in the settings.
+
+        :param backend: The backend.
+        :param config: Everything else the responses depend on besides the chat history.
+        :return: The wrapped backend, or the backend itself if disabled.
+        """
+
+        if self.response_cache_dir is None or not backend.stateless:
+            return backend
+
+        cache = DiskCache('Response', self.response_cache_dir, int(self.response_cache_size_mb * 1024 * 1024))
+        # Today's date is in the system prompt; a rerun on another day should still hit the cache
+        return CachingBackend(backend, cache, config, volatile=[get_today()])
+
+    def create_gemini_backend(self, model_config: Dict[str, Any], **kwargs) -> ModelBackend:
+        """
+        Create the Gemini backend. Vertex AI takes seconds to import, so it is imported only here,
+        and not at all when another backend is used.
+
+        :param model_config: The generation parameters.
+        :param kwargs: Any other arguments of the backend.
+        :return: The backend.
+        """
+
+        from ai_assistant.backends.gemini import GeminiBackend
 
+        key = json.dumps([self.tools, model_config, kwargs], sort_keys=True, default=str)
+        if key not in GEMINI_BACKENDS:
+            GEMINI_BACKENDS[key] = GeminiBackend(self.tools, model_config, **kwargs)
+
+        return GEMINI_BACKENDS[key]
+
+    def emit_event(self, name: str, **data):
+        """
+        Report an event of the session to `on_event`, if set.
+
+        :param name: The name of the event, e.g., `step`.
+        :param data: The details of the event.
+        """
+
+        if self.on_event is not None:
+            self.on_event(name, data)
 
     @staticmethod
-    def get_chat_response(chat_session: ChatSession, prompt: str) -> MultiCandidateTextGenerationResponse:
+    def get_chat_response(chat_session: ChatSession, prompt: str) -> Any:
         """
-        Get chat response from Gemini.
+        Get chat response from the model backend.
 
         :param chat_session: The ongoing chat session.
         :param prompt: The user prompt.
@@ -191,9 +488,534 @@ class Assistant:
         response = chat_session.send_message(prompt)
         return response
 
-    def run(self):
+    async def speculate(self, chat_session: ChatSession, responses: List[Any]) -> Tuple[Any, Optional[List[str]]]:
+        """
+        Run the function calls of several alternative responses speculatively, so that the response
+        used is the first one whose calls succeeded, as per `Speculator`.
+
+        :param chat_session: The ongoing chat session.
+        :param responses: The responses, as given by `ChatSession.send_message_variants`.
+        :return: The response chosen, which is then in the history, and the outputs of its function
+         calls other than the final answer, or `None` if those are still to be run.
+        """
+
+        if len(responses) < 2:
+            return responses[0], None
+
+        call_lists = []
+
+        for response in responses:
+            calls = [Assistant.get_function_call(part) for part in response.candidates[0].content.parts]
+            call_lists.append([
+                call for call in calls if call is not None and call[0] != FinalAnswerTool.name
+            ])
+
+        speculation = await asyncio.to_thread(self.speculator.run, call_lists, self.use_tool)
+        if speculation is None:
+            return responses[0], None
+
+        num, outputs = speculation
+        if num != 0:
+            chat_session.choose_variant(responses[num])
+            if self.verbose:
+                tc.cprint(f'*** Using alternative response {num + 1} of {len(responses)}', Assistant.COLOR_TEXT)
+
+        return responses[num], outputs
+
+    @staticmethod
+    def get_function_call(part: Any) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """
+        Get the function call of a part of a response.
+
+        :param part: The part.
+        :return: The function name and its parameters, or `None` if the part has no valid call.
+        """
+
+        func_call = part.function_call
+        if not func_call.name or func_call.args is None:
+            return None
+
+        return func_call.name, dict(func_call.args)
+
+    @staticmethod
+    def is_related_path(path_a: str, path_b: str) -> bool:
+        """
+        Check whether two paths refer to the same file or directory or one contains the other.
+
+        :param path_a: The first path.
+        :param path_b: The second path.
+        :return: True if the paths are related.
+        """
+
+        path_a, path_b = os.path.abspath(path_a), os.path.abspath(path_b)
+
+        try:
+            common = os.path.commonpath([path_a, path_b])
+        except ValueError:  # Different drives
+            return False
+
+        return common in (path_a, path_b)
+
+    def get_resource(self, func_name: str, params: Dict[str, Any]) -> Optional[str]:
+        """
+        Get the resource a function call works on, if the call may run concurrently with others.
+
+        :param func_name: The name of the tool.
+        :param params: The parameters of the call.
+        :return: The path of the resource, or `None` if the call must run alone.
+        """
+
+        tool = self.tools_by_name.get(func_name)
+        return tool.get_resource(params) if tool and tool.concurrent_safe else None
+
+    def plan_function_calls(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[List[Tuple[str, Dict[str, Any]]]]:
+        """
+        Split the function calls of a response into stages. The calls within a stage are
+        independent of each other and can run concurrently; the stages run one after another,
+        in the order the calls were generated.
+
+        :param calls: The function names and their parameters.
+        :return: The stages.
+        """
+
+        stages = []
+        stage_resources = []
+
+        for func_name, params in calls:
+            resource = self.get_resource(func_name, params)
+
+            can_join = (
+                stages
+                and resource is not None
+                and all(res is not None for res in stage_resources)
+                and not any(Assistant.is_related_path(resource, res) for res in stage_resources)
+            )
+
+            if can_join:
+                stages[-1].append((func_name, params))
+                stage_resources.append(resource)
+            else:
+                stages.append([(func_name, params)])
+                stage_resources = [resource]
+
+        return stages
+
+    def use_tool(self, func_name: str, params: Dict[str, Any]) -> str:
+        """
+        Use a tool by its name.
+
+        :param func_name: The name of the tool.
+        :param params: The parameters of the function call.
+        :return: The output of the tool's action.
+        """
+
+        if func_name not in self.tools_by_name:
+            return (
+                f'* Error:: There is no tool named {func_name}.'
+                f' Please use one of the following: {", ".join(self.tools_by_name.keys())}.'
+            )
+
+        tool = self.tools_by_name[func_name]
+
+        with trace(func_name, 'tool'):
+            output = tool.use(params)
+
+        if not tool.tracks_workspace:
+            # E.g., a program run may have changed any file
+            WORKSPACE.refresh()
+
+        return output
+
+    async def execute_function_calls(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[str]:
+        """
+        Execute all function calls of a response, running the independent ones concurrently.
+
+        :param calls: The function names and their parameters.
+        :return: The output of each call, in the order of the calls.
+        """
+
+        outputs = []
+
+        for stage in self.plan_function_calls(calls):
+            if self.verbose and len(stage) > 1:
+                tc.cprint(f'*** Running {len(stage)} function calls concurrently', Assistant.COLOR_TEXT)
+
+            outputs.extend(
+                await asyncio.gather(
+                    *[asyncio.to_thread(self.use_tool, func_name, params) for func_name, params in stage]
+                )
+            )
+
+        return outputs
+
+    async def stream_chat_response(
+            self,
+            chat_session: ChatSession,
+            prompt: str,
+            span: Any
+    ) -> Tuple[Any, List[asyncio.Task]]:
+        """
+        Get a chat response as a stream, and start executing every function call as soon as it
+        arrives, while the rest of the response is still being generated. A call waits only for
+        the earlier calls that it cannot run concurrently with, as per `plan_function_calls`.
+
+        :param chat_session: The ongoing chat session.
+        :param prompt: The user prompt.
+        :param span: The span of the model call, which records the time until the first function call.
+        :return: The response, and the execution of every function call other than the final answer,
+         in the order of the calls.
+        """
+
+        loop = asyncio.get_running_loop()
+        parts: asyncio.Queue = asyncio.Queue()
+        start_time = time.perf_counter()
+
+        async def execute_after(
+                earlier: List[asyncio.Task], func_name: str, params: Dict[str, Any]
+        ) -> str:
+            if earlier:
+                await asyncio.wait(earlier)
+            return await asyncio.to_thread(self.use_tool, func_name, params)
+
+        generation = asyncio.ensure_future(
+            asyncio.to_thread(
+                chat_session.send_message_stream, prompt, lambda part: loop.call_soon_threadsafe(parts.put_nowait, part)
+            )
+        )
+        # Every part is queued before the generation is done, so this comes last
+        generation.add_done_callback(lambda _: parts.put_nowait(None))
+        executions: List[Tuple[Optional[str], asyncio.Task]] = []
+        # Whether a text is being shown as it arrives
+        showing_text = False
+
+        while True:
+            part = await parts.get()
+            if part is None:
+                break
+
+            call = Assistant.get_function_call(part)
+
+            if call is None:
+                if self.verbose and getattr(part, 'text', ''):
+                    print(part.text, end='', flush=True)
+                    showing_text = True
+                continue
+
+            if showing_text:
+                print()
+                showing_text = False
+
+            func_name, params = call
+            if self.verbose:
+                tc.cprint(f'*** Function call: {func_name=}, {params=}', Assistant.COLOR_TEXT)
+            if func_name == FinalAnswerTool.name:
+                continue
+
+            if not executions:
+                span.set(first_call_time=round(time.perf_counter() - start_time, 4))
+
+            resource = self.get_resource(func_name, params)
+            earlier = [
+                task for earlier_resource, task in executions
+                if resource is None or earlier_resource is None
+                or Assistant.is_related_path(resource, earlier_resource)
+            ]
+            executions.append((resource, asyncio.ensure_future(execute_after(earlier, func_name, params))))
+
+        if showing_text:
+            print()
+
+        tasks = [task for _, task in executions]
+
+        try:
+            response = await generation
+        except BaseException:
+            # Let the calls already started finish before giving up
+            if tasks:
+                await asyncio.wait(tasks)
+            raise
+
+        return response, tasks
+
+    def get_initial_history(self) -> List[Any]:
+        """
+        Get the chat history to start a session with. The task itself is not included;
+        it is sent exactly once, in the first step.
+
+        :return: The history.
+        """
+
+        if self.backend.has_system_instruction:
+            return []
+
+        # Since Gemini Pro does not allow system prompt/context, mimic to have one
+        history = [
+            self.backend.make_content('user', self.system_prompt),
+            self.backend.make_content(
+                'model', 'Okay. I will follow the instructions and help you achieve the goal.'
+            ),
+        ]
+
+        if self.debug:
+            tc.cprint(f'Setting chat history to:\n{history}', Assistant.COLOR_DEBUG)
+
+        return history
+
+    def save_checkpoint(self, chat: ChatSession, next_step: int, prompt: str):
+        """
+        Save the state of the session after a step, to resume from if the session is interrupted.
+
+        :param chat: The ongoing chat session.
+        :param next_step: The index of the next step.
+        :param prompt: The prompt of the next step.
+        """
+
+        checkpoint = Checkpoint(
+            hash_text(self.prompt),
+            next_step,
+            prompt,
+            Checkpoint.history_to_dicts(chat.history),
+            chat.num_fixed_turns,
+            chat.usage.to_dict(),
+            Checkpoint.hash_files(exclude=self.checkpoint_file),
+            chat.num_responses,
+        )
+        checkpoint.save(self.checkpoint_file)
+
+    def restore_checkpoint(self, chat: ChatSession) -> Optional[Tuple[int, str]]:
+        """
+        Restore the state of an interrupted session of the same task from its checkpoint.
+        If any file was changed since, the model is told about it in the next prompt.
+
+        :param chat: The new chat session, to restore the state into.
+        :return: The index of the step to resume from and its prompt, or `None` to start afresh.
+        """
+
+        checkpoint = Checkpoint.load(self.checkpoint_file)
+
+        if checkpoint is None:
+            tc.cprint(f'\nNo checkpoint found at {self.checkpoint_file}; starting afresh', Assistant.COLOR_DEBUG)
+            return None
+        if checkpoint.prompt_hash != hash_text(self.prompt):
+            tc.cprint(
+                f'\n* Error: The checkpoint at {self.checkpoint_file} is of another task; starting afresh',
+                Assistant.COLOR_ERROR
+            )
+            return None
+
+        chat.history = Checkpoint.history_from_dicts(checkpoint.history, self.backend)
+        chat.num_fixed_turns = checkpoint.num_fixed_turns
+        chat.usage = UsageStats.from_dict(checkpoint.usage)
+        # Not the round-trips, which count every one of several alternative responses got at once
+        chat.num_responses = checkpoint.num_responses
+        self.backend.resume(chat.num_responses)
+        prompt = checkpoint.prompt
+
+        changes = checkpoint.changed_files(Checkpoint.hash_files(exclude=self.checkpoint_file))
+        if changes:
+            tc.cprint(f'Files changed since the checkpoint: {", ".join(changes)}', Assistant.COLOR_DEBUG)
+            prompt = (
+                f'Note: The following files were changed outside of this session since the previous step:'
+                f' {", ".join(changes)}.\n{prompt}'
+            )
+
+        tc.cprint(
+            f'\nResuming from step {checkpoint.next_step + 1} after {chat.usage.round_trips} model calls',
+            Assistant.COLOR_TEXT
+        )
+        return checkpoint.next_step, prompt
+
+    async def run_step(self, chat: ChatSession, prompt: str, idx: int, result: Dict[str, Any]) -> Optional[str]:
+        """
+        Execute a single step: send the prompt, then execute the function calls of the response.
+
+        :param chat: The ongoing chat session.
+        :param prompt: The prompt of this step.
+        :param idx: The index of the step.
+        :param result: The outcome of the session, updated when the session ends.
+        :return: The prompt for the next step, or `None` if the session has ended.
+        """
+
+        msg = f'\n\n>>>>> Step {idx + 1} <<<<<'
+        tc.cprint(msg, Assistant.COLOR_TEXT)
+
+        # if self.debug:
+        #     tc.cprint(f'>> The chat history so far:\n{chat.history}', Assistant.COLOR_DEBUG)
+
+        # The model is told the number of every step, so that it can go back to one
+        if self.snapshot_settings is not None and 'RollbackTool' in self.tools_by_name:
+            prompt = f'[Step {idx + 1}]\n{prompt}'
+
+        print(f'{prompt}')
+
+        # The function calls started while the response was streamed, if streaming
+        executions = None
+        # The alternative responses, if speculating
+        responses = None
+        # The outputs of the function calls already run speculatively, if any
+        action_outputs = None
+
+        try:
+            with trace('generate', 'model', step=idx + 1) as span:
+                prompt_tokens, response_tokens = chat.usage.prompt_tokens, chat.usage.response_tokens
+                if self.streaming:
+                    response, executions = await self.stream_chat_response(chat, prompt, span)
+                elif self.speculator is not None:
+                    responses = await asyncio.to_thread(
+                        chat.send_message_variants, prompt, self.speculator.num_variants
+                    )
+                    response = responses[0]
+                else:
+                    response = await asyncio.to_thread(Assistant.get_chat_response, chat, prompt)
+                span.set(
+                    prompt_tokens=chat.usage.prompt_tokens - prompt_tokens,
+                    response_tokens=chat.usage.response_tokens - response_tokens,
+                )
+        except ResponseBlockedError as rbe:
+            tc.cprint(
+                f'*** Error while generating a response using Gemini: {rbe}',
+                Assistant.COLOR_ERROR
+            )
+            tc.cprint('Exiting...please try running again later', Assistant.COLOR_ERROR)
+            sys.exit(1)
+            # prompt = f'\nOutput based on the previous action: {rbe}'
+            # continue
+        except ModelCallError as mce:
+            tc.cprint(f'*** Error while generating a response: {mce}', Assistant.COLOR_ERROR)
+            result['status'] = 'error'
+            result['error'] = str(mce)
+            return None
+
+        if response.candidates[0].finish_reason == 'SAFETY':
+            msg = '*** Execution stopped because of SAFETY reasons'
+            tc.cprint(msg, Assistant.COLOR_ERROR)
+            result['status'] = 'safety'
+            return None
+
+        if responses is not None:
+            response, action_outputs = await self.speculate(chat, responses)
+
+        calls = []
+        func_name, func_args = None, None
+
+        for part in response.candidates[0].content.parts:
+            func_name, func_args = part.function_call.name, part.function_call.args
+            call = Assistant.get_function_call(part)
+
+            if call is not None:
+                calls.append(call)
+
+        if not calls:
+            prompt = (
+                f'Incorrect choice generated:: {func_name=}, {func_args=}.'
+                f' Please generate a valid function choice based on the following:'
+                f'\n{self.tools}'
+            )
+            return prompt
+
+        # The calls of a streamed response were shown as they arrived
+        if self.verbose and executions is None:
+            for func_name, params in calls:
+                tc.cprint(f'*** Function call: {func_name=}, {params=}', Assistant.COLOR_TEXT)
+
+        final_answers = [params for func_name, params in calls if func_name == FinalAnswerTool.name]
+        calls = [(func_name, params) for func_name, params in calls if func_name != FinalAnswerTool.name]
+
+        if executions is not None:
+            action_outputs = list(await asyncio.gather(*executions))
+        elif action_outputs is None:
+            action_outputs = await self.execute_function_calls(calls)
+
+        if self.verbose:
+            for action_output in action_outputs:
+                tc.cprint(f'*** Output of the function call: {action_output}', Assistant.COLOR_TEXT)
+
+        self.emit_event(
+            'step',
+            step=idx + 1,
+            calls=[{'name': func_name, 'params': params} for func_name, params in calls],
+            outputs=action_outputs,
+            final_answer=final_answers[0].get('answer') if final_answers else None,
+        )
+
+        if final_answers:
+            msg = (
+                f'\nExiting the loop after {idx + 1} runs because the final answer was found:'
+                f'\n\n{final_answers[0]["answer"]}'
+            )
+            tc.cprint(msg, Assistant.COLOR_TEXT)
+            result['status'] = 'completed'
+            result['final_answer'] = final_answers[0]['answer']
+            return None
+
+        if len(calls) == 1:
+            prompt = f'Previously used tool: {calls[0][0]}\nOutput of the previous action: {action_outputs[0]}'
+        else:
+            prompt = '\n'.join(
+                [f'Previously used tools: {", ".join(func_name for func_name, _ in calls)}'] + [
+                    f'Output of the previous action {num} ({func_name}): {action_output}'
+                    for num, ((func_name, _), action_output) in enumerate(zip(calls, action_outputs), 1)
+                ]
+            )
+
+        if self.workspace_summary_entries:
+            summary = WORKSPACE.get_changed_summary(self.workspace_summary_entries)
+            if summary:
+                prompt = f'{prompt}\n{summary}'
+
+        return prompt
+
+    def rollback(self, step: int) -> bool:
+        """
+        Restore the files of the working directory to how they were before a step of the last session.
+
+        :param step: The step, starting from 1.
+        :return: True if restored, False if there is no snapshot of the step.
+        """
+
+        SNAPSHOTS.reset(os.getcwd(), clear=False, **(self.snapshot_settings or {}))
+
+        try:
+            steps = SNAPSHOTS.steps()
+            changes = SNAPSHOTS.rollback(step) if step in steps else None
+        finally:
+            SNAPSHOTS.reset(None)
+
+        if changes is None:
+            tc.cprint(
+                f'\n* Error: There is no snapshot of the files before step {step}.'
+                f' The snapshots are of the steps: {", ".join(map(str, steps)) or "none"}.',
+                Assistant.COLOR_ERROR
+            )
+            return False
+
+        tc.cprint(
+            f'\nRestored the files to how they were before step {step}: {", ".join(changes) or "no changes"}',
+            Assistant.COLOR_TEXT
+        )
+        return True
+
+    def run(self) -> Dict[str, Any]:
         """
         Execute the assistant to solve a specified problem.
+
+        :return: The outcome of the session: its `status`, the number of `steps` taken,
+         the `final_answer`, if any, the `error` of a model call that failed even after its
+         retries, the model `usage`, and the estimated `history_tokens` sent in the last step,
+         if the history was managed.
+        """
+
+        return asyncio.run(self.arun())
+
+    async def arun(self) -> Dict[str, Any]:
+        """
+        Execute the assistant to solve a specified problem. All function calls generated in a
+        step are executed, and their outputs are sent back together in the next step.
+
+        :return: The outcome of the session: its `status`, the number of `steps` taken,
+         the `final_answer`, if any, the `error` of a model call that failed even after its
+         retries, the model `usage`, and the estimated `history_tokens` sent in the last step,
+         if the history was managed.
         """
 
         if not self.prompt:
@@ -207,75 +1029,83 @@ class Assistant:
 
         print(f'running now for max {self.max_steps} steps')
 
-        # Since Gemini does not allow system prompt/context, mimic to have one
-        history = [
-            Content(role='user', parts=[Part.from_text(self.system_prompt)]),
-            Content(role='model', parts=[
-                Part.from_text('Okay. I will follow the instructions and help you achieve the goal.')
-            ]),
-        ]
+        history_manager = HistoryManager(**self.history_settings) if self.history_settings is not None else None
+        chat = self.backend.start_chat(history=self.get_initial_history(), history_manager=history_manager)
+        prompt = self.prompt
+        start_step = 0
+        result = {'status': 'max_steps', 'steps': 0, 'final_answer': None}
+        TRACER.reset()
 
-        if self.debug:
-            tc.cprint(f'Setting chat history to:\n{history}', Assistant.COLOR_DEBUG)
+        if self.resume and self.checkpoint_file:
+            restored = self.restore_checkpoint(chat)
+            if restored is not None:
+                start_step, prompt = restored
+                result['steps'] = start_step
 
-        chat = self.model.start_chat(history=history)
-        Assistant.get_chat_response(chat, self.prompt)
-        prompt = self.prompt
+        if self.workspace_settings is not None:
+            WORKSPACE.reset(os.getcwd(), **self.workspace_settings)
 
-        for idx in range(self.max_steps):
-            msg = f'\n\n>>>>> Step {idx + 1} <<<<<'
-            tc.cprint(msg, Assistant.COLOR_TEXT)
+            # The files already there are summarized in the first prompt; an empty directory is not
+            summary = WORKSPACE.get_changed_summary(self.workspace_summary_entries)
+            if summary and self.workspace_summary_entries and WORKSPACE.files and start_step == 0:
+                prompt = f'{prompt}\n{summary}'
 
-            # if self.debug:
-            #     tc.cprint(f'>> The chat history so far:\n{chat.history}', Assistant.COLOR_DEBUG)
+        if self.snapshot_settings is not None:
+            # The snapshots of an interrupted session are kept to resume it
+            SNAPSHOTS.reset(os.getcwd(), clear=start_step == 0, **self.snapshot_settings)
 
-            print(f'{prompt}')
+        with trace('session', 'session'):
+            for idx in range(start_step, self.max_steps):
+                result['steps'] = idx + 1
 
-            try:
-                response = Assistant.get_chat_response(chat, prompt)
-            except vertexai.generative_models._generative_models.ResponseBlockedError as rbe:
-                tc.cprint(
-                    f'*** Error while generating a response using Gemini: {rbe}',
-                    Assistant.COLOR_ERROR
-                )
-                tc.cprint('Exiting...please try running again later', Assistant.COLOR_ERROR)
-                sys.exit(1)
-                # prompt = f'\nOutput based on the previous action: {rbe}'
-                # continue
-
-            if response.candidates[0].finish_reason == 'SAFETY':
-                msg = '*** Execution stopped because of SAFETY reasons'
-                tc.cprint(msg, Assistant.COLOR_ERROR)
-                break
+                if self.snapshot_settings is not None:
+                    with trace('snapshot', 'snapshot', step=idx + 1) as span:
+                        span.set(files_stored=SNAPSHOTS.take(idx + 1))
 
-            func_call = response.candidates[0].content.parts[0].function_call
-            func_name = func_call.name
-            func_args = func_call.args
+                with trace('step', 'step', step=idx + 1):
+                    prompt = await self.run_step(chat, prompt, idx, result)
 
-            if func_name == '' or func_name is None or func_args is None:
-                prompt = (
-                    f'Incorrect choice generated:: {func_name=}, {func_args=}.'
-                    f' Please generate a valid function choice based on the following:'
-                    f'\n{self.tools}'
-                )
-                continue
+                if prompt is None:
+                    break
 
-            params = dict(func_args)
+                if self.checkpoint_file:
+                    with trace('checkpoint', 'checkpoint'):
+                        self.save_checkpoint(chat, idx + 1, prompt)
 
-            if self.verbose:
-                tc.cprint(f'*** Function call: {func_name=}, {params=}', Assistant.COLOR_TEXT)
+        WORKSPACE.reset(None)
+        # The snapshots are kept until the next session, to go back to any step after the session, too
+        SNAPSHOTS.reset(None)
 
-            if func_name == FinalAnswerTool.name:
-                msg = (
-                    f'\nExiting the loop after {idx + 1} runs because the final answer was found:'
-                    f'\n\n{params["answer"]}'
-                )
-                tc.cprint(msg, Assistant.COLOR_TEXT)
-                break
+        # The session has ended by itself, so there is nothing left to resume, unless the model failed
+        if self.checkpoint_file and result['status'] != 'error' and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
 
-            action_output = self.tools_by_name[func_name].use(params)
+        result['usage'] = chat.usage.to_dict()
+        tc.cprint(f'\n{chat.usage.report()}', Assistant.COLOR_TEXT)
 
-            if self.verbose:
-                tc.cprint(f'*** Output of the function call: {action_output}', Assistant.COLOR_TEXT)
+        if history_manager is not None:
+            result['history_tokens'] = history_manager.last_tokens
+            tc.cprint(history_manager.report(), Assistant.COLOR_TEXT)
+
+        if self.resilient_backend is not None:
+            tc.cprint(self.resilient_backend.report(), Assistant.COLOR_TEXT)
+
+        if self.speculator is not None:
+            tc.cprint(self.speculator.report(), Assistant.COLOR_TEXT)
+
+        if self.snapshot_settings is not None:
+            tc.cprint(SNAPSHOTS.report(), Assistant.COLOR_TEXT)
+
+        if self.verbose:
+            for cache in CACHES.values():
+                tc.cprint(cache.report(), Assistant.COLOR_TEXT)
+
+        if TRACER.enabled:
+            if self.trace_summary:
+                tc.cprint(f'\n{TRACER.summary()}', Assistant.COLOR_TEXT)
+            if self.trace_jsonl_file:
+                TRACER.export_jsonl(self.trace_jsonl_file)
+            if self.trace_chrome_file:
+                TRACER.export_chrome_trace(self.trace_chrome_file)
 
-            prompt = f'Previously used tool: {func_name}\nOutput of the previous action: {action_output}'
+        return result
@@ -0,0 +1,362 @@
+import json
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from ai_assistant.tracing import trace
+
+
+class ResponseBlockedError(Exception):
+    """
+    Raised by a backend when the model refused to generate a usable response.
+    """
+
+    def __init__(self, message: str, response: Any = None):
+        super().__init__(message)
+        self.response = response
+
+
+class Candidate(object):
+    def __init__(self, content: Any, finish_reason: str = 'STOP'):
+        self.content = content
+        self.finish_reason = finish_reason
+
+
+class Response(object):
+    """
+    A response assembled by the assistant itself rather than received from a model, e.g., from
+    the chunks of a streamed response, or from a cache. It looks like Gemini's responses.
+    """
+
+    def __init__(self, candidates: List[Candidate], usage_metadata: Any = None):
+        self.candidates = candidates
+        self.usage_metadata = usage_metadata
+
+    @property
+    def text(self) -> str:
+        return ''.join(getattr(part, 'text', '') for part in self.candidates[0].content.parts) if self.candidates else ''
+
+
+def get_finish_reason(response: Any) -> str:
+    """
+    Get the finish reason of a response by its name, e.g., `STOP`, whatever the backend.
+
+    :param response: The response.
+    :return: The name of the finish reason.
+    """
+
+    finish_reason = response.candidates[0].finish_reason
+    return getattr(finish_reason, 'name', str(finish_reason))
+
+
+def join_chunks(chunks: List[Any]) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Join the chunks of a streamed response. A text may be split across chunks, but a function
+    call always arrives whole.
+
+    :param chunks: The chunks, each a response with a part of the content.
+    :return: The parts of the whole response, as dictionaries, and its finish reason.
+    """
+
+    parts: List[Dict[str, Any]] = []
+
+    for chunk in chunks:
+        if not chunk.candidates:
+            continue
+
+        for part in chunk.candidates[0].content.parts:
+            data = part.to_dict()
+
+            if 'text' in data and len(data) == 1 and parts and list(parts[-1]) == ['text']:
+                parts[-1] = {'text': parts[-1]['text'] + data['text']}
+            else:
+                parts.append(data)
+
+    # The last chunk may have no candidates, e.g., only the usage of the response
+    chunks_with_candidates = [chunk for chunk in chunks if chunk.candidates]
+    finish_reason = get_finish_reason(chunks_with_candidates[-1]) if chunks_with_candidates else 'STOP'
+    return parts, finish_reason
+
+
+def estimate_tokens(contents: List[Any]) -> int:
+    """
+    Roughly estimate the number of tokens in some chat turns, at about four characters per token.
+
+    :param contents: The chat turns.
+    :return: The estimated number of tokens.
+    """
+
+    num_chars = sum(
+        len(json.dumps(part.to_dict(), ensure_ascii=False)) for content in contents for part in content.parts
+    )
+    return (num_chars + 3) // 4
+
+
+class UsageStats(object):
+    """
+    The number of model round-trips and tokens used in a chat session.
+    """
+
+    def __init__(self):
+        self.round_trips = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.estimated = False
+
+    def record(self, contents: List[Any], response: Any):
+        """
+        Account for a single model call. Token counts reported by the backend are used where
+        available; otherwise, they are estimated from the size of the turns.
+
+        :param contents: The turns sent to the model.
+        :param response: The model's response.
+        """
+
+        self.round_trips += 1
+        usage = getattr(response, 'usage_metadata', None)
+
+        if usage is not None and usage.prompt_token_count:
+            self.prompt_tokens += usage.prompt_token_count
+            self.response_tokens += usage.candidates_token_count
+        else:
+            self.estimated = True
+            self.prompt_tokens += estimate_tokens(contents)
+            if response.candidates:
+                self.response_tokens += estimate_tokens([response.candidates[0].content])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'round_trips': self.round_trips,
+            'prompt_tokens': self.prompt_tokens,
+            'response_tokens': self.response_tokens,
+            'estimated': self.estimated,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'UsageStats':
+        usage = UsageStats()
+        usage.round_trips = data.get('round_trips', 0)
+        usage.prompt_tokens = data.get('prompt_tokens', 0)
+        usage.response_tokens = data.get('response_tokens', 0)
+        usage.estimated = data.get('estimated', False)
+        return usage
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the usage.
+
+        :return: The report.
+        """
+
+        return (
+            f'Model round-trips: {self.round_trips}, input tokens: {self.prompt_tokens},'
+            f' output tokens: {self.response_tokens}'
+            + (' (estimated)' if self.estimated else '')
+        )
+
+
+class ModelBackend(object):
+    """
+    An abstract for creating a model backend used by the Assistant.
+    A backend turns the chat history into the next model response. The response must expose
+    `candidates[0].content.parts[i].function_call` and `candidates[0].finish_reason`,
+    like Gemini's responses do.
+    """
+    name: str = 'backend-name'
+    # Whether the backend was given the system prompt natively, so that it need not be in the history
+    has_system_instruction: bool = False
+    # Whether a response depends only on the contents sent, so that a call can be safely sent twice
+    stateless: bool = True
+
+    def make_content(self, role: str, text: str) -> Any:
+        """
+        Create a single chat turn containing only text.
+
+        :param role: The role of the turn, either `user` or `model`.
+        :param text: The text of the turn.
+        :return: The content object understood by this backend.
+        """
+
+        raise NotImplementedError('make_content() method not implemented')  # Implement in subclass
+
+    def content_from_dict(self, data: Dict[str, Any]) -> Any:
+        """
+        Create a chat turn from its dictionary form, as given by `to_dict()` of the turn's parts,
+        e.g., `{'role': 'model', 'parts': [{'function_call': {'name': ..., 'args': {...}}}]}`.
+
+        :param data: The turn as a dictionary.
+        :return: The content object understood by this backend.
+        """
+
+        raise NotImplementedError('content_from_dict() method not implemented')  # Implement in subclass
+
+    def generate(self, contents: List[Any]) -> Any:
+        """
+        Generate the next response based on the whole conversation so far.
+
+        :param contents: The chat history followed by the latest user turn.
+        :return: The response object.
+        """
+
+        raise NotImplementedError('generate() method not implemented')  # Implement in subclass
+
+    def generate_stream(self, contents: List[Any]) -> Iterator[Any]:
+        """
+        Generate the next response as a stream of chunks, so that its parts can be used as soon as
+        they arrive. The backends that cannot stream give the whole response as a single chunk.
+
+        :param contents: The chat history followed by the latest user turn.
+        :return: The chunks, each a response object with some of the parts.
+        """
+
+        yield self.generate(contents)
+
+    def generate_variants(self, contents: List[Any], num_variants: int) -> List[Any]:
+        """
+        Generate several alternative responses at once, e.g., at different temperatures, so that
+        the best one can be used. The backends that cannot vary their responses give only one.
+
+        :param contents: The chat history followed by the latest user turn.
+        :param num_variants: The maximum number of responses.
+        :return: The responses, the one that would be generated by `generate` first.
+        """
+
+        return [self.generate(contents)]
+
+    def resume(self, num_responses: int):
+        """
+        Continue an earlier, interrupted session, which has already got some responses.
+        The backends whose responses depend only on the chat history need not do anything.
+
+        :param num_responses: The number of calls answered in the earlier session; the alternative
+         responses got at once by a single call count as one.
+        """
+
+    def start_chat(self, history: List[Any] = None, history_manager: Any = None) -> 'ChatSession':
+        """
+        Start a new chat session with this backend.
+
+        :param history: The initial chat history, if any.
+        :param history_manager: The `HistoryManager` keeping the history within a token budget, if any.
+        :return: The chat session.
+        """
+
+        return ChatSession(self, history, history_manager)
+
+
+class ChatSession(object):
+    """
+    A backend-agnostic chat session. The session owns the chat history and sends it in full
+    to the backend on every turn, so that the backend itself remains stateless.
+    """
+
+    def __init__(self, backend: ModelBackend, history: List[Any] = None, history_manager: Optional[Any] = None):
+        self.backend = backend
+        self.history: List[Any] = list(history) if history else []
+        self.usage = UsageStats()
+        # The number of calls of the backend, each getting one response or, for variants, several at once
+        self.num_responses = 0
+        self.history_manager = history_manager
+        # The initial turns and the task, which are never compacted
+        self.num_fixed_turns = len(self.history) + 1
+
+    def get_contents(self, prompt: str) -> List[Any]:
+        """
+        Get the turns to send for a user message: the history, compacted if necessary, and the message.
+
+        :param prompt: The user prompt.
+        :return: The turns.
+        """
+
+        contents = self.history + [self.backend.make_content('user', prompt)]
+
+        if self.history_manager is not None:
+            with trace('compact', 'history') as span:
+                span.set(tokens=self.history_manager.compact(contents, self.backend, self.num_fixed_turns))
+            self.history = contents[:-1]
+
+        return contents
+
+    def send_message(self, prompt: str) -> Any:
+        """
+        Send a user message and record both the message and the model's reply in the history.
+
+        :param prompt: The user prompt.
+        :return: The response object.
+        """
+
+        contents = self.get_contents(prompt)
+        content = contents[-1]
+
+        response = self.backend.generate(contents)
+        self.num_responses += 1
+        self.usage.record(contents, response)
+        self.history.append(content)
+
+        if response.candidates:
+            self.history.append(response.candidates[0].content)
+
+        return response
+
+    def send_message_variants(self, prompt: str, num_variants: int) -> List[Any]:
+        """
+        Send a user message like `send_message` does, but get several alternative replies.
+        The first one is recorded in the history until another is chosen with `choose_variant`.
+
+        :param prompt: The user prompt.
+        :param num_variants: The maximum number of replies.
+        :return: The responses.
+        """
+
+        contents = self.get_contents(prompt)
+        responses = self.backend.generate_variants(contents, num_variants)
+        self.num_responses += 1
+
+        for response in responses:
+            self.usage.record(contents, response)
+
+        self.history.append(contents[-1])
+        self.history.append(responses[0].candidates[0].content)
+
+        return responses
+
+    def choose_variant(self, response: Any):
+        """
+        Use another of the replies given by `send_message_variants` in the history.
+
+        :param response: The reply.
+        """
+
+        self.history[-1] = response.candidates[0].content
+
+    def send_message_stream(self, prompt: str, on_part: Callable[[Any], None]) -> Any:
+        """
+        Send a user message like `send_message` does, but receive the reply as a stream,
+        passing every part of it on as soon as it arrives.
+
+        :param prompt: The user prompt.
+        :param on_part: Called with every part of the reply, e.g., a function call, as it arrives.
+        :return: The whole response, once complete.
+        """
+
+        contents = self.get_contents(prompt)
+        content = contents[-1]
+        chunks = []
+
+        for chunk in self.backend.generate_stream(contents):
+            chunks.append(chunk)
+            if chunk.candidates:
+                for part in chunk.candidates[0].content.parts:
+                    on_part(part)
+
+        self.num_responses += 1
+        parts, finish_reason = join_chunks(chunks)
+        response = Response(
+            [Candidate(self.backend.content_from_dict({'role': 'model', 'parts': parts}), finish_reason)],
+            # Only the last chunk has the token counts of the whole response
+            getattr(chunks[-1], 'usage_metadata', None) if chunks else None
+        )
+
+        self.usage.record(contents, response)
+        self.history.append(content)
+        self.history.append(response.candidates[0].content)
+
+        return response
@@ -0,0 +1,197 @@
+import json
+import re
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from ai_assistant.backends.base import Candidate, ModelBackend, Response, join_chunks
+from ai_assistant.cache import DiskCache, hash_text
+from ai_assistant.history import get_parts
+from ai_assistant.tracing import trace
+
+
+# Where the output of a tool starts in the prompt following its call, as written by the assistant
+OUTPUT_MARKER = re.compile(
+    r'^(?:Previously used tool: (\w+)\nOutput of the previous action: |Output of the previous action \d+ \((\w+)\): )',
+    re.MULTILINE
+)
+# The measurements in the outputs of the tools, which differ on every run even when nothing else does,
+# by the tool: the duration and the peak memory in the header of a program run, the time a download
+# took, and the modification times of the files listed
+VOLATILE_OUTPUTS = {
+    'CodeExecutionTool': [
+        (re.compile(r'\A(Status: [^\n]*\n)Duration: \d+\.\d+ s\n(?:Peak memory: \d+\.\d+ MB\n)?'), r'\1<volatile>\n'),
+    ],
+    'DownloadFileTool': [
+        (re.compile(r'^(Successfully downloaded the file and saved it as: .* \(\d+ bytes) in \d+\.\d+ s', re.MULTILINE),
+         r'\1 in <volatile>'),
+    ],
+    'ListDirectoryTool': [
+        (re.compile(r'^(.+  \d+(?:\.\d+)? [KMG]?B  )\d{4}-\d{2}-\d{2} \d{2}:\d{2}$', re.MULTILINE), r'\1<volatile>'),
+    ],
+}
+VOLATILE_OUTPUTS['DownloadFilesTool'] = VOLATILE_OUTPUTS['DownloadFileTool']
+
+
+def mask_tool_outputs(text: str) -> str:
+    """
+    Mask the measurements in the outputs of the tools in a prompt, e.g., the duration of a program
+    run, so that a rerun of a session still finds its responses. Only the lines the tools write
+    themselves are masked, not, e.g., the output of the program run.
+
+    :param text: The prompt.
+    :return: The prompt, masked.
+    """
+
+    matches = list(OUTPUT_MARKER.finditer(text))
+    if not matches:
+        return text
+
+    pieces = [text[:matches[0].end()]]
+
+    for num, match in enumerate(matches):
+        end = matches[num + 1].start() if num + 1 < len(matches) else len(text)
+        output = text[match.end():end]
+
+        for pattern, replacement in VOLATILE_OUTPUTS.get(match.group(1) or match.group(2), []):
+            output = pattern.sub(replacement, output)
+
+        pieces.append(output)
+        if num + 1 < len(matches):
+            pieces.append(text[matches[num + 1].start():matches[num + 1].end()])
+
+    return ''.join(pieces)
+
+
+class CachingBackend(ModelBackend):
+    """
+    Wrap another backend to reuse the responses to identical calls, e.g., when the same prompt
+    is run again with a temperature of zero. A response is keyed on the chat history sent,
+    normalized, and on everything else it depends on, such as the function declarations and
+    the generation parameters. Only the backends whose responses depend on nothing else, i.e.,
+    the stateless ones, should be wrapped.
+    """
+    name: str = 'caching'
+
+    def __init__(
+            self,
+            backend: ModelBackend,
+            cache: DiskCache,
+            config: Dict[str, Any],
+            volatile: Sequence[str] = ()
+    ):
+        """
+        :param backend: The backend to wrap.
+        :param cache: The cache of the responses.
+        :param config: Everything else the responses depend on, e.g., the model name and the
+         generation parameters, which must be serializable to JSON.
+        :param volatile: The texts to ignore in the key, e.g., today's date in the system prompt.
+        """
+
+        self.backend = backend
+        self.has_system_instruction = backend.has_system_instruction
+        self.stateless = backend.stateless
+        self.cache = cache
+        self.config = json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+        self.volatile = [text for text in volatile if text]
+
+    def make_content(self, role: str, text: str) -> Any:
+        return self.backend.make_content(role, text)
+
+    def content_from_dict(self, data: Dict[str, Any]) -> Any:
+        return self.backend.content_from_dict(data)
+
+    def resume(self, num_responses: int):
+        self.backend.resume(num_responses)
+
+    def get_key(self, contents: List[Any]) -> str:
+        """
+        Get the key of a call. The text of every turn is stripped, so that the calls differing only
+        in leading or trailing whitespace are considered identical, and the measurements in the tool
+        outputs, such as the duration of a program run, are masked, so that a rerun of a session
+        still finds its responses.
+
+        :param contents: The chat history followed by the latest user turn.
+        :return: The key.
+        """
+
+        turns = [
+            {
+                'role': content.role,
+                'parts': [
+                    {'text': mask_tool_outputs(part['text'].strip())} if 'text' in part else part
+                    for part in get_parts(content)
+                ],
+            }
+            for content in contents
+        ]
+        text = json.dumps(turns, sort_keys=True, ensure_ascii=False, default=str) + self.config
+
+        for volatile_text in self.volatile:
+            text = text.replace(volatile_text, '<volatile>')
+
+        return hash_text(text)
+
+    def make_response(self, data: Dict[str, Any]) -> Response:
+        content = self.backend.content_from_dict({'role': 'model', 'parts': data['parts']})
+        return Response([Candidate(content, data.get('finish_reason', 'STOP'))])
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        with trace('lookup', 'cache') as span:
+            data = self.cache.get(key)
+            span.set(hit=data is not None)
+
+        return data
+
+    def store(self, key: str, chunks: List[Any], variants: Sequence[Any] = ()):
+        # Only the successful responses get here; the blocked ones raise an error
+        parts, finish_reason = join_chunks(chunks)
+        data = {'parts': parts, 'finish_reason': finish_reason}
+
+        if variants:
+            data['variants'] = []
+            for variant in variants:
+                parts, finish_reason = join_chunks([variant])
+                data['variants'].append({'parts': parts, 'finish_reason': finish_reason})
+
+        self.cache.put(key, data)
+
+    def generate(self, contents: List[Any]) -> Any:
+        key = self.get_key(contents)
+        data = self.lookup(key)
+
+        if data is not None:
+            return self.make_response(data)
+
+        response = self.backend.generate(contents)
+        self.store(key, [response])
+        return response
+
+    def generate_variants(self, contents: List[Any], num_variants: int) -> List[Any]:
+        # The same key as `generate`, since the first response is the same; the variants are
+        # kept with it, so that rerunning the session makes the same choice among them
+        key = self.get_key(contents)
+        data = self.lookup(key)
+
+        if data is not None:
+            return [self.make_response(data)] + [
+                self.make_response(variant) for variant in data.get('variants', [])[:num_variants - 1]
+            ]
+
+        responses = self.backend.generate_variants(contents, num_variants)
+        self.store(key, responses[:1], responses[1:])
+        return responses
+
+    def generate_stream(self, contents: List[Any]) -> Iterator[Any]:
+        key = self.get_key(contents)
+        data = self.lookup(key)
+
+        if data is not None:
+            yield self.make_response(data)
+            return
+
+        chunks = []
+
+        for chunk in self.backend.generate_stream(contents):
+            chunks.append(chunk)
+            yield chunk
+
+        self.store(key, chunks)
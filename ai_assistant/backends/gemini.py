@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List
+
+from vertexai.generative_models._generative_models import (
+    HarmBlockThreshold,
+    HarmCategory,
+    Content,
+    Part
+)
+from vertexai.preview.generative_models import (
+    FunctionDeclaration,
+    GenerativeModel,
+    Tool,
+)
+
+from ai_assistant.backends.base import ModelBackend, ResponseBlockedError, get_finish_reason
+
+
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_LOW_AND_ABOVE,
+}
+SUCCESSFUL_FINISH_REASONS = ('STOP', 'FINISH_REASON_UNSPECIFIED')
+
+
+class GeminiBackend(ModelBackend):
+    """
+    The Gemini Pro model served by Vertex AI.
+    """
+    name: str = 'gemini'
+
+    def __init__(
+            self,
+            tools: List[Any],
+            generation_config: Dict[str, Any],
+            model_name: str = 'gemini-pro',
+            system_instruction: str = None,
+            variant_temperature: float = 1.0
+    ):
+        """
+        :param tools: The declarations of the functions the model can call, either dictionaries
+         or `FunctionDeclaration`s.
+        :param generation_config: The generation parameters, such as the temperature.
+        :param model_name: The name of the Gemini model.
+        :param system_instruction: The system prompt. Only set this for the models that
+         support system instructions; `gemini-pro` does not.
+        :param variant_temperature: The temperature of the most varied of the alternative responses.
+        """
+
+        self.tools = Tool(
+            function_declarations=[
+                FunctionDeclaration(**tool) if isinstance(tool, dict) else tool for tool in tools
+            ]
+        )
+        self.generation_config = generation_config
+        self.model_name = model_name
+        self.variant_temperature = variant_temperature
+        self.has_system_instruction = bool(system_instruction)
+
+        # The older versions of Vertex AI do not accept a system instruction at all
+        kwargs = {'system_instruction': system_instruction} if system_instruction else {}
+        self.model = GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=SAFETY_SETTINGS,
+            tools=[self.tools],
+            **kwargs
+        )
+
+    def make_content(self, role: str, text: str) -> Content:
+        return Content(role=role, parts=[Part.from_text(text)])
+
+    def content_from_dict(self, data: Dict[str, Any]) -> Content:
+        return Content.from_dict(data)
+
+    @staticmethod
+    def check_response(response: Any):
+        """
+        Check that a response, or a chunk of a streamed one, was not blocked. Mirrors the validation
+        done by Vertex AI's own chat session.
+
+        :param response: The response.
+        """
+
+        if not response.candidates:
+            raise ResponseBlockedError(
+                f'The model response was blocked: {response.prompt_feedback}',
+                response
+            )
+
+        finish_reason = get_finish_reason(response)
+        if finish_reason not in SUCCESSFUL_FINISH_REASONS:
+            raise ResponseBlockedError(
+                f'The model response did not complete successfully. Finish reason: {finish_reason}',
+                response
+            )
+
+    def generate(self, contents: List[Content]) -> Any:
+        response = self.model.generate_content(contents)
+        GeminiBackend.check_response(response)
+        return response
+
+    def generate_variants(self, contents: List[Content], num_variants: int) -> List[Any]:
+        # Gemini Pro generates a single candidate per request, so the variants are requested at once,
+        # at temperatures spread from the configured one up to `variant_temperature`
+        temperature = self.generation_config.get('temperature', 0)
+        temperatures = [
+            temperature + (max(self.variant_temperature, temperature) - temperature) * num / max(num_variants - 1, 1)
+            for num in range(num_variants)
+        ]
+
+        def generate(variant_temperature: float) -> Any:
+            response = self.model.generate_content(
+                contents, generation_config={**self.generation_config, 'temperature': variant_temperature}
+            )
+            GeminiBackend.check_response(response)
+            return response
+
+        with ThreadPoolExecutor(max_workers=num_variants) as executor:
+            futures = [executor.submit(generate, variant_temperature) for variant_temperature in temperatures]
+
+        # The first response is needed; any other that failed, e.g., because it was blocked, is left out
+        responses = [futures[0].result()]
+        responses.extend(future.result() for future in futures[1:] if future.exception() is None)
+
+        return responses
+
+    def generate_stream(self, contents: List[Content]) -> Iterator[Any]:
+        chunks = []
+
+        for chunk in self.model.generate_content(contents, stream=True):
+            # A chunk may have no candidates, e.g., the last one, with only the usage of the response
+            if chunk.candidates:
+                GeminiBackend.check_response(chunk)
+            chunks.append(chunk)
+            yield chunk
+
+        # The whole response, once joined, must have some candidate
+        if not any(chunk.candidates for chunk in chunks):
+            raise ResponseBlockedError(
+                f'The model response was blocked: {chunks[-1].prompt_feedback if chunks else None}',
+                chunks[-1] if chunks else None
+            )
@@ -0,0 +1,271 @@
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from ai_assistant.backends.base import ModelBackend, join_chunks
+
+
+class ReplayExhaustedError(Exception):
+    """
+    Raised when a replay backend is asked for more responses than it has recorded.
+    """
+
+
+class ReplayError(Exception):
+    """
+    A failed model call scripted in a recording, e.g., a quota error, to exercise the handling of errors.
+    """
+
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+class ReplayFunctionCall(object):
+    def __init__(self, name: str = '', args: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.args = args if args is not None else {}
+
+
+class ReplayPart(object):
+    def __init__(self, text: str = '', function_call: Optional[ReplayFunctionCall] = None):
+        self.text = text
+        self.function_call = function_call if function_call is not None else ReplayFunctionCall()
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.function_call.name:
+            return {'function_call': {'name': self.function_call.name, 'args': dict(self.function_call.args)}}
+
+        return {'text': self.text}
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'ReplayPart':
+        if 'function_call' in data:
+            func_call = data['function_call']
+            return ReplayPart(function_call=ReplayFunctionCall(func_call['name'], func_call.get('args', {})))
+
+        return ReplayPart(text=data.get('text', ''))
+
+
+class ReplayContent(object):
+    def __init__(self, role: str, parts: List[ReplayPart]):
+        self.role = role
+        self.parts = parts
+
+    @property
+    def text(self) -> str:
+        return ''.join(part.text for part in self.parts)
+
+    def __repr__(self) -> str:
+        return f'ReplayContent(role={self.role!r}, parts={[part.to_dict() for part in self.parts]})'
+
+
+class ReplayCandidate(object):
+    def __init__(self, content: ReplayContent, finish_reason: str = 'STOP'):
+        self.content = content
+        self.finish_reason = finish_reason
+
+
+class ReplayResponse(object):
+    def __init__(self, candidates: List[ReplayCandidate]):
+        self.candidates = candidates
+
+    @property
+    def text(self) -> str:
+        return self.candidates[0].content.text if self.candidates else ''
+
+
+class ReplayBackend(ModelBackend):
+    """
+    A local, deterministic stand-in for a real model. It returns previously recorded
+    (or hand-written) responses in order, optionally after an artificial delay, so that
+    the agent loop and the tools can be run and measured without any model endpoint.
+
+    A recording is a JSON file of the form:
+    `{"responses": [{"parts": [{"function_call": {"name": ..., "args": {...}}}], "latency": 0.5}, ...]}`
+    A response may instead be a failed call, e.g., `{"error": {"code": 429, "message": "Quota exceeded"}}`.
+    """
+    name: str = 'replay'
+    # The recorded responses do not depend on the prompts, so no system turns are needed
+    has_system_instruction: bool = True
+    # Every call takes the next response
+    stateless: bool = False
+
+    def __init__(self, responses: List[Dict[str, Any]], latency: float = 0.0):
+        """
+        :param responses: The scripted responses, in the order they are to be returned.
+        :param latency: The default delay in seconds before every response. A response may
+         override it with its own `latency` key.
+        """
+
+        self.responses = responses
+        self.latency = latency
+        self.position = 0
+
+    @staticmethod
+    def from_file(file_name: str, latency: float = 0.0) -> 'ReplayBackend':
+        """
+        Create a replay backend from a recording file.
+
+        :param file_name: The recording file.
+        :param latency: The default delay in seconds before every response.
+        :return: The backend.
+        """
+
+        with open(file_name, 'r', encoding='utf-8') as in_file:
+            data = json.load(in_file)
+
+        return ReplayBackend(data['responses'], latency)
+
+    def make_content(self, role: str, text: str) -> ReplayContent:
+        return ReplayContent(role=role, parts=[ReplayPart(text=text)])
+
+    def content_from_dict(self, data: Dict[str, Any]) -> ReplayContent:
+        return ReplayContent(role=data['role'], parts=[ReplayPart.from_dict(part) for part in data['parts']])
+
+    def resume(self, num_responses: int):
+        self.position = num_responses
+
+    def next_response(self) -> Dict[str, Any]:
+        """
+        Get the next recorded response, raising the error recorded instead, if any.
+
+        :return: The response, as recorded.
+        """
+
+        if self.position >= len(self.responses):
+            raise ReplayExhaustedError(
+                f'The replay recording has only {len(self.responses)} responses'
+            )
+
+        data = self.responses[self.position]
+        self.position += 1
+
+        if 'error' in data:
+            latency = data.get('latency', self.latency)
+            if latency:
+                time.sleep(latency)
+            raise ReplayError(data['error'].get('message', 'The model call failed'), data['error'].get('code'))
+
+        return data
+
+    def generate(self, contents: List[Any]) -> ReplayResponse:
+        data = self.next_response()
+
+        latency = data.get('latency', self.latency)
+        if latency:
+            time.sleep(latency)
+
+        content = ReplayContent(role='model', parts=[ReplayPart.from_dict(part) for part in data['parts']])
+        return ReplayResponse([ReplayCandidate(content, data.get('finish_reason', 'STOP'))])
+
+    def generate_variants(self, contents: List[Any], num_variants: int) -> List[ReplayResponse]:
+        # The alternative responses, if any, are recorded as `variants` of the response
+        data = self.next_response()
+
+        latency = data.get('latency', self.latency)
+        if latency:
+            time.sleep(latency)
+
+        return [
+            ReplayResponse([ReplayCandidate(
+                ReplayContent(role='model', parts=[ReplayPart.from_dict(part) for part in variant['parts']]),
+                variant.get('finish_reason', 'STOP')
+            )])
+            for variant in ([data] + data.get('variants', []))[:num_variants]
+        ]
+
+    def generate_stream(self, contents: List[Any]) -> Iterator[ReplayResponse]:
+        # Every part is a chunk, and the latency is spread over the parts, like a model generating them
+        data = self.next_response()
+        parts = data['parts'] or [{'text': ''}]
+        latency = data.get('latency', self.latency)
+
+        for part in parts:
+            if latency:
+                time.sleep(latency / len(parts))
+
+            content = ReplayContent(role='model', parts=[ReplayPart.from_dict(part)])
+            yield ReplayResponse([ReplayCandidate(content, data.get('finish_reason', 'STOP'))])
+
+
+class RecordingBackend(ModelBackend):
+    """
+    Wrap another backend and save every response it generates in the replay format,
+    so that a live session can later be run again with `ReplayBackend`.
+    """
+    name: str = 'recording'
+
+    # Every response is recorded
+    stateless: bool = False
+
+    def __init__(self, backend: ModelBackend, file_name: str):
+        self.backend = backend
+        self.has_system_instruction = backend.has_system_instruction
+        self.file_name = file_name
+        self.responses: List[Dict[str, Any]] = []
+
+    def make_content(self, role: str, text: str) -> Any:
+        return self.backend.make_content(role, text)
+
+    def content_from_dict(self, data: Dict[str, Any]) -> Any:
+        return self.backend.content_from_dict(data)
+
+    def resume(self, num_responses: int):
+        # Keep recording after the responses of the earlier session
+        try:
+            with open(self.file_name, 'r', encoding='utf-8') as in_file:
+                self.responses = json.load(in_file)['responses'][:num_responses]
+        except (OSError, ValueError, KeyError):
+            self.responses = []
+
+        self.backend.resume(num_responses)
+
+    def record(
+            self,
+            parts: List[Dict[str, Any]],
+            finish_reason: str,
+            latency: float,
+            variants: Optional[List[Dict[str, Any]]] = None
+    ):
+        self.responses.append({
+            'parts': parts,
+            'finish_reason': finish_reason,
+            'latency': round(latency, 3),
+        })
+        if variants:
+            self.responses[-1]['variants'] = variants
+
+        with open(self.file_name, 'w', encoding='utf-8') as out_file:
+            json.dump({'responses': self.responses}, out_file, indent=2)
+
+    def generate(self, contents: List[Any]) -> Any:
+        start_time = time.perf_counter()
+        response = self.backend.generate(contents)
+        self.record(*join_chunks([response]), time.perf_counter() - start_time)
+
+        return response
+
+    def generate_variants(self, contents: List[Any], num_variants: int) -> List[Any]:
+        start_time = time.perf_counter()
+        responses = self.backend.generate_variants(contents, num_variants)
+        variants = []
+
+        for response in responses[1:]:
+            parts, finish_reason = join_chunks([response])
+            variants.append({'parts': parts, 'finish_reason': finish_reason})
+
+        self.record(*join_chunks(responses[:1]), time.perf_counter() - start_time, variants)
+
+        return responses
+
+    def generate_stream(self, contents: List[Any]) -> Iterator[Any]:
+        start_time = time.perf_counter()
+        chunks = []
+
+        for chunk in self.backend.generate_stream(contents):
+            chunks.append(chunk)
+            yield chunk
+
+        # A streamed response is recorded whole
+        self.record(*join_chunks(chunks), time.perf_counter() - start_time)
@@ -0,0 +1,336 @@
+import collections
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Set
+
+from ai_assistant.backends.base import ModelBackend, ResponseBlockedError
+from ai_assistant.tracing import trace
+
+
+# The errors worth retrying, by the names of their classes, e.g., those of `google.api_core.exceptions`
+RETRYABLE_ERRORS = (
+    'TimeoutError', 'ConnectionError', 'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable',
+    'InternalServerError', 'BadGateway', 'GatewayTimeout', 'DeadlineExceeded', 'Aborted',
+)
+# The HTTP status codes worth retrying
+RETRYABLE_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class ModelCallError(Exception):
+    """
+    Raised when a model call failed even after all retries.
+    """
+
+
+class RateLimiter(object):
+    """
+    A token bucket limiting the rate of the model calls. The limiters are shared by name, so that
+    all sessions running in a process, e.g., concurrently, stay within a single quota together.
+    """
+
+    _limiters: Dict[str, 'RateLimiter'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        """
+        :param requests_per_minute: The sustained rate of the calls.
+        :param burst: The number of calls that may be made at once after a quiet period.
+        """
+
+        self.rate = requests_per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get(name: str, requests_per_minute: float) -> 'RateLimiter':
+        """
+        Get the limiter shared by that name, creating it or updating its rate.
+        """
+
+        with RateLimiter._registry_lock:
+            limiter = RateLimiter._limiters.get(name)
+
+            if limiter is None:
+                limiter = RateLimiter._limiters[name] = RateLimiter(requests_per_minute)
+            else:
+                limiter.rate = requests_per_minute / 60.0
+
+            return limiter
+
+    def acquire(self) -> float:
+        """
+        Wait until a call may be made. Every caller reserves its turn right away, so that the
+        waiting callers are served in order.
+
+        :return: The time waited, in seconds.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if delay > 0:
+            with trace('rate_limit', 'retry'):
+                time.sleep(delay)
+
+        return delay
+
+
+class ResilientBackend(ModelBackend):
+    """
+    Wrap another backend to make its calls resilient: every call has a timeout; the calls failed
+    with a transient error, e.g., a quota error, are retried after an exponential backoff with
+    full jitter; the calls are rate limited; and, optionally, a second, hedged request is sent
+    when a call takes longer than most earlier ones did, and the first response is used.
+
+    The calls run in daemon threads, so that a call abandoned after its timeout does not block
+    the process from exiting. Timeouts and hedging are only applied to stateless backends: a call
+    abandoned, or hedged, would otherwise go on to use up a response of a stateful one, e.g., the
+    next recorded response of a replay. A streamed call is
+    retried, and timed out, only until its first chunk arrives, since the later chunks may
+    already have been used; it is never hedged.
+    """
+    name: str = 'resilient'
+
+    def __init__(
+            self,
+            backend: ModelBackend,
+            timeout: float = 120.0,
+            max_retries: int = 4,
+            backoff_base: float = 1.0,
+            backoff_max: float = 30.0,
+            retry_blocked: bool = False,
+            requests_per_minute: float = 0,
+            hedge_percentile: float = 0,
+            hedge_min_samples: int = 5,
+            verbose: bool = True
+    ):
+        """
+        :param backend: The backend to wrap.
+        :param timeout: The maximum time of every attempt, in seconds; zero for none. Ignored for
+         the backends that are not stateless.
+        :param max_retries: The maximum number of retries of a call.
+        :param backoff_base: The maximum delay before the first retry, in seconds; doubled for every later one.
+        :param backoff_max: The maximum delay before any retry, in seconds.
+        :param retry_blocked: Whether to also retry the responses blocked by the model.
+        :param requests_per_minute: The maximum rate of the calls, shared by the process; zero for no limit.
+        :param hedge_percentile: The percentile of the earlier latencies after which a hedged request
+         is sent, e.g., 95; zero to never hedge.
+        :param hedge_min_samples: The number of calls to observe before hedging.
+        :param verbose: Whether to print every retry; either way, it is traced and counted.
+        """
+
+        self.backend = backend
+        self.has_system_instruction = backend.has_system_instruction
+        self.stateless = backend.stateless
+        self.timeout = timeout if backend.stateless else 0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_blocked = retry_blocked
+        self.rate_limiter = RateLimiter.get('model', requests_per_minute) if requests_per_minute > 0 else None
+        self.hedge_percentile = hedge_percentile if backend.stateless else 0
+        self.hedge_min_samples = hedge_min_samples
+        self.verbose = verbose
+        self.latencies: Deque[float] = collections.deque(maxlen=100)
+        self.stats = {'calls': 0, 'attempts': 0, 'retries': 0, 'timeouts': 0, 'hedged': 0, 'hedges_won': 0}
+        # The calls may be made from several threads, e.g., by concurrent sessions
+        self._lock = threading.Lock()
+
+    def make_content(self, role: str, text: str) -> Any:
+        return self.backend.make_content(role, text)
+
+    def content_from_dict(self, data: Dict[str, Any]) -> Any:
+        return self.backend.content_from_dict(data)
+
+    def resume(self, num_responses: int):
+        self.backend.resume(num_responses)
+
+    def count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, ResponseBlockedError):
+            return self.retry_blocked
+
+        return (
+            any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+            or getattr(error, 'code', None) in RETRYABLE_CODES
+        )
+
+    def get_hedge_delay(self) -> Optional[float]:
+        """
+        :return: The time after which to send a hedged request, if any.
+        """
+
+        if not self.hedge_percentile or len(self.latencies) < self.hedge_min_samples:
+            return None
+
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    def submit(self, function: Callable[[], Any]) -> Future:
+        future = Future()
+
+        def call():
+            try:
+                future.set_result(function())
+            except BaseException as ex:
+                future.set_exception(ex)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        self.count('attempts')
+        threading.Thread(target=call, daemon=True).start()
+        return future
+
+    def call_once(self, contents: List[Any]) -> Any:
+        """
+        Make a single attempt of a call, with its timeout and, if due, a hedged request.
+
+        :param contents: The chat history followed by the latest user turn.
+        :return: The response.
+        """
+
+        start_time = time.perf_counter()
+        hedge_delay = self.get_hedge_delay()
+        hedge_at = start_time + hedge_delay if hedge_delay is not None else None
+        deadline = start_time + self.timeout if self.timeout > 0 else None
+
+        first = self.submit(lambda: self.backend.generate(contents))
+        pending: Set[Future] = {first}
+        error = None
+
+        while pending:
+            wake_times = [moment for moment in (hedge_at, deadline) if moment is not None]
+            wait_time = max(0.0, min(wake_times) - time.perf_counter()) if wake_times else None
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    self.latencies.append(time.perf_counter() - start_time)
+                    if future is not first:
+                        self.count('hedges_won')
+                    return future.result()
+
+                error = future.exception()
+
+            now = time.perf_counter()
+
+            if pending and deadline is not None and now >= deadline:
+                self.count('timeouts')
+                raise TimeoutError(f'The model did not respond within {self.timeout} s')
+
+            if pending and hedge_at is not None and now >= hedge_at:
+                # The call is slower than most; whichever of the two responds first is used
+                hedge_at = None
+                self.count('hedged')
+                pending.add(self.submit(lambda: self.backend.generate(contents)))
+
+        raise error
+
+    def back_off(self, error: Exception, attempt: int):
+        """
+        Wait before retrying a failed call, or give up.
+
+        :param error: The error of the failed attempt.
+        :param attempt: The number of the attempt, starting from 0.
+        """
+
+        if not self.is_retryable(error):
+            raise error
+        if attempt == self.max_retries:
+            raise ModelCallError(
+                f'The model call failed after {attempt + 1} attempts: {type(error).__name__}: {error}'
+            ) from error
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if self.verbose:
+            print(f'* The model call failed ({type(error).__name__}: {error}); retrying in {delay:.1f} s')
+        self.count('retries')
+
+        with trace('backoff', 'retry', attempt=attempt + 1):
+            time.sleep(delay)
+
+    def generate(self, contents: List[Any]) -> Any:
+        self.count('calls')
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.call_once(contents)
+            except Exception as ex:
+                self.back_off(ex, attempt)
+
+    def generate_variants(self, contents: List[Any], num_variants: int) -> List[Any]:
+        self.count('calls')
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                future = self.submit(lambda: self.backend.generate_variants(contents, num_variants))
+                done, _ = wait([future], timeout=self.timeout if self.timeout > 0 else None)
+
+                if not done:
+                    self.count('timeouts')
+                    raise TimeoutError(f'The model did not respond within {self.timeout} s')
+
+                return future.result()
+            except Exception as ex:
+                self.back_off(ex, attempt)
+
+    def start_stream(self, contents: List[Any]) -> Iterator[Any]:
+        """
+        Start a streamed call, waiting for its first chunk no longer than the timeout.
+
+        :param contents: The chat history followed by the latest user turn.
+        :return: The chunks, starting with the first one.
+        """
+
+        def first_chunk():
+            chunks = iter(self.backend.generate_stream(contents))
+            return chunks, next(chunks, None)
+
+        future = self.submit(first_chunk)
+        done, _ = wait([future], timeout=self.timeout if self.timeout > 0 else None)
+
+        if not done:
+            self.count('timeouts')
+            raise TimeoutError(f'The model did not start responding within {self.timeout} s')
+
+        chunks, first = future.result()
+        return itertools.chain([first] if first is not None else [], chunks)
+
+    def generate_stream(self, contents: List[Any]) -> Iterator[Any]:
+        self.count('calls')
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                chunks = self.start_stream(contents)
+            except Exception as ex:
+                self.back_off(ex, attempt)
+                continue
+
+            yield from chunks
+            return
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the calls.
+
+        :return: The report.
+        """
+
+        return (
+            f'Model calls: {self.stats["calls"]}, attempts: {self.stats["attempts"]},'
+            f' retries: {self.stats["retries"]}, timeouts: {self.stats["timeouts"]},'
+            f' hedged: {self.stats["hedged"]} ({self.stats["hedges_won"]} won)'
+        )
@@ -0,0 +1,199 @@
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Type, Union
+
+import termcolor as tc
+
+from ai_assistant.assistant import Assistant
+from ai_assistant.tools.base import ToolInterface
+
+
+class BatchJob(object):
+    """
+    A single, independent assistant session to be run as part of a batch.
+    """
+
+    def __init__(self, name: str, prompt_file: str, settings: Dict[str, Dict[str, Any]] = None):
+        """
+        :param name: The unique name of the job. Also used as the name of its working directory.
+        :param prompt_file: The prompt file to solve.
+        :param settings: Any settings overriding those in the settings file, grouped by section.
+        """
+
+        self.name = name
+        self.prompt_file = prompt_file
+        self.settings = settings or {}
+
+
+def load_jobs(path: str) -> List[BatchJob]:
+    """
+    Get the jobs to run from either a directory of prompt files or a manifest.
+    A manifest is a JSON file containing a list of objects with the `prompt_file` key and,
+    optionally, the `name` and `settings` keys. A name already used by an earlier job gets a
+    numbered suffix, e.g., `name_2`, so that every job has its own working directory.
+
+    :param path: The directory or the manifest file.
+    :return: The jobs.
+    """
+
+    if os.path.isdir(path):
+        return [
+            BatchJob(os.path.splitext(file_name)[0], os.path.join(path, file_name))
+            for file_name in sorted(os.listdir(path)) if file_name.endswith('.txt')
+        ]
+
+    with open(path, 'r', encoding='utf-8') as in_file:
+        entries = json.load(in_file)
+
+    jobs = []
+    names = set()
+
+    for idx, entry in enumerate(entries):
+        name = entry.get('name', f'{idx:04d}_{os.path.splitext(os.path.basename(entry["prompt_file"]))[0]}')
+        unique_name, num = name, 1
+
+        while unique_name in names:
+            num += 1
+            unique_name = f'{name}_{num}'
+
+        names.add(unique_name)
+        jobs.append(BatchJob(unique_name, entry['prompt_file'], entry.get('settings')))
+
+    return jobs
+
+
+def run_job(
+        job: BatchJob,
+        tools: List[Union[str, Type[ToolInterface]]],
+        settings_file: str,
+        work_root: str,
+        num_processes: int = 1,
+        on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """
+    Run a single job in its own working directory. All output of the session goes to the
+    `session.log` file inside that directory. This is executed in a worker process because
+    the tools resolve file names relative to the process-wide current directory.
+
+    :param job: The job to run.
+    :param tools: The tools available to the assistant.
+    :param settings_file: The settings file shared by all jobs.
+    :param work_root: The directory under which the job's working directory is created.
+    :param num_processes: The number of worker processes, which share the rate limit of the model calls.
+    :param on_event: Called with the name and the details of every event of the session, e.g., after every step.
+    :return: The outcome of the session together with its timing.
+    """
+
+    work_dir = os.path.abspath(os.path.join(work_root, job.name))
+    os.makedirs(work_dir, exist_ok=True)
+    settings = {section: dict(params) for section, params in job.settings.items()}
+    settings.setdefault('Assistant', {})['prompt_file'] = job.prompt_file
+    settings.setdefault('Resilience', {})['num_processes'] = num_processes
+    settings.setdefault('Workspace', {}).setdefault('exclude', ['session.log'])
+    result = {'name': job.name, 'work_dir': work_dir, 'status': 'error', 'steps': 0, 'error': None}
+    start_time = time.perf_counter()
+    cwd = os.getcwd()
+
+    with open(os.path.join(work_dir, 'session.log'), 'w', encoding='utf-8') as log_file:
+        with contextlib.redirect_stdout(log_file):
+            try:
+                # Settings and prompt paths are relative to where the batch was launched from
+                assistant = Assistant(
+                    tools=tools, verbose=False, settings_file=settings_file, settings_overrides=settings
+                )
+                assistant.on_event = on_event
+                os.chdir(work_dir)
+                result.update(assistant.run())
+            except SystemExit as se:
+                result['error'] = f'The session exited with code {se.code}'
+            except Exception as ex:
+                result['error'] = f'{type(ex).__name__}: {ex}'
+            finally:
+                os.chdir(cwd)
+
+    result['duration'] = time.perf_counter() - start_time
+    return result
+
+
+async def run_batch(
+        jobs: List[BatchJob],
+        tools: List[Union[str, Type[ToolInterface]]],
+        settings_file: str,
+        work_root: str,
+        max_workers: int
+) -> List[Dict[str, Any]]:
+    """
+    Run the jobs concurrently using a pool of worker processes.
+
+    :param jobs: The jobs to run.
+    :param tools: The tools available to the assistant, preferably by name, so that every worker
+     imports only the modules of those tools.
+    :param settings_file: The settings file shared by all jobs.
+    :param work_root: The directory under which each job gets its own working directory.
+    :param max_workers: The maximum number of sessions to run at the same time.
+    :return: The outcome of every job, in the order of completion.
+    """
+
+    loop = asyncio.get_running_loop()
+    settings_file = os.path.abspath(settings_file)
+    results = []
+
+    # Spawn rather than fork the workers since the gRPC client used by Vertex AI is not fork-safe
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [
+            loop.run_in_executor(pool, run_job, job, tools, settings_file, work_root, max_workers) for job in jobs
+        ]
+
+        for future in asyncio.as_completed(futures):
+            result = await future
+            color = Assistant.COLOR_TEXT if result['status'] == 'completed' else Assistant.COLOR_ERROR
+            tc.cprint(
+                f'[{len(results) + 1}/{len(jobs)}] {result["name"]}: {result["status"]}'
+                f' in {result["steps"]} steps, {result["duration"]:.2f} s'
+                + (f' ({result["error"]})' if result['error'] else ''),
+                color
+            )
+            results.append(result)
+
+    return results
+
+
+def summarize(results: List[Dict[str, Any]], wall_time: float) -> str:
+    """
+    Summarize the throughput and the latency of a batch run.
+
+    :param results: The outcome of every job.
+    :param wall_time: The total time taken by the batch, in seconds.
+    :return: The summary.
+    """
+
+    if not results:
+        return 'No jobs were run'
+
+    durations = sorted(result['duration'] for result in results)
+    completed = sum(1 for result in results if result['status'] == 'completed')
+    total_steps = sum(result['steps'] for result in results)
+    usages = [result['usage'] for result in results if result.get('usage')]
+    serial_time = sum(durations)
+
+    def percentile(fraction: float) -> float:
+        return durations[min(len(durations) - 1, int(round(fraction * (len(durations) - 1))))]
+
+    return '\n'.join([
+        f'Jobs: {len(results)} ({completed} completed, {len(results) - completed} not completed)',
+        f'Steps: {total_steps} in total, {total_steps / len(results):.1f} per job',
+        f'Model round-trips: {sum(usage["round_trips"] for usage in usages)},'
+        f' input tokens: {sum(usage["prompt_tokens"] for usage in usages)},'
+        f' output tokens: {sum(usage["response_tokens"] for usage in usages)}',
+        f'Wall time: {wall_time:.2f} s (sum of session times: {serial_time:.2f} s,'
+        f' speedup: {serial_time / wall_time if wall_time else 0:.2f}x)',
+        f'Throughput: {len(results) / wall_time * 60 if wall_time else 0:.2f} jobs/min',
+        f'Session latency: mean {statistics.mean(durations):.2f} s, p50 {percentile(0.5):.2f} s,'
+        f' p95 {percentile(0.95):.2f} s, max {durations[-1]:.2f} s',
+    ])
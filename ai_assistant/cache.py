@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple, Union
+
+
+# All caches created so far, by their names
+CACHES: Dict[str, Union['LRUCache', 'DiskCache']] = {}
+
+
+class LRUCache(object):
+    """
+    A thread-safe, bounded cache that evicts the least recently used entry when full.
+    """
+
+    def __init__(self, name: str, max_size: int = 128):
+        """
+        :param name: The name of the cache, used in reports.
+        :param max_size: The maximum number of entries. Zero disables the cache.
+        """
+
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get a cached value.
+
+        :param key: The key.
+        :return: The value, or `None` if the key is not cached.
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Cache a value.
+
+        :param key: The key.
+        :param value: The value.
+        """
+
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def resize(self, max_size: int):
+        """
+        Change the maximum number of entries, evicting entries if necessary.
+
+        :param max_size: The maximum number of entries. Zero disables the cache.
+        """
+
+        with self._lock:
+            self.max_size = max_size
+
+            while len(self._entries) > max(max_size, 0):
+                self._entries.popitem(last=False)
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the cache usage.
+
+        :return: The report.
+        """
+
+        return f'{self.name} cache: {self.hits} hits, {self.misses} misses, {len(self._entries)} entries'
+
+
+def hash_text(text: str) -> str:
+    """
+    Get the SHA-256 hash of a text.
+
+    :param text: The text.
+    :return: The hash, as a hex string.
+    """
+
+    return hashlib.sha256(text.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+
+def hash_file(file_name: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Get the SHA-256 hash of the content of a file, read in chunks.
+
+    :param file_name: The file.
+    :param chunk_size: The number of bytes read at once.
+    :return: The hash, as a hex string.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(file_name, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def iter_dir_files(dir_name: str, extension: str = None) -> Iterator[os.DirEntry]:
+    """
+    Iterate over the files inside a directory and its subdirectories.
+    Hidden directories and `__pycache__` are skipped.
+
+    :param dir_name: The directory.
+    :param extension: If specified, only the files with this extension, e.g., `.py`, are yielded,
+     and the subdirectories are not descended into, except for the packages.
+    :return: The directory entries of the files.
+    """
+
+    pending = [dir_name or '.']
+
+    while pending:
+        current = pending.pop()
+
+        try:
+            with os.scandir(current) as items:
+                for item in items:
+                    if item.is_dir(follow_symlinks=False):
+                        if item.name.startswith('.') or item.name == '__pycache__':
+                            continue
+                        if extension is None or os.path.exists(os.path.join(item.path, '__init__.py')):
+                            pending.append(item.path)
+                    elif extension is None or item.name.endswith(extension):
+                        yield item
+        except OSError:
+            continue
+
+
+def fingerprint_dir(dir_name: str, max_files: int = 1000, extension: str = None) -> Optional[Tuple]:
+    """
+    Get a cheap fingerprint of the files inside a directory, based on their names, sizes, and
+    modification times.
+
+    :param dir_name: The directory.
+    :param max_files: The maximum number of files to consider.
+    :param extension: If specified, only the files with this extension are considered (see `iter_dir_files`).
+    :return: The fingerprint, or `None` if there are too many files.
+    """
+
+    entries = []
+
+    for item in iter_dir_files(dir_name, extension):
+        stat = item.stat()
+        entries.append((item.path, stat.st_size, stat.st_mtime_ns))
+
+        if len(entries) > max_files:
+            return None
+
+    return tuple(sorted(entries))
+
+
+def hash_dir(dir_name: str, max_files: int = 1000, max_bytes: int = 16 * 1024 * 1024) -> Optional[Tuple]:
+    """
+    Get a fingerprint of the files inside a directory based on their names and contents.
+    Unlike `fingerprint_dir`, this is not affected by rewriting a file with the same content.
+    Hidden files are skipped too, e.g., the checkpoint of the session, which changes every step.
+
+    :param dir_name: The directory.
+    :param max_files: The maximum number of files to consider.
+    :param max_bytes: The maximum total size of the files to hash.
+    :return: The fingerprint, or `None` if there are too many or too large files.
+    """
+
+    entries = []
+    total_bytes = 0
+
+    for item in iter_dir_files(dir_name):
+        if item.name.startswith('.'):
+            continue
+
+        total_bytes += item.stat().st_size
+
+        if len(entries) >= max_files or total_bytes > max_bytes:
+            return None
+
+        try:
+            with open(item.path, 'rb') as in_file:
+                entries.append((item.path, hashlib.sha256(in_file.read()).hexdigest()))
+        except OSError:
+            return None
+
+    return tuple(sorted(entries))
+
+
+class DiskCache(object):
+    """
+    A persistent cache of JSON values, one file per key, which can be shared by processes.
+    When the files exceed the maximum size, the least recently used ones are evicted.
+    """
+
+    def __init__(self, name: str, dir_name: str, max_bytes: int = 256 * 1024 * 1024):
+        """
+        :param name: The name of the cache, used in reports.
+        :param dir_name: The directory of the cache, created if necessary.
+        :param max_bytes: The maximum total size of the files.
+        """
+
+        self.name = name
+        self.dir_name = os.path.abspath(os.path.expanduser(dir_name))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # The total size of the files, found only once something is written
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        CACHES[name] = self
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.dir_name, key[:2], f'{key}.json')
+
+    def _iter_entries(self) -> Iterator[os.DirEntry]:
+        return (item for item in iter_dir_files(self.dir_name) if item.name.endswith('.json'))
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Get a cached value.
+
+        :param key: The key, a hex string, e.g., as given by `hash_text`.
+        :return: The value, or `None` if the key is not cached or its file is unreadable.
+        """
+
+        path = self.get_path(key)
+
+        try:
+            with open(path, 'r', encoding='utf-8') as in_file:
+                value = json.load(in_file)
+            # Mark the entry as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        """
+        Cache a value. The file is replaced only once fully written, so that concurrent readers
+        never see a partial entry.
+
+        :param key: The key.
+        :param value: The value, which must be serializable to JSON.
+        """
+
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        try:
+            # The size of the entry replaced, if any
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as out_file:
+                json.dump(value, out_file, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_file, path)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(item.stat().st_size for item in self._iter_entries())
+            else:
+                self._size += os.path.getsize(path) - old_size
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the cache is within 90% of its maximum size.
+        """
+
+        entries = []
+        for item in self._iter_entries():
+            stat = item.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+
+        for _, size, path in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the cache usage.
+
+        :return: The report.
+        """
+
+        return f'{self.name} cache: {self.hits} hits, {self.misses} misses, in {self.dir_name}'
@@ -0,0 +1,162 @@
+import gzip
+import json
+import os
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from ai_assistant.backends.base import ModelBackend
+from ai_assistant.cache import hash_dir
+from ai_assistant.history import get_parts
+
+
+# Incremented whenever the format changes; older checkpoints are then ignored
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(object):
+    """
+    The state of a session after a step, saved so that an interrupted session, e.g., one that
+    crashed or whose response was blocked, can be resumed from there instead of started over,
+    without repeating any of the model calls made so far. It is stored as gzipped JSON.
+    """
+
+    def __init__(
+            self,
+            prompt_hash: str,
+            next_step: int,
+            prompt: str,
+            history: List[Dict[str, Any]],
+            num_fixed_turns: int,
+            usage: Dict[str, Any],
+            files: Optional[List[List[str]]],
+            num_responses: int = 0
+    ):
+        """
+        :param prompt_hash: The hash of the task, so that a checkpoint of another task is not resumed.
+        :param next_step: The index of the step to resume from.
+        :param prompt: The prompt of that step, which contains the outputs of the tools used in the last step.
+        :param history: The chat history, each turn as a dictionary.
+        :param num_fixed_turns: The number of turns at the start of the history that are never compacted.
+        :param usage: The model usage so far.
+        :param files: The path and the hash of every file in the working directory, if not too many.
+        :param num_responses: The number of calls of the backend so far, each of which may have got
+         several responses at once, e.g., the alternatives tried by speculation.
+        """
+
+        self.prompt_hash = prompt_hash
+        self.next_step = next_step
+        self.prompt = prompt
+        self.history = history
+        self.num_fixed_turns = num_fixed_turns
+        self.usage = usage
+        self.files = files
+        self.num_responses = num_responses
+
+    @staticmethod
+    def hash_files(exclude: str) -> Optional[List[List[str]]]:
+        """
+        Hash the files of the working directory.
+
+        :param exclude: A file not to consider, i.e., the checkpoint itself.
+        :return: The path and the hash of every file, or `None` if there are too many.
+        """
+
+        entries = hash_dir('.')
+        if entries is None:
+            return None
+
+        exclude = os.path.abspath(exclude)
+        return [[path, digest] for path, digest in entries if os.path.abspath(path) != exclude]
+
+    @staticmethod
+    def history_to_dicts(history: List[Any]) -> List[Dict[str, Any]]:
+        return [{'role': content.role, 'parts': get_parts(content)} for content in history]
+
+    @staticmethod
+    def history_from_dicts(history: List[Dict[str, Any]], backend: ModelBackend) -> List[Any]:
+        return [backend.content_from_dict(turn) for turn in history]
+
+    def changed_files(self, files: Optional[List[List[str]]]) -> List[str]:
+        """
+        Find the files changed since the checkpoint was saved.
+
+        :param files: The current paths and hashes of the files.
+        :return: The changed files, each with how it changed, e.g., `app.py (deleted)`.
+        """
+
+        if self.files is None or files is None:
+            return []
+
+        old, new = dict(self.files), dict(files)
+        changes = [f'{path} (deleted)' for path in old if path not in new]
+        changes.extend(f'{path} (modified)' for path in old if path in new and new[path] != old[path])
+        changes.extend(f'{path} (added)' for path in new if path not in old)
+
+        return sorted(changes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'version': CHECKPOINT_VERSION,
+            'prompt_hash': self.prompt_hash,
+            'next_step': self.next_step,
+            'prompt': self.prompt,
+            'history': self.history,
+            'num_fixed_turns': self.num_fixed_turns,
+            'usage': self.usage,
+            'files': self.files,
+            'num_responses': self.num_responses,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'Checkpoint':
+        return Checkpoint(
+            data['prompt_hash'],
+            data['next_step'],
+            data['prompt'],
+            data['history'],
+            data['num_fixed_turns'],
+            data['usage'],
+            data.get('files'),
+            # The earlier checkpoints had one response per model call
+            data.get('num_responses', data['usage'].get('round_trips', 0)),
+        )
+
+    def save(self, file_name: str):
+        """
+        Save the checkpoint, replacing any earlier one only once it is fully written.
+
+        :param file_name: The checkpoint file.
+        """
+
+        dir_name = os.path.dirname(os.path.abspath(file_name))
+        fd, temp_file = tempfile.mkstemp(dir=dir_name, prefix=f'.{os.path.basename(file_name)}.', suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as raw_file, gzip.open(raw_file, 'wt', encoding='utf-8', compresslevel=5) as out_file:
+                json.dump(self.to_dict(), out_file, separators=(',', ':'), default=str)
+
+            os.replace(temp_file, file_name)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    @staticmethod
+    def load(file_name: str) -> Optional['Checkpoint']:
+        """
+        Load a checkpoint.
+
+        :param file_name: The checkpoint file.
+        :return: The checkpoint, or `None` if there is none, or it is unreadable or of an older format.
+        """
+
+        try:
+            with gzip.open(file_name, 'rt', encoding='utf-8') as in_file:
+                data = json.load(in_file)
+        except (OSError, EOFError, ValueError):
+            return None
+
+        if data.get('version') != CHECKPOINT_VERSION:
+            return None
+
+        return Checkpoint.from_dict(data)
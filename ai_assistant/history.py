@@ -0,0 +1,272 @@
+import json
+from typing import Any, Dict, List, Set, Tuple
+
+from ai_assistant.backends.base import ModelBackend
+
+
+def get_parts(content: Any) -> List[Dict[str, Any]]:
+    """
+    Get the parts of a chat turn as plain dictionaries, whatever the backend.
+
+    :param content: The chat turn.
+    :return: The parts, each with either a `text` or a `function_call` key.
+    """
+
+    return [part.to_dict() for part in content.parts]
+
+
+def get_text(content: Any) -> str:
+    """
+    Get the text of a chat turn, ignoring its function calls.
+
+    :param content: The chat turn.
+    :return: The text.
+    """
+
+    return ''.join(part.get('text', '') for part in get_parts(content))
+
+
+def shorten(text: str, max_chars: int) -> str:
+    """
+    Shorten a text by dropping its middle, which keeps both how an output starts and
+    how it ends, e.g., the final error of a traceback.
+
+    :param text: The text.
+    :param max_chars: The maximum number of characters to keep.
+    :return: The shortened text.
+    """
+
+    if len(text) <= max_chars:
+        return text
+
+    head = max_chars // 2
+    tail = max_chars - head
+    return f'{text[:head]}\n... [{len(text) - max_chars} characters truncated] ...\n{text[len(text) - tail:]}'
+
+
+def summarize(text: str, max_lines: int = 5) -> str:
+    """
+    Summarize the output of a step without any model call: keep the lines naming the tools and
+    the actions, and those reporting errors.
+
+    :param text: The output.
+    :param max_lines: The maximum number of lines to keep.
+    :return: The summary.
+    """
+
+    keywords = ('Previously used tool', 'Output of the previous action', 'Error', 'error', 'Status:')
+    lines = [line.strip()[:200] for line in text.splitlines() if any(word in line for word in keywords)]
+
+    if len(lines) > max_lines:
+        lines = lines[:max_lines] + [f'... [{len(lines) - max_lines} more lines]']
+
+    return '\n'.join(['[Summary of an earlier step]'] + lines)
+
+
+class HistoryManager(object):
+    """
+    Keep the chat history within a token budget. The whole history is sent to the model in
+    every step, so every large tool output kept there is paid for again and again. Before each
+    model call, the manager:
+
+    1. Replaces any long text in a tool output that repeats an argument of the function call
+       it answers, e.g., the code written by `WriteFileTool`, with a reference to that call.
+    2. Truncates the tool outputs older than the most recent ones, and the long arguments of
+       the older function calls; the content of a file written again later is dropped.
+    3. If the history still exceeds the budget, summarizes the oldest tool outputs.
+
+    The system turns and the task are never modified.
+    """
+
+    # Texts shorter than this are not worth replacing with a reference
+    MIN_DUPLICATE_CHARS: int = 200
+
+    def __init__(self, token_budget: int = 32000, keep_recent_turns: int = 3, max_tool_output_chars: int = 2000):
+        """
+        :param token_budget: The maximum estimated number of tokens sent to the model in a step.
+         Zero means no budget; the older tool outputs are still deduplicated and truncated.
+        :param keep_recent_turns: The number of most recent tool outputs kept as they are.
+        :param max_tool_output_chars: The maximum length of the older tool outputs and function
+         call arguments.
+        """
+
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.max_tool_output_chars = max_tool_output_chars
+        # The estimated tokens of each turn, keyed on the turn's identity; the turn is kept
+        # alongside to keep the identity valid
+        self.token_counts: Dict[int, Tuple[Any, int]] = {}
+        # How far each tool output has been compacted already: 1 for deduplicated, 2 for truncated,
+        # and 3 for summarized, again keyed on the turn's identity
+        self.levels: Dict[int, Tuple[Any, int]] = {}
+        self.tokens_saved = 0
+        self.last_tokens = 0
+
+    def count_tokens(self, content: Any) -> int:
+        """
+        Estimate the number of tokens in a chat turn, at about four characters per token.
+
+        :param content: The chat turn.
+        :return: The estimated number of tokens.
+        """
+
+        entry = self.token_counts.get(id(content))
+
+        if entry is None or entry[0] is not content:
+            num_chars = sum(len(json.dumps(part, ensure_ascii=False)) for part in get_parts(content))
+            entry = (content, (num_chars + 3) // 4)
+            self.token_counts[id(content)] = entry
+
+        return entry[1]
+
+    def get_level(self, content: Any) -> int:
+        entry = self.levels.get(id(content))
+        return entry[1] if entry is not None and entry[0] is content else 0
+
+    def replace_turn(self, history: List[Any], idx: int, new_content: Any, level: int):
+        old_content = history[idx]
+        old_tokens = self.count_tokens(old_content)
+        self.token_counts.pop(id(old_content), None)
+        self.levels.pop(id(old_content), None)
+
+        history[idx] = new_content
+        self.levels[id(new_content)] = (new_content, level)
+        self.tokens_saved += old_tokens - self.count_tokens(new_content)
+
+    @staticmethod
+    def deduplicate(text: str, previous_turn: Any) -> str:
+        """
+        Replace the long function call arguments repeated in a tool output with references.
+
+        :param text: The tool output.
+        :param previous_turn: The model turn with the function calls answered by the output.
+        :return: The deduplicated output.
+        """
+
+        for part in get_parts(previous_turn):
+            func_call = part.get('function_call')
+            if not func_call:
+                continue
+
+            for key, value in (func_call.get('args') or {}).items():
+                value = value.strip() if isinstance(value, str) else ''
+
+                if len(value) >= HistoryManager.MIN_DUPLICATE_CHARS and value in text:
+                    text = text.replace(value, f'[Same as the `{key}` argument of {func_call["name"]} above]')
+
+        return text
+
+    def compact_function_calls(self, content: Any, later_files: Set[str]) -> Dict[str, Any]:
+        """
+        Shorten the long arguments of the function calls of an old model turn. The content of
+        a file that is written again later is dropped altogether.
+
+        :param content: The model turn.
+        :param later_files: The files written by the later turns.
+        :return: The compacted turn as a dictionary.
+        """
+
+        parts = get_parts(content)
+
+        for part in parts:
+            func_call = part.get('function_call')
+            if not func_call:
+                continue
+
+            args = dict(func_call.get('args') or {})
+            file_name = args.get('file_name')
+
+            for key, value in args.items():
+                if key == 'file_name' or not isinstance(value, str) or len(value) <= self.max_tool_output_chars:
+                    continue
+
+                if isinstance(file_name, str) and file_name.strip() in later_files:
+                    args[key] = f'[Omitted; {file_name.strip()} was written again later]'
+                else:
+                    args[key] = shorten(value, self.max_tool_output_chars)
+
+            func_call['args'] = args
+
+        return {'role': 'model', 'parts': parts}
+
+    def compact(self, history: List[Any], backend: ModelBackend, num_fixed_turns: int) -> int:
+        """
+        Compact the turns about to be sent in place so that they fit in the budget.
+
+        :param history: The chat history followed by the latest user turn.
+        :param backend: The backend, to create the replacement turns.
+        :param num_fixed_turns: The number of turns at the start of the history never to modify,
+         i.e., the system turns and the task.
+        :return: The estimated number of tokens that will be sent.
+        """
+
+        first = max(num_fixed_turns, 1)
+        # The tool outputs are the user turns following a model turn
+        outputs = [idx for idx in range(first, len(history)) if getattr(history[idx], 'role', 'user') == 'user']
+        calls = [idx for idx in range(first, len(history)) if getattr(history[idx], 'role', 'user') == 'model']
+        num_old = max(len(outputs) - self.keep_recent_turns, 0)
+        num_old_calls = max(len(calls) - self.keep_recent_turns, 0)
+
+        for num, idx in enumerate(outputs):
+            level = 2 if num < num_old and self.max_tool_output_chars else 1
+            if self.get_level(history[idx]) >= level:
+                continue
+
+            text = get_text(history[idx])
+            new_text = text
+            if self.get_level(history[idx]) < 1:
+                new_text = HistoryManager.deduplicate(new_text, history[idx - 1])
+            if level == 2:
+                new_text = shorten(new_text, self.max_tool_output_chars)
+
+            new_content = backend.make_content('user', new_text) if new_text != text else history[idx]
+            self.replace_turn(history, idx, new_content, level)
+
+        if self.max_tool_output_chars:
+            later_files = set()
+
+            for num in range(len(calls) - 1, -1, -1):
+                idx = calls[num]
+
+                if num < num_old_calls and self.get_level(history[idx]) < 2:
+                    try:
+                        new_content = backend.content_from_dict(
+                            self.compact_function_calls(history[idx], later_files)
+                        )
+                    except NotImplementedError:
+                        break
+
+                    self.replace_turn(history, idx, new_content, 2)
+
+                for part in get_parts(history[idx]):
+                    file_name = (part.get('function_call') or {}).get('args', {}).get('file_name')
+                    if isinstance(file_name, str):
+                        later_files.add(file_name.strip())
+
+        total = sum(self.count_tokens(content) for content in history)
+
+        for idx in outputs[:num_old]:
+            if not self.token_budget or total <= self.token_budget:
+                break
+            if self.get_level(history[idx]) >= 3:
+                continue
+
+            old_tokens = self.count_tokens(history[idx])
+            self.replace_turn(history, idx, backend.make_content('user', summarize(get_text(history[idx]))), 3)
+            total -= old_tokens - self.count_tokens(history[idx])
+
+        self.last_tokens = total
+        return total
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the history size.
+
+        :return: The report.
+        """
+
+        budget = f' of a budget of {self.token_budget}' if self.token_budget else ''
+        return (
+            f'Chat history: ~{self.last_tokens} tokens in the last step{budget},'
+            f' ~{self.tokens_saved} tokens removed from it by compaction'
+        )
@@ -0,0 +1,432 @@
+import contextlib
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Type, Union
+
+from ai_assistant.batch import BatchJob, run_job
+from ai_assistant.tools.base import ToolInterface
+
+
+# The dependencies imported by every worker before it takes any job, if installed
+PRELOAD_MODULES = ('vertexai', 'pylint.lint', 'requests')
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue of the server is full.
+    """
+
+
+class ServerJob(object):
+    """
+    A job submitted to the server: an assistant session, run by one of the workers in its own
+    working directory, whose events are streamed back to the client.
+    """
+
+    def __init__(self, job_id: str, prompt_file: str, settings: Dict[str, Dict[str, Any]]):
+        """
+        :param job_id: The unique name of the job, also used as the name of its working directory.
+        :param prompt_file: The prompt file to solve.
+        :param settings: Any settings overriding those in the settings file, grouped by section.
+        """
+
+        self.job_id = job_id
+        self.prompt_file = prompt_file
+        self.settings = settings
+        # The events of the job, as dictionaries, until `None` after the last one
+        self.events: queue.Queue = queue.Queue()
+        self.submit_time = time.perf_counter()
+        self.worker: Optional[int] = None
+
+
+def warm_up(tools: List[Union[str, Type[ToolInterface]]], settings_file: str, preload_modules: List[str]):
+    """
+    Do, once, all the work that every session would otherwise start with: import the heavy
+    dependencies, parse the settings, configure the tools, and create the model client.
+    """
+
+    for name in preload_modules:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+
+    from ai_assistant.assistant import Assistant
+    from ai_assistant.tools.import_check import MODULE_INDEX
+
+    MODULE_INDEX.refresh()
+
+    with open(os.devnull, 'w', encoding='utf-8') as null_file, contextlib.redirect_stdout(null_file):
+        try:
+            # The backend created is reused by the sessions with the same model settings
+            Assistant(tools=tools, verbose=False, settings_file=settings_file)
+        except (SystemExit, Exception):
+            # E.g., the model client cannot be created; every job reports that itself
+            pass
+
+
+def run_worker(
+        worker: int,
+        tools: List[Union[str, Type[ToolInterface]]],
+        settings_file: str,
+        work_root: str,
+        num_workers: int,
+        preload_modules: List[str],
+        jobs: multiprocessing.Queue,
+        events: multiprocessing.Queue
+):
+    """
+    Run the jobs of the server one after another, in a worker process, until told to stop.
+    Every worker runs a single job at a time because the tools resolve file names relative
+    to the process-wide current directory.
+
+    :param worker: The number of the worker.
+    :param tools: The tools available to the assistant.
+    :param settings_file: The settings file shared by all jobs.
+    :param work_root: The directory under which every job gets its own working directory.
+    :param num_workers: The number of workers, which share the rate limit of the model calls.
+    :param preload_modules: The modules to import before taking any job.
+    :param jobs: The job ID, the prompt file, and the settings of every job; `None` to stop.
+    :param events: The job ID, the name, and the details of every event, sent back to the server.
+    """
+
+    warm_up(tools, settings_file, preload_modules)
+    events.put((None, 'ready', {'worker': worker}))
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        job_id, prompt_file, settings = job
+        events.put((job_id, 'started', {'worker': worker}))
+
+        def on_event(name: str, data: Dict[str, Any]):
+            # Only plain data can be sent back, e.g., not the parameters of the calls as given by Vertex AI
+            events.put((job_id, name, json.loads(json.dumps(data, default=str))))
+
+        result = run_job(
+            BatchJob(job_id, prompt_file, settings), tools, settings_file, work_root, num_workers, on_event
+        )
+        events.put((job_id, 'done', json.loads(json.dumps(result, default=str))))
+
+
+class AssistantServer(object):
+    """
+    A long-running pool of worker processes that run assistant sessions on demand. Every worker
+    imports the heavy dependencies, parses the settings, and creates the model client once, when
+    started, so that a job submitted later starts working at once. At most as many jobs as there
+    are workers run at the same time; up to `max_queue` more wait for a free worker.
+    """
+
+    def __init__(
+            self,
+            tools: List[Union[str, Type[ToolInterface]]],
+            settings_file: str,
+            work_root: str,
+            num_workers: int = 2,
+            max_queue: int = 100,
+            preload_modules: List[str] = PRELOAD_MODULES
+    ):
+        """
+        :param tools: The tools available to the assistant, preferably by name.
+        :param settings_file: The settings file shared by all jobs.
+        :param work_root: The directory under which every job gets its own working directory.
+        :param num_workers: The number of worker processes, i.e., of jobs run at the same time.
+        :param max_queue: The maximum number of jobs waiting for a worker.
+        :param preload_modules: The modules every worker imports before taking any job, if installed.
+        """
+
+        self.tools = tools
+        self.settings_file = os.path.abspath(settings_file)
+        self.work_root = os.path.abspath(work_root)
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.preload_modules = list(preload_modules)
+        # Spawn rather than fork the workers since the gRPC client used by Vertex AI is not fork-safe
+        self.context = multiprocessing.get_context('spawn')
+        self.job_queue = self.context.Queue()
+        self.event_queue = self.context.Queue()
+        self.workers: Dict[int, multiprocessing.Process] = {}
+        self.jobs: Dict[str, ServerJob] = {}
+        self.num_ready = 0
+        self.num_waiting = 0
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._dispatcher: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def start_worker(self, worker: int):
+        process = self.context.Process(
+            target=run_worker,
+            args=(
+                worker, self.tools, self.settings_file, self.work_root, self.num_workers,
+                self.preload_modules, self.job_queue, self.event_queue,
+            ),
+            daemon=True,
+        )
+        process.start()
+        self.workers[worker] = process
+
+    def start(self):
+        """
+        Start the workers, which warm up in the background, and the dispatching of their events.
+        """
+
+        os.makedirs(os.path.join(self.work_root, '.prompts'), exist_ok=True)
+
+        for worker in range(self.num_workers):
+            self.start_worker(worker)
+
+        self._dispatcher = threading.Thread(target=self.dispatch_events, daemon=True)
+        self._dispatcher.start()
+
+    def stop(self):
+        """
+        Stop the workers once they are done with the jobs they are running.
+        """
+
+        self._stopping = True
+
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for process in self.workers.values():
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+
+    def submit(self, prompt: str, name: str = None, settings: Dict[str, Dict[str, Any]] = None) -> ServerJob:
+        """
+        Queue a job.
+
+        :param prompt: The prompt to solve.
+        :param name: A name for the job, which is made unique.
+        :param settings: Any settings overriding those in the settings file, grouped by section.
+        :return: The job, whose events can be followed via `ServerJob.events`.
+        """
+
+        with self._lock:
+            if self.num_waiting >= self.max_queue:
+                self.stats['rejected'] += 1
+                raise QueueFullError(f'The queue is full: {self.num_waiting} jobs are waiting')
+
+            name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name or 'job').strip('._') or 'job'
+            job_id = f'{next(self._sequence):05d}_{name}'
+            prompt_file = os.path.join(self.work_root, '.prompts', f'{job_id}.txt')
+
+            with open(prompt_file, 'w', encoding='utf-8') as out_file:
+                out_file.write(prompt)
+
+            job = ServerJob(job_id, prompt_file, settings or {})
+            self.jobs[job_id] = job
+            self.num_waiting += 1
+            self.stats['submitted'] += 1
+            job.events.put({'event': 'queued', 'job': job_id, 'position': self.num_waiting})
+        self.job_queue.put((job_id, prompt_file, job.settings))
+        return job
+
+    def finish(self, job: ServerJob, result: Dict[str, Any]):
+        with self._lock:
+            self.jobs.pop(job.job_id, None)
+            self.stats['completed' if result.get('status') == 'completed' else 'failed'] += 1
+
+        try:
+            os.remove(job.prompt_file)
+        except OSError:
+            pass
+
+        result['latency'] = round(time.perf_counter() - job.submit_time, 3)
+        job.events.put({'event': 'done', 'job': job.job_id, 'result': result})
+        job.events.put(None)
+
+    def dispatch_events(self):
+        """
+        Pass the events sent by the workers on to their jobs, and replace any worker that died,
+        failing the job it was running. The workers are checked every second, even while the
+        other jobs keep sending events.
+        """
+
+        last_check = time.monotonic()
+
+        while not self._stopping:
+            if time.monotonic() - last_check >= 1.0:
+                self.check_workers()
+                last_check = time.monotonic()
+
+            try:
+                job_id, name, data = self.event_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            if name == 'ready':
+                self.num_ready += 1
+                continue
+
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+
+            if name == 'started':
+                with self._lock:
+                    self.num_waiting -= 1
+                job.worker = data['worker']
+                job.events.put({'event': 'started', 'job': job_id, 'worker': job.worker})
+            elif name == 'done':
+                self.finish(job, data)
+            else:
+                job.events.put({'event': name, 'job': job_id, **data})
+
+    def check_workers(self):
+        for worker, process in list(self.workers.items()):
+            if process.is_alive() or self._stopping:
+                continue
+
+            for job in list(self.jobs.values()):
+                if job.worker == worker:
+                    self.finish(job, {
+                        'name': job.job_id, 'status': 'error', 'steps': 0,
+                        'error': f'The worker running the job exited with code {process.exitcode}',
+                    })
+
+            self.num_ready -= 1
+            self.start_worker(worker)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        :return: The state of the workers and the queue, and the number of jobs so far.
+        """
+
+        with self._lock:
+            return {
+                'workers': self.num_workers,
+                'ready': self.num_ready,
+                'running': len(self.jobs) - self.num_waiting,
+                'waiting': self.num_waiting,
+                **self.stats,
+            }
+
+
+class ServerRequestHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP interface of the server:
+
+    - `POST /jobs` with a JSON object with the `prompt` and, optionally, the `name` and the
+      `settings` overriding those in the settings file, e.g., `{"Gemini": {"temperature": 0.5}}`.
+      The events of the job are streamed back as JSON lines until the last one, `done`, which
+      has the outcome of the session.
+    - `GET /status` to get the state of the workers and the queue.
+    """
+    # Every response ends by closing the connection, so that the events can be streamed without a length
+    protocol_version = 'HTTP/1.0'
+    server_version = 'GeminiSenpai'
+
+    def address_string(self) -> str:
+        # The clients connected via a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def send_json(self, status: int, data: Dict[str, Any]):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.assistant_server.status())
+        else:
+            self.send_json(404, {'error': f'Not found: {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, {'error': f'Not found: {self.path}'})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError as ve:
+            self.send_json(400, {'error': f'Invalid JSON: {ve}'})
+            return
+
+        if not isinstance(request, dict) or not str(request.get('prompt', '')).strip():
+            self.send_json(400, {'error': 'The `prompt` is missing'})
+            return
+
+        settings = request.get('settings') or {}
+        if not isinstance(settings, dict) or not all(isinstance(params, dict) for params in settings.values()):
+            self.send_json(400, {'error': 'The `settings` must be grouped by section'})
+            return
+
+        try:
+            job = self.server.assistant_server.submit(str(request['prompt']), request.get('name'), settings)
+        except QueueFullError as qfe:
+            self.send_json(503, {'error': str(qfe)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        while True:
+            event = job.events.get()
+            if event is None:
+                break
+
+            try:
+                self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                # The client went away; the job goes on regardless
+                break
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The HTTP server listening on a Unix socket instead of a TCP port.
+    """
+    daemon_threads = True
+
+
+def serve(
+        assistant_server: AssistantServer,
+        host: str = '127.0.0.1',
+        port: int = 8765,
+        socket_path: str = None
+):
+    """
+    Serve the requests via HTTP until interrupted.
+
+    :param assistant_server: The server running the jobs, started already.
+    :param host: The address to listen on.
+    :param port: The port to listen on.
+    :param socket_path: If specified, the Unix socket to listen on instead of the address.
+    """
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        http_server = UnixHTTPServer(socket_path, ServerRequestHandler)
+    else:
+        http_server = ThreadingHTTPServer((host, port), ServerRequestHandler)
+
+    http_server.assistant_server = assistant_server
+
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
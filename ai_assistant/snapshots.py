@@ -0,0 +1,295 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+from ai_assistant.cache import hash_file
+from ai_assistant.workspace import walk_tree
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# The ioctl cloning a file into another, sharing the blocks until either is changed
+FICLONE = 0x40049409
+
+
+def clone_file(source: str, target: str):
+    """
+    Copy a file. Where the file system supports it, e.g., Btrfs or XFS, the copy is a reflink,
+    which shares the blocks of the file until either is changed, so it takes no time or space.
+
+    :param source: The file.
+    :param target: The copy.
+    """
+
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as in_file, open(target, 'wb') as out_file:
+                fcntl.ioctl(out_file.fileno(), FICLONE, in_file.fileno())
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(source, target)
+
+
+class SnapshotStore(object):
+    """
+    Snapshots of the files of the working directory, taken before every step, so that the files
+    can be restored to how they were before any earlier step. The contents are kept in a
+    content-addressed store of blobs, and every snapshot is a manifest of the paths, the hashes,
+    the modes, and the modification times of the files. A file unchanged since the previous
+    snapshot, by its size and modification time, is neither hashed nor stored again, so taking a
+    snapshot costs only as much as the files changed.
+
+    The blobs are reflinks of the files where supported, and copies otherwise. They are never
+    hardlinks: the programs run may change a file in place, which would change its blob too.
+    Hidden files and directories and `__pycache__` are not snapshotted, including the store itself.
+    """
+
+    def __init__(self):
+        # The absolute path of the working directory, and of the store in it, if enabled
+        self.root: Optional[str] = None
+        self.dir_name: Optional[str] = None
+        self.max_files = 2000
+        self.max_bytes = 256 * 1024 * 1024
+        # The manifest of the latest snapshot, to tell which files changed since
+        self.last_files: Dict[str, List[Any]] = {}
+        self.stats = {'snapshots': 0, 'files_stored': 0, 'rollbacks': 0}
+        self._lock = threading.Lock()
+
+    def reset(
+            self,
+            root: Optional[str],
+            dir_name: str = '.senpai_snapshots',
+            max_files: int = 2000,
+            max_mb: float = 256,
+            clear: bool = True
+    ):
+        """
+        Start keeping the snapshots of a directory, or stop.
+
+        :param root: The directory, or `None` to stop.
+        :param dir_name: The store, relative to the directory; hidden, so that it is not snapshotted itself.
+        :param max_files: The maximum number of files of the directory; no snapshot is taken beyond this.
+        :param max_mb: The maximum total size of those files, in MB.
+        :param clear: Whether to remove the snapshots of an earlier session, e.g., unless resuming it.
+        """
+
+        with self._lock:
+            self.root = os.path.abspath(root) if root is not None else None
+            self.dir_name = os.path.join(self.root, dir_name) if self.root is not None else None
+            self.max_files = max_files
+            self.max_bytes = int(max_mb * 1024 * 1024)
+            self.last_files = {}
+
+            if self.dir_name is None:
+                return
+
+            if clear:
+                shutil.rmtree(self.dir_name, ignore_errors=True)
+
+            os.makedirs(os.path.join(self.dir_name, 'blobs'), exist_ok=True)
+            os.makedirs(os.path.join(self.dir_name, 'steps'), exist_ok=True)
+
+            steps = self.steps()
+            if steps:
+                self.last_files = self.load(steps[-1])['files']
+
+    def get_manifest_file(self, step: int) -> str:
+        return os.path.join(self.dir_name, 'steps', f'step_{step:04d}.json')
+
+    def get_blob_file(self, digest: str) -> str:
+        return os.path.join(self.dir_name, 'blobs', digest[:2], digest)
+
+    def steps(self) -> List[int]:
+        """
+        :return: The steps snapshotted, in order.
+        """
+
+        if self.dir_name is None:
+            return []
+
+        try:
+            names = os.listdir(os.path.join(self.dir_name, 'steps'))
+        except OSError:
+            return []
+
+        return sorted(
+            int(name[len('step_'):-len('.json')])
+            for name in names if name.startswith('step_') and name.endswith('.json')
+        )
+
+    def load(self, step: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.get_manifest_file(step), 'r', encoding='utf-8') as in_file:
+                return json.load(in_file)
+        except (OSError, ValueError):
+            return None
+
+    def store_blob(self, path: str, digest: str) -> bool:
+        """
+        Store the content of a file, unless already stored.
+
+        :param path: The file.
+        :param digest: The hash of its content.
+        :return: True if stored now.
+        """
+
+        blob_file = self.get_blob_file(digest)
+        if os.path.exists(blob_file):
+            return False
+
+        os.makedirs(os.path.dirname(blob_file), exist_ok=True)
+        temp_file = f'{blob_file}.{os.getpid()}.tmp'
+
+        try:
+            clone_file(path, temp_file)
+            os.chmod(temp_file, 0o444)
+            os.replace(temp_file, blob_file)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+        return True
+
+    def take(self, step: int) -> Optional[int]:
+        """
+        Take a snapshot of the files, before a step.
+
+        :param step: The step, starting from 1.
+        :return: The number of files stored, i.e., changed since the previous snapshot, or `None`
+         if no snapshot was taken, e.g., because there are too many files.
+        """
+
+        with self._lock:
+            if self.root is None:
+                return None
+
+            dirs, entries = walk_tree(self.root)
+            if len(entries) > self.max_files or sum(stat.st_size for _, stat in entries) > self.max_bytes:
+                return None
+
+            files = {}
+            num_stored = 0
+
+            for rel_path, stat in entries:
+                old = self.last_files.get(rel_path)
+
+                if old is not None and old[1] == stat.st_size and old[2] == stat.st_mtime_ns:
+                    digest = old[0]
+                else:
+                    path = os.path.join(self.root, rel_path)
+                    try:
+                        digest = hash_file(path)
+                        num_stored += self.store_blob(path, digest)
+                    except OSError:
+                        continue
+
+                files[rel_path] = [digest, stat.st_size, stat.st_mtime_ns, stat.st_mode & 0o7777]
+
+            manifest_file = self.get_manifest_file(step)
+            with open(f'{manifest_file}.tmp', 'w', encoding='utf-8') as out_file:
+                json.dump({'step': step, 'dirs': sorted(dirs), 'files': files}, out_file)
+            os.replace(f'{manifest_file}.tmp', manifest_file)
+
+            self.last_files = files
+            self.stats['snapshots'] += 1
+            self.stats['files_stored'] += num_stored
+
+            return num_stored
+
+    def restore_file(self, rel_path: str, entry: List[Any]):
+        """
+        Restore a file from its blob, atomically, with its mode and modification time.
+        """
+
+        digest, _, mtime_ns, mode = entry
+        target = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.senpai_')
+        os.close(fd)
+
+        try:
+            clone_file(self.get_blob_file(digest), temp_file)
+            os.chmod(temp_file, mode)
+            os.utime(temp_file, ns=(mtime_ns, mtime_ns))
+            os.replace(temp_file, target)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    def rollback(self, step: int) -> Optional[List[str]]:
+        """
+        Restore the files to how they were before a step: the files changed since are restored,
+        and those created since are removed, along with the directories created since, if empty.
+        The later snapshots are kept, so that a rollback can itself be undone.
+
+        :param step: The step.
+        :return: The paths changed, each with how it changed, e.g., `app.py (removed)`, or `None`
+         if there is no snapshot of the step.
+        """
+
+        with self._lock:
+            manifest = self.load(step) if self.root is not None else None
+            if manifest is None:
+                return None
+
+            dirs, entries = walk_tree(self.root)
+            current = {rel_path: stat for rel_path, stat in entries}
+            changes = []
+
+            for rel_path, entry in sorted(manifest['files'].items()):
+                stat = current.get(rel_path)
+                if stat is not None and stat.st_size == entry[1] and stat.st_mtime_ns == entry[2]:
+                    continue
+
+                self.restore_file(rel_path, entry)
+                changes.append(f'{rel_path} (restored)' if stat is not None else f'{rel_path} (recreated)')
+
+            for rel_path in sorted(current.keys() - manifest['files'].keys()):
+                try:
+                    os.remove(os.path.join(self.root, rel_path))
+                    changes.append(f'{rel_path} (removed)')
+                except OSError:
+                    continue
+
+            # The deepest first, so that a directory is emptied before its parent
+            for rel_path in sorted(set(dirs) - set(manifest['dirs']), reverse=True):
+                try:
+                    os.rmdir(os.path.join(self.root, rel_path))
+                    changes.append(f'{rel_path}/ (removed)')
+                except OSError:
+                    # Not empty, e.g., because of hidden files
+                    continue
+
+            for rel_path in manifest['dirs']:
+                os.makedirs(os.path.join(self.root, rel_path), exist_ok=True)
+
+            self.last_files = manifest['files']
+            self.stats['rollbacks'] += 1
+
+            return changes
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the snapshots.
+
+        :return: The report.
+        """
+
+        return (
+            f'Snapshots: {self.stats["snapshots"]}, files stored: {self.stats["files_stored"]},'
+            f' rollbacks: {self.stats["rollbacks"]}'
+        )
+
+
+# The snapshots of the working directory of the session running in this process
+SNAPSHOTS = SnapshotStore()
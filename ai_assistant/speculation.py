@@ -0,0 +1,385 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ai_assistant.tools.base import ToolInterface
+from ai_assistant.tracing import trace
+from ai_assistant.workspace import WORKSPACE, walk_tree
+
+
+# The parameters of the tools that name files or directories
+PATH_PARAMS = ('file_name', 'dir_name', 'file_names')
+
+
+class Sandbox(object):
+    """
+    A copy of the working directory for a branch to work in. What the branch changed is found by
+    comparing the sizes and modification times of the files with those of the copy, which keeps
+    the modification times of the originals. The hidden files, e.g., `.env`, are copied too, so
+    that the programs run in the copy behave as they would in the working directory; only the
+    state of the assistant itself, such as its checkpoint, is not.
+    """
+
+    def __init__(self, root: str, path: str, files: Dict[str, Tuple[int, int]], dirs: List[str]):
+        """
+        :param root: The working directory.
+        :param path: The copy.
+        :param files: The size and the modification time of every file copied, by its relative path.
+        :param dirs: The directories copied, by their relative paths.
+        """
+
+        self.root = root
+        self.path = path
+        self.files = files
+        self.dirs = dirs
+
+    @staticmethod
+    def create(root: str, max_files: int, max_bytes: int) -> Optional['Sandbox']:
+        """
+        Copy a directory into a new temporary directory.
+
+        :param root: The directory.
+        :param max_files: The maximum number of files to copy.
+        :param max_bytes: The maximum total size of the files to copy.
+        :return: The sandbox, or `None` if the directory is too large.
+        """
+
+        dirs, entries = walk_tree(root, include_hidden=True)
+        if len(entries) > max_files or sum(stat.st_size for _, stat in entries) > max_bytes:
+            return None
+
+        path = tempfile.mkdtemp(prefix='senpai_branch_')
+        files = {}
+
+        for rel_path in dirs:
+            os.makedirs(os.path.join(path, rel_path), exist_ok=True)
+
+        for rel_path, _ in entries:
+            try:
+                shutil.copy2(os.path.join(root, rel_path), os.path.join(path, rel_path))
+                stat = os.stat(os.path.join(path, rel_path))
+                files[rel_path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+
+        return Sandbox(root, path, files, dirs)
+
+    def commit(self) -> List[str]:
+        """
+        Apply the changes made in the sandbox to the working directory: the files written are
+        copied back, each replacing the original atomically, and the files and the directories
+        removed are removed.
+
+        :return: The paths changed, relative to the working directory.
+        """
+
+        changed = []
+        found = set()
+        dirs, entries = walk_tree(self.path, include_hidden=True)
+
+        for rel_path in dirs:
+            os.makedirs(os.path.join(self.root, rel_path), exist_ok=True)
+
+        for rel_path, stat in entries:
+            found.add(rel_path)
+            if self.files.get(rel_path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            target = os.path.join(self.root, rel_path)
+            fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.senpai_')
+            os.close(fd)
+
+            try:
+                shutil.copy2(os.path.join(self.path, rel_path), temp_name)
+                os.replace(temp_name, target)
+            except OSError:
+                if os.path.exists(temp_name):
+                    os.remove(temp_name)
+                raise
+
+            changed.append(rel_path)
+
+        for rel_path in self.files.keys() - found:
+            try:
+                os.remove(os.path.join(self.root, rel_path))
+                changed.append(rel_path)
+            except FileNotFoundError:
+                continue
+
+        # The deepest first, so that a directory is emptied before its parent; whatever is left in
+        # it was not copied, e.g., `__pycache__`
+        for rel_path in sorted(set(self.dirs) - set(dirs), reverse=True):
+            target = os.path.join(self.root, rel_path)
+
+            if os.path.islink(target):
+                os.remove(target)
+            else:
+                shutil.rmtree(target, ignore_errors=True)
+            changed.append(f'{rel_path}/')
+
+        return sorted(changed)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Branch(object):
+    """
+    The function calls of one of the alternative responses, run in a separate process in a sandbox.
+    """
+
+    def __init__(self, num: int, calls: List[Tuple[str, Dict[str, Any]]], sandbox: Sandbox):
+        """
+        :param num: The index of the response.
+        :param calls: The function names and their parameters, other than the final answer.
+        :param sandbox: The copy of the working directory to run the calls in.
+        """
+
+        self.num = num
+        self.calls = calls
+        self.sandbox = sandbox
+        self.process: Optional[multiprocessing.Process] = None
+        self.connection: Optional[Connection] = None
+        # The outputs of the calls, once done; `None` if the process crashed or was stopped
+        self.outputs: Optional[List[str]] = None
+        self.done = False
+        self.passed = False
+
+
+class Speculator(object):
+    """
+    Run the function calls of several alternative responses of the model at once, each in its own
+    process working in a copy of the working directory, and keep the first of them, in the order of
+    the responses, whose calls all succeeded, e.g., whose code lints cleanly and runs without errors.
+    Only the changes made by that one are applied to the working directory; the others are discarded.
+
+    Only the working directory is sandboxed: anything else a branch does, e.g., downloading a file
+    or changing a file elsewhere, is done once for every branch. So, the responses whose calls name
+    a path outside the working directory are not run speculatively.
+    """
+
+    def __init__(
+            self,
+            tools_by_name: Dict[str, ToolInterface],
+            num_variants: int = 3,
+            max_files: int = 1000,
+            max_mb: float = 64,
+            timeout: float = 300.0
+    ):
+        """
+        :param tools_by_name: The tools, by name.
+        :param num_variants: The maximum number of responses to get, and of branches to run, at every step.
+        :param max_files: The maximum number of files of the working directory to copy into every sandbox.
+        :param max_mb: The maximum total size of those files, in MB.
+        :param timeout: The maximum time of every branch, in seconds.
+        """
+
+        self.tools_by_name = tools_by_name
+        self.num_variants = num_variants
+        self.max_files = max_files
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.timeout = timeout
+        self.stats = {'steps': 0, 'branches': 0, 'alternatives_used': 0, 'all_failed': 0}
+
+    @staticmethod
+    def is_supported() -> bool:
+        return 'fork' in multiprocessing.get_all_start_methods()
+
+    @staticmethod
+    def is_outside(path: Any) -> bool:
+        if isinstance(path, list):
+            return any(Speculator.is_outside(item) for item in path)
+        if not isinstance(path, str):
+            return False
+
+        path = path.strip()
+        return os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == '..'
+
+    def select_branches(self, call_lists: List[List[Tuple[str, Dict[str, Any]]]]) -> List[int]:
+        """
+        Select the responses worth running: those that have any function call, with the first
+        response among them, and whose calls differ from those of the other responses. Nothing is
+        run if any of the calls may change something outside of the working directory.
+
+        :param call_lists: The function calls of every response, other than the final answer.
+        :return: The indices of the responses, or fewer than two to not speculate.
+        """
+
+        if not call_lists or not call_lists[0]:
+            return []
+
+        selected = []
+        seen = []
+
+        for num, calls in enumerate(call_lists):
+            if not calls or calls in seen:
+                continue
+            if any(Speculator.is_outside(params.get(key)) for _, params in calls for key in PATH_PARAMS):
+                return []
+            if any(
+                    func_name in self.tools_by_name and not self.tools_by_name[func_name].sandboxed
+                    for func_name, _ in calls
+            ):
+                return []
+
+            selected.append(num)
+            seen.append(calls)
+
+        return selected
+
+    def is_failure(self, calls: List[Tuple[str, Dict[str, Any]]], outputs: List[str]) -> bool:
+        return any(
+            func_name not in self.tools_by_name or self.tools_by_name[func_name].is_failure(output)
+            for (func_name, _), output in zip(calls, outputs)
+        )
+
+    def run_branch(self, branch: Branch, use_tool: Callable[[str, Dict[str, Any]], str], connection: Connection):
+        """
+        Run the calls of a branch, in the process forked for it.
+        """
+
+        try:
+            for tool in self.tools_by_name.values():
+                tool.after_fork()
+
+            os.chdir(branch.sandbox.path)
+            WORKSPACE.reset(branch.sandbox.path, watch=False, max_files=self.max_files)
+
+            outputs = [
+                use_tool(func_name, params).replace(branch.sandbox.path, branch.sandbox.root)
+                for func_name, params in branch.calls
+            ]
+            connection.send(outputs)
+        finally:
+            connection.close()
+
+    def stop(self, branch: Branch):
+        if branch.process is not None and branch.process.is_alive():
+            branch.process.kill()
+        if branch.process is not None:
+            branch.process.join()
+            branch.process.close()
+            branch.process = None
+        if branch.connection is not None:
+            branch.connection.close()
+            branch.connection = None
+
+    def run(
+            self,
+            call_lists: List[List[Tuple[str, Dict[str, Any]]]],
+            use_tool: Callable[[str, Dict[str, Any]], str]
+    ) -> Optional[Tuple[int, List[str]]]:
+        """
+        Run the function calls of the alternative responses speculatively, and apply the changes of
+        the first one that succeeded to the working directory. If none succeeded, those of the first
+        response are applied, as if it had been run by itself.
+
+        :param call_lists: The function calls of every response, other than the final answer.
+        :param use_tool: Uses a tool by its name, returning the output.
+        :return: The index of the response chosen and the outputs of its calls, or `None` if the
+         calls were not run speculatively, and the calls of the first response are still to be run.
+        """
+
+        selected = self.select_branches(call_lists)
+        if len(selected) < 2:
+            return None
+
+        root = os.getcwd()
+        branches = []
+
+        with trace('speculate', 'speculation', branches=len(selected)) as span:
+            try:
+                for num in selected:
+                    sandbox = Sandbox.create(root, self.max_files, self.max_bytes)
+                    if sandbox is None:
+                        span.set(skipped='workspace too large')
+                        return None
+                    branches.append(Branch(num, call_lists[num], sandbox))
+
+                context = multiprocessing.get_context('fork')
+
+                for branch in branches:
+                    branch.connection, child_connection = context.Pipe(duplex=False)
+                    branch.process = context.Process(
+                        target=self.run_branch, args=(branch, use_tool, child_connection), daemon=True
+                    )
+                    branch.process.start()
+                    child_connection.close()
+
+                chosen = self.wait_for_branches(branches)
+                span.set(chosen=chosen.num if chosen is not None else None)
+
+                if chosen is None:
+                    return None
+
+                with trace('commit', 'speculation', branch=chosen.num):
+                    chosen.sandbox.commit()
+                WORKSPACE.scan()
+
+                self.stats['steps'] += 1
+                self.stats['branches'] += len(branches)
+                if chosen.num != 0:
+                    self.stats['alternatives_used'] += 1
+                if not chosen.passed:
+                    self.stats['all_failed'] += 1
+
+                return chosen.num, chosen.outputs
+            finally:
+                for branch in branches:
+                    self.stop(branch)
+                    branch.sandbox.remove()
+
+    def wait_for_branches(self, branches: List[Branch]) -> Optional[Branch]:
+        """
+        Wait until the first branch, in order, that succeeded is known, stopping the others then.
+
+        :param branches: The branches, running.
+        :return: The branch chosen: the first that succeeded, else the first branch if it finished,
+         else `None`.
+        """
+
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        pending = {branch.connection: branch for branch in branches}
+
+        while pending:
+            timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            ready = wait(list(pending), timeout=timeout)
+
+            if not ready:
+                break
+
+            for connection in ready:
+                branch = pending.pop(connection)
+                try:
+                    branch.outputs = connection.recv()
+                    branch.passed = not self.is_failure(branch.calls, branch.outputs)
+                except (EOFError, OSError):
+                    # The process crashed
+                    branch.outputs = None
+                branch.done = True
+
+            # A later branch is used only once all the earlier ones failed
+            for branch in branches:
+                if not branch.done:
+                    break
+                if branch.passed:
+                    return branch
+
+        first = branches[0]
+        return first if first.done and first.outputs is not None else None
+
+    def report(self) -> str:
+        """
+        Get a human-readable report of the speculative steps.
+
+        :return: The report.
+        """
+
+        return (
+            f'Speculative steps: {self.stats["steps"]}, branches: {self.stats["branches"]},'
+            f' alternatives used: {self.stats["alternatives_used"]}, all failed: {self.stats["all_failed"]}'
+        )
@@ -1,6 +1,7 @@
-from typing import Dict
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-from vertexai.preview.generative_models import FunctionDeclaration, Tool
+if TYPE_CHECKING:
+    from vertexai.preview.generative_models import Tool
 
 
 class ToolInterface(object):
@@ -9,20 +10,51 @@ class ToolInterface(object):
     """
     name: str = 'tool-name'
     description: str = 'Description of the tool.'
-    function_declaration: FunctionDeclaration = None
+    # The declaration of the function as per Gemini's function calling: its name, description, and parameters.
+    # A plain dictionary, so that the tools can be loaded without importing Vertex AI.
+    function_declaration: Dict[str, Any] = None
+    # Whether the tool may run at the same time as other such tools working on different resources
+    concurrent_safe: bool = False
+    # Whether the tool keeps the workspace index up to date itself; otherwise, the index is refreshed after it is used
+    tracks_workspace: bool = False
+    # Whether a use of the tool changes nothing but the files of the working directory, so that it can be
+    # run in a copy of the directory, e.g., speculatively
+    sandboxed: bool = True
 
     @staticmethod
-    def get_tool() -> Tool:
+    def get_tool() -> 'Tool':
         """
         Get the tool as per Gemini's function calling.
 
         :return: The tool.
         """
 
+        from vertexai.preview.generative_models import FunctionDeclaration, Tool
+
         return Tool(
-            function_declarations=[ToolInterface.function_declaration],
+            function_declarations=[FunctionDeclaration(**ToolInterface.function_declaration)],
         )
 
+    @staticmethod
+    def configure(params: Dict[str, Any]):
+        """
+        Apply the tool's settings, found in the section of the settings file named after the tool.
+
+        :param params: The settings.
+        """
+
+    @staticmethod
+    def get_resource(params: Dict[str, str]) -> Optional[str]:
+        """
+        Get the file or directory that a use of this tool would work on.
+        Uses of concurrent-safe tools on unrelated resources are run concurrently.
+
+        :param params: The parameters to be used for function calling.
+        :return: The path of the resource, if any.
+        """
+
+        return None
+
     @staticmethod
     def use(params: Dict[str, str]) -> str:
         """
@@ -34,14 +66,34 @@ class ToolInterface(object):
 
         raise NotImplementedError('use() method not implemented')  # Implement in subclass
 
+    @staticmethod
+    def is_failure(output: str) -> bool:
+        """
+        Check whether the output of a use of this tool shows that something went wrong,
+        e.g., that a program crashed, so that the model will have to fix it.
+
+        :param output: The output of the tool's action.
+        :return: True if the use failed.
+        """
+
+        return output.startswith('* Error')
+
+    @staticmethod
+    def after_fork():
+        """
+        Drop any state that must not be shared with the parent process, e.g., open connections,
+        in a process forked to use the tool.
+        """
+
 
 class FinalAnswerTool(ToolInterface):
     name: str = 'FinalAnswerTool'
     description: str = 'Use this when you have the final answer available.'
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    tracks_workspace: bool = True
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'answer': {
@@ -49,7 +101,7 @@ class FinalAnswerTool(ToolInterface):
                 },
             },
         },
-    )
+    }
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
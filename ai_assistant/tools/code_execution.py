@@ -1,11 +1,16 @@
+import atexit
 import os
-import subprocess
 import sys
-from typing import Dict
+import threading
+from typing import Any, Dict, Optional
 
-from vertexai.preview.generative_models import FunctionDeclaration
 
+from ai_assistant.cache import LRUCache, hash_dir
 from ai_assistant.tools.base import ToolInterface
+from ai_assistant.tools.execution_limits import ExecutionLimits, run_process
+from ai_assistant.tools.import_check import MODULE_INDEX, find_missing_imports
+from ai_assistant.tools.warm_pool import WarmInterpreterPool
+from ai_assistant.tracing import trace
 
 
 class CodeExecutionTool(ToolInterface):
@@ -14,10 +19,20 @@ class CodeExecutionTool(ToolInterface):
         'Use only when you need to run Python program, identified with a file name.'
         ' The file must be existing in the filesystem or need to be created before execution.'
     )
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    # Outputs keyed on the interpreter, the program, and the contents of the files in its directory;
+    # disabled unless enabled in the settings, since a program may also depend on anything else,
+    # e.g., the files elsewhere, the network, the clock, or random numbers
+    cache: LRUCache = LRUCache('Execution', 0)
+    # Warm interpreters to run the programs in, if enabled
+    pool: Optional[WarmInterpreterPool] = None
+    # The time, CPU, memory, and output limits of every program
+    limits: ExecutionLimits = ExecutionLimits()
+    # Whether to check that the modules a program imports are installed before running it
+    check_imports: bool = True
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'file_name': {
@@ -29,7 +44,47 @@ class CodeExecutionTool(ToolInterface):
                 }
             },
         },
-    )
+    }
+
+    @staticmethod
+    def configure(params: Dict[str, Any]):
+        CodeExecutionTool.limits = ExecutionLimits(
+            timeout=params.get('timeout', 60.0),
+            cpu_time=params.get('cpu_time_limit', 0),
+            memory_mb=params.get('memory_limit_mb', 0),
+            max_output_chars=params.get('max_output_chars', 20000),
+        )
+        CodeExecutionTool.check_imports = params.get('import_check', True)
+
+        if CodeExecutionTool.check_imports:
+            # Let the installed modules be indexed while the model generates the code
+            threading.Thread(target=MODULE_INDEX.refresh, daemon=True).start()
+
+        if params.get('warm_pool', False) and WarmInterpreterPool.is_supported():
+            pool = CodeExecutionTool.pool
+            preload_modules, size = params.get('preload_modules', []), params.get('warm_pool_size', 2)
+
+            # A long-running process keeps its interpreters for all the sessions with the same settings
+            if pool is not None and pool.started and pool.preload_modules == preload_modules and pool.size == size:
+                return
+            if pool is not None:
+                pool.stop()
+
+            CodeExecutionTool.pool = WarmInterpreterPool(
+                params.get('preload_modules', []), params.get('warm_pool_size', 2)
+            )
+            # Let the interpreters preload the modules while the model generates the code
+            CodeExecutionTool.pool.start()
+            atexit.register(CodeExecutionTool.pool.stop)
+
+    @staticmethod
+    def is_failure(output: str) -> bool:
+        return not output.startswith('Status: Exit code 0')
+
+    @staticmethod
+    def after_fork():
+        # The warm interpreters belong to the parent process
+        CodeExecutionTool.pool = None
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
@@ -42,19 +97,53 @@ class CodeExecutionTool(ToolInterface):
             print(ex)
             cwd, file_name = None, input_text
 
+        if CodeExecutionTool.check_imports and input_text.endswith('.py') and os.path.isfile(input_text):
+            with trace('import_check', 'execution', file_name=input_text) as span:
+                missing = find_missing_imports(input_text)
+                span.set(missing=len(missing))
+
+            if missing:
+                # The program would fail at once anyway, so it is not started
+                return (
+                    'Status: Not run because of missing modules\n'
+                    'Errors:\n' + '\n'.join(
+                        f'ModuleNotFoundError: No module named \'{name}\' (imported in line {line} of {input_text})'
+                        for name, line in missing
+                    ) + '\nThese modules are not installed. Please change the program to use only the standard'
+                    ' library, the installed packages, and the modules in the working directory.'
+                )
+
+        # Running an unchanged program on unchanged inputs again gives the same output, if deterministic
+        key = None
+        if CodeExecutionTool.cache.max_size > 0 and os.path.isfile(input_text):
+            inputs = hash_dir(cwd or '.')
+            if inputs is not None:
+                key = (sys.executable, os.path.abspath(input_text), inputs)
+                output = CodeExecutionTool.cache.get(key)
+                if output is not None:
+                    return output
+
         try:
-            response = subprocess.run(
-                [sys.executable, file_name],
-                shell=False,
-                capture_output=True,
-                text=True,
-                cwd=cwd
-            )
+            result = None
+
+            if CodeExecutionTool.pool is not None:
+                with trace('warm', 'execution', file_name=input_text) as span:
+                    # Returns nothing if the interpreter crashed; try again with a new interpreter then
+                    result = CodeExecutionTool.pool.run(file_name, cwd, CodeExecutionTool.limits)
+                    span.set(exit_code=result.exit_code if result is not None else None)
+
+            if result is None:
+                with trace('cold', 'execution', file_name=input_text) as span:
+                    result = run_process([sys.executable, file_name], cwd, CodeExecutionTool.limits)
+                    span.set(exit_code=result.exit_code)
+
+            output = result.to_text()
 
-            if response.returncode != 0:
-                return response.stderr
+            # A program killed midway may well finish another time
+            if key is not None and not result.timed_out:
+                CodeExecutionTool.cache.put(key, output)
 
-            return response.stdout
+            return output
 
         except Exception as ex:
             return f'* Error:: Failed to run the program with file {file_name} because of the following error: {ex}'
@@ -0,0 +1,244 @@
+import io
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from ai_assistant.cache import LRUCache, fingerprint_dir, hash_text
+from ai_assistant.tracing import trace
+
+if TYPE_CHECKING:
+    from pylint.lint import PyLinter
+
+
+class PythonLinter(object):
+    """
+    A fast static check of Python code. The code is first compiled, which catches syntax errors
+    in microseconds. Only syntactically valid code is then checked with Pylint, using a single,
+    long-lived Pylint instance so that Pylint's setup and its analysis of the imported modules
+    are not repeated for every file.
+    """
+
+    # Pylint keeps global state, so only one file can be linted at a time
+    lock = threading.Lock()
+    linter: Optional['PyLinter'] = None
+    # The size and modification time of every workspace module Astroid has parsed, when last linted
+    module_stamps: Dict[str, Tuple[int, int]] = {}
+    # Results keyed on the file, its content, and the state of the other modules it may import
+    cache: LRUCache = LRUCache('Lint', 128)
+
+    @staticmethod
+    def check_syntax(code: str, file_name: str) -> Optional[SyntaxError]:
+        """
+        Compile the code to find any syntax error.
+
+        :param code: The code.
+        :param file_name: The name of the file containing the code.
+        :return: The syntax error, if any.
+        """
+
+        try:
+            compile(code, file_name, 'exec', dont_inherit=True)
+        except SyntaxError as se:
+            return se
+        except ValueError as ve:  # Null bytes in the source
+            return SyntaxError(str(ve), (file_name, 1, 0, ''))
+
+        return None
+
+    @staticmethod
+    def format_syntax_error(file_name: str, error: SyntaxError) -> str:
+        """
+        Format a syntax error like Pylint does.
+
+        :param file_name: The name of the file.
+        :param error: The syntax error.
+        :return: The formatted error.
+        """
+
+        module_name = os.path.splitext(os.path.basename(file_name))[0]
+        return (
+            f'************* Module {module_name}\n'
+            f'{file_name}:{error.lineno or 1}:{error.offset or 0}: E0001:'
+            f' Parsing failed: \'{error.msg} (<unknown>, line {error.lineno or 1})\' (syntax-error)'
+        )
+
+    @staticmethod
+    def is_unterminated_literal(error: Optional[SyntaxError]) -> bool:
+        return (
+            error is not None
+            and bool(error.lineno)
+            and any(msg in error.msg for msg in ('unterminated string literal', 'EOL while scanning'))
+        )
+
+    @staticmethod
+    def fix_unterminated_string_literals(code: str, file_name: str) -> Tuple[str, int]:
+        """
+        Fix all unterminated string literal errors, which typically arise when a `\\n` escape
+        sequence in a string is decoded into an actual newline. Each such newline is replaced
+        with the `\\n` escape sequence. The code is fixed in memory, so that the file is written
+        only once. A literal that does not end even when joined with all the lines after it is left
+        as it is.
+
+        :param code: The code.
+        :param file_name: The name of the file containing the code.
+        :return: The fixed code and the number of fixes made.
+        """
+
+        num_fixes = 0
+        lines = code.split('\n')
+        error = PythonLinter.check_syntax(code, file_name)
+
+        while PythonLinter.is_unterminated_literal(error) and error.lineno < len(lines):
+            # Join the line with the next ones until the literal ends; a literal may span several lines
+            lineno = error.lineno
+            fixed_lines, num_joins = list(lines), 0
+
+            while (
+                    PythonLinter.is_unterminated_literal(error)
+                    and error.lineno == lineno
+                    and lineno < len(fixed_lines)
+            ):
+                fixed_lines[lineno - 1] = fixed_lines[lineno - 1] + '\\n' + fixed_lines[lineno]
+                del fixed_lines[lineno]
+                num_joins += 1
+                error = PythonLinter.check_syntax('\n'.join(fixed_lines), file_name)
+
+            if PythonLinter.is_unterminated_literal(error) and error.lineno == lineno:
+                # The literal never ends, so the newlines were not the cause: keep the fixes made so far
+                break
+
+            lines = fixed_lines
+            code = '\n'.join(lines)
+            num_fixes += num_joins
+
+        return code, num_fixes
+
+    @staticmethod
+    def get_workspace_modules(astroid_cache: dict, file_name: str) -> Dict[str, str]:
+        """
+        Find the modules parsed by Astroid that are in the directory of a file, i.e., in the workspace.
+
+        :param astroid_cache: The modules parsed, keyed by their names.
+        :param file_name: The file linted.
+        :return: The path of every such module, keyed by its name.
+        """
+
+        root = os.path.dirname(os.path.abspath(file_name)) + os.sep
+        modules = {}
+
+        for module_name, module in list(astroid_cache.items()):
+            path = os.path.abspath(module.file) if getattr(module, 'file', None) else None
+            if path is not None and path.startswith(root):
+                modules[module_name] = path
+
+        return modules
+
+    @staticmethod
+    def get_stamp(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def drop_stale_modules(astroid_cache: dict, file_name: str):
+        """
+        Drop the file linted from the modules parsed by Astroid, along with every workspace module
+        changed since it was parsed, so that the errors reported about their use are not stale.
+        """
+
+        path = os.path.abspath(file_name)
+
+        for module_name, module_path in PythonLinter.get_workspace_modules(astroid_cache, file_name).items():
+            if (
+                    module_path == path
+                    or PythonLinter.module_stamps.get(module_path) != PythonLinter.get_stamp(module_path)
+            ):
+                del astroid_cache[module_name]
+
+    @staticmethod
+    def record_modules(astroid_cache: dict, file_name: str):
+        """
+        Record the size and modification time of the workspace modules parsed by Astroid.
+        """
+
+        PythonLinter.module_stamps = {
+            module_path: PythonLinter.get_stamp(module_path)
+            for module_path in PythonLinter.get_workspace_modules(astroid_cache, file_name).values()
+        }
+
+    @staticmethod
+    def run_pylint(file_name: str) -> str:
+        """
+        Run Pylint on a .py file, showing only the errors.
+
+        :param file_name: The source file name.
+        :return: The result of Pylint scan.
+        """
+
+        # Pylint takes a while to import, so it is imported only when the first file is linted
+        from astroid import MANAGER
+        from pylint.lint import Run
+        from pylint.reporters.text import TextReporter
+
+        pylint_output = io.StringIO()
+        reporter = TextReporter(pylint_output)
+
+        with PythonLinter.lock:
+            if PythonLinter.linter is None:
+                run = Run(['--errors-only', file_name], reporter=reporter, exit=False)
+                PythonLinter.linter = run.linter
+                PythonLinter.record_modules(MANAGER.astroid_cache, file_name)
+                return pylint_output.getvalue()
+
+            # Astroid caches the parsed modules; drop this file and every workspace module changed since
+            PythonLinter.drop_stale_modules(MANAGER.astroid_cache, file_name)
+
+            try:
+                PythonLinter.linter.set_reporter(reporter)
+                PythonLinter.linter.check([file_name])
+                PythonLinter.linter.generate_reports()
+            except Exception:
+                # Start afresh with a new instance
+                pylint_output = io.StringIO()
+                run = Run(['--errors-only', file_name], reporter=TextReporter(pylint_output), exit=False)
+                PythonLinter.linter = run.linter
+            finally:
+                PythonLinter.record_modules(MANAGER.astroid_cache, file_name)
+
+        return pylint_output.getvalue()
+
+    @staticmethod
+    def lint(file_name: str, code: str) -> str:
+        """
+        Check the code of a .py file for errors.
+
+        :param file_name: The source file name.
+        :param code: The current content of the file.
+        :return: The errors found, if any.
+        """
+
+        with trace('compile', 'lint'):
+            error = PythonLinter.check_syntax(code, file_name)
+        if error is not None:
+            return PythonLinter.format_syntax_error(file_name, error)
+
+        path = os.path.abspath(file_name)
+        modules = fingerprint_dir(os.path.dirname(path), extension='.py')
+        key = None
+
+        if modules is not None:
+            key = (path, hash_text(code), tuple(entry for entry in modules if entry[0] != path))
+            result = PythonLinter.cache.get(key)
+            if result is not None:
+                return result
+
+        with trace('pylint', 'lint', file_name=file_name):
+            result = PythonLinter.run_pylint(file_name)
+
+        if key is not None:
+            PythonLinter.cache.put(key, result)
+
+        return result
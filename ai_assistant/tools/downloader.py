@@ -0,0 +1,469 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from ai_assistant.tracing import trace
+
+if TYPE_CHECKING:
+    import requests
+
+
+class DownloadError(Exception):
+    """
+    Raised when a file could not be downloaded completely and correctly.
+    """
+
+
+class RemoteFileChangedError(DownloadError):
+    """
+    Raised when the file changed on the server since a partial download of it, which must then
+    be started over.
+    """
+
+
+class DownloadResult(object):
+    """
+    The outcome of a download.
+    """
+
+    def __init__(
+            self,
+            file_name: str,
+            size: int,
+            duration: float,
+            resumed_bytes: int = 0,
+            parts: int = 1,
+            up_to_date: bool = False
+    ):
+        """
+        :param file_name: The file saved.
+        :param size: The size of the file, in bytes.
+        :param duration: The time taken, in seconds.
+        :param resumed_bytes: The number of bytes already downloaded earlier.
+        :param parts: The number of ranges fetched at the same time.
+        :param up_to_date: Whether the file already existed with the expected hash.
+        """
+
+        self.file_name = file_name
+        self.size = size
+        self.duration = duration
+        self.resumed_bytes = resumed_bytes
+        self.parts = parts
+        self.up_to_date = up_to_date
+
+    def to_text(self) -> str:
+        if self.up_to_date:
+            return f'{self.file_name} ({self.size} bytes, already downloaded)'
+
+        details = [f'{self.size} bytes in {self.duration:.2f} s']
+        if self.parts > 1:
+            details.append(f'{self.parts} parts in parallel')
+        if self.resumed_bytes:
+            details.append(f'resumed after {self.resumed_bytes} bytes')
+
+        return f'{self.file_name} ({", ".join(details)})'
+
+
+def get_file_sha256(file_name: str, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+
+    with open(file_name, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(chunk_size), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def parse_content_range(value: str) -> Optional[int]:
+    """
+    Get the total size from a `Content-Range` header, e.g., `bytes 0-1023/4096`.
+
+    :param value: The header value.
+    :return: The total size, if known.
+    """
+
+    try:
+        total = value.rsplit('/', 1)[1]
+        return int(total) if total != '*' else None
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_content_range_start(value: str) -> Optional[int]:
+    """
+    Get the first byte from a `Content-Range` header, e.g., `bytes 0-1023/4096`.
+
+    :param value: The header value.
+    :return: The first byte, if any.
+    """
+
+    try:
+        return int(value.split()[1].split('-', 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def get_validator(response: 'requests.Response') -> Optional[str]:
+    """
+    Get the validator of a response, which tells whether the file changed since: the ETag, or
+    otherwise the modification time. A weak ETag cannot be used in `If-Range`, so it is ignored.
+
+    :param response: The response.
+    :return: The validator, if any.
+    """
+
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return response.headers.get('Last-Modified')
+
+
+class Downloader(object):
+    """
+    Download files over a shared, pooled HTTP session. The response bodies are streamed to disk
+    in large chunks. Downloads go to a `.part` file that is renamed when complete, so that an
+    interrupted download is resumed with an HTTP range request rather than started over. The
+    request is conditional on the file's ETag or modification time when first downloaded, with
+    `If-Range`, so that a file changed since is started over rather than spliced onto the old
+    bytes. Large files are fetched in several ranges at once if the server supports them.
+    """
+
+    def __init__(
+            self,
+            timeout: float = 15.0,
+            chunk_size: int = 1024 * 1024,
+            max_parts: int = 4,
+            part_size: int = 8 * 1024 * 1024,
+            max_connections: int = 16
+    ):
+        """
+        :param timeout: The connect and read timeout of every request, in seconds.
+        :param chunk_size: The size of the chunks written to disk, in bytes.
+        :param max_parts: The maximum number of ranges of a file fetched at the same time;
+         one to always download sequentially.
+        :param part_size: The size of each range, in bytes. Files up to this size are downloaded
+         sequentially.
+        :param max_connections: The maximum number of connections kept open per host.
+        """
+
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_parts = max_parts
+        self.part_size = part_size
+        self.max_connections = max_connections
+        self._session: Optional['requests.Session'] = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> 'requests.Session':
+        """
+        The HTTP session, whose connections are reused across requests and downloads.
+        Requests is imported only when the first download starts.
+        """
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            if self._session is None:
+                adapter = HTTPAdapter(pool_connections=self.max_connections, pool_maxsize=self.max_connections)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+
+        return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def after_fork(self):
+        # The connections belong to the parent process; closing them here would close them for it too
+        self._session = None
+        self._lock = threading.Lock()
+
+    def get(
+            self,
+            url: str,
+            start: int = 0,
+            end: Optional[int] = None,
+            validator: Optional[str] = None
+    ) -> 'requests.Response':
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = f'bytes={start}-{"" if end is None else end}'
+            if validator:
+                # The range only if the file is unchanged; the whole file otherwise
+                headers['If-Range'] = validator
+
+        return self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+
+    def write_body(self, response: 'requests.Response', out_file: Any, max_bytes: Optional[int] = None) -> int:
+        """
+        Stream a response body to a file.
+
+        :param response: The response.
+        :param out_file: The file, opened in binary mode and positioned where the body goes.
+        :param max_bytes: The number of bytes expected, if known; any more are an error.
+        :return: The number of bytes written.
+        """
+
+        written = 0
+
+        with response:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                written += len(chunk)
+
+                if max_bytes is not None and written > max_bytes:
+                    raise DownloadError(f'The server sent more than the {max_bytes} bytes requested')
+
+                out_file.write(chunk)
+
+        return written
+
+    @staticmethod
+    def check_status(response: 'requests.Response', url: str):
+        if response.status_code not in (200, 206):
+            response.close()
+            raise DownloadError(f'Failed to download file {url}. HTTP response code: {response.status_code}')
+
+    def download(self, url: str, file_name: str, sha256: Optional[str] = None) -> DownloadResult:
+        """
+        Download a file, resuming any earlier, interrupted download of it.
+
+        :param url: The URL of the file.
+        :param file_name: The file to save it as.
+        :param sha256: The expected SHA-256 hash of the file, if known.
+        :return: The outcome.
+        :raises DownloadError: If the download failed or the file does not match the hash.
+        """
+
+        start_time = time.perf_counter()
+        sha256 = sha256.strip().lower() if sha256 else None
+
+        if sha256 and os.path.isfile(file_name) and get_file_sha256(file_name) == sha256:
+            return DownloadResult(
+                file_name, os.path.getsize(file_name), time.perf_counter() - start_time, up_to_date=True
+            )
+
+        part_file = file_name + '.part'
+        state_file = part_file + '.json'
+        validator_file = part_file + '.validator'
+
+        with trace('download', 'network', url=url) as span:
+            try:
+                if os.path.exists(state_file):
+                    size, resumed_bytes, parts = self.download_parts(url, part_file, state_file)
+                else:
+                    size, resumed_bytes, parts = self.download_sequentially(url, part_file, state_file)
+            except RemoteFileChangedError:
+                # Start over, once
+                for name in (part_file, state_file, validator_file):
+                    if os.path.exists(name):
+                        os.remove(name)
+                size, resumed_bytes, parts = self.download_sequentially(url, part_file, state_file)
+            span.set(size=size, parts=parts)
+
+        if os.path.exists(validator_file):
+            os.remove(validator_file)
+
+        if sha256 and get_file_sha256(part_file) != sha256:
+            os.remove(part_file)
+            raise DownloadError(f'The file downloaded from {url} does not match the expected SHA-256 hash')
+
+        os.replace(part_file, file_name)
+        return DownloadResult(file_name, size, time.perf_counter() - start_time, resumed_bytes, parts)
+
+    def download_sequentially(self, url: str, part_file: str, state_file: str) -> Tuple[int, int, int]:
+        """
+        Download a file in a single request, continuing from any partial download. If the file
+        turns out to be large and the server supports ranges, switch to `download_parts`.
+
+        :return: The size of the file, the number of bytes resumed from, and the number of parts.
+        """
+
+        validator_file = part_file + '.validator'
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        validator = None
+
+        if offset:
+            try:
+                with open(validator_file, 'r', encoding='utf-8') as in_file:
+                    validator = in_file.read().strip() or None
+            except OSError:
+                pass
+
+            # Without a validator, nothing tells whether the file changed since: start over
+            if validator is None:
+                offset = 0
+
+        if offset == 0 and self.max_parts > 1:
+            # Ask only for the first part: the response tells whether ranges are supported,
+            # and the total size, without a separate HEAD request
+            response = self.get(url, 0, self.part_size - 1)
+        else:
+            response = self.get(url, offset, validator=validator)
+
+        if response.status_code == 416:
+            # Already complete if the partial file is as large as the whole; an empty file also
+            # has no satisfiable range
+            response.close()
+            if offset and parse_content_range(response.headers.get('Content-Range', '')) == offset:
+                return offset, offset, 1
+
+            offset = 0
+            response = self.get(url)
+
+        Downloader.check_status(response, url)
+        total = None
+
+        if response.status_code == 206:
+            content_range = response.headers.get('Content-Range', '')
+
+            if parse_content_range_start(content_range) != offset:
+                # Not the range asked for: start over with the whole file
+                response.close()
+                offset = 0
+                response = self.get(url)
+                Downloader.check_status(response, url)
+            else:
+                total = parse_content_range(content_range)
+
+        if response.status_code != 206:
+            # The server ignored the range, or the file changed since: start over
+            offset = 0
+
+        if offset == 0:
+            validator = get_validator(response)
+
+            if total is not None and total > self.part_size:
+                self.start_parts(part_file, state_file, total, validator)
+                return self.download_parts(url, part_file, state_file, first_response=response)
+
+            if validator is not None:
+                with open(validator_file, 'w', encoding='utf-8') as out_file:
+                    out_file.write(validator)
+
+        with open(part_file, 'ab' if offset else 'wb') as out_file:
+            written = self.write_body(response, out_file)
+
+        size = offset + written
+        if total is not None and size != total:
+            raise DownloadError(f'The download of {url} ended after {size} of {total} bytes')
+
+        return size, offset, 1
+
+    def start_parts(self, part_file: str, state_file: str, total: int, validator: Optional[str]):
+        with open(part_file, 'wb') as out_file:
+            out_file.truncate(total)
+
+        ranges = [[start, min(start + self.part_size, total) - 1] for start in range(0, total, self.part_size)]
+        Downloader.save_state(state_file, {'total': total, 'pending': ranges, 'validator': validator})
+
+    @staticmethod
+    def save_state(state_file: str, state: Dict[str, Any]):
+        with open(state_file + '.tmp', 'w', encoding='utf-8') as out_file:
+            json.dump(state, out_file)
+
+        os.replace(state_file + '.tmp', state_file)
+
+    def download_parts(
+            self,
+            url: str,
+            part_file: str,
+            state_file: str,
+            first_response: 'requests.Response' = None
+    ) -> Tuple[int, int, int]:
+        """
+        Download the pending ranges of a file at the same time, each into its place in the
+        preallocated partial file. The ranges still pending are kept in a state file, so that
+        an interrupted download fetches only those again.
+
+        :param first_response: The response to the first range, if already requested.
+        :return: The size of the file, the number of bytes resumed from, and the number of parts.
+        :raises RemoteFileChangedError: If the file changed since the earlier ranges were fetched.
+        """
+
+        with open(state_file, 'r', encoding='utf-8') as in_file:
+            state = json.load(in_file)
+
+        validator = state.get('validator')
+        if validator is None and first_response is None:
+            # Nothing tells whether the ranges fetched earlier are of the same file
+            raise RemoteFileChangedError(f'The partial download of {url} cannot be resumed')
+
+        total = state['total']
+        pending: List[List[int]] = state['pending']
+        resumed_bytes = total - sum(end - start + 1 for start, end in pending)
+        lock = threading.Lock()
+
+        def fetch(byte_range: List[int], response: 'requests.Response' = None):
+            start, end = byte_range
+            if response is None:
+                response = self.get(url, start, end, validator=validator)
+                Downloader.check_status(response, url)
+
+            if (
+                    response.status_code != 206
+                    or parse_content_range_start(response.headers.get('Content-Range', '')) != start
+                    or parse_content_range(response.headers.get('Content-Range', '')) != total
+            ):
+                # The whole file instead of the range, since it changed, or another range
+                response.close()
+                raise RemoteFileChangedError(f'The file at {url} changed during the download')
+
+            with open(part_file, 'r+b') as out_file:
+                out_file.seek(start)
+                written = self.write_body(response, out_file, end - start + 1)
+
+            if written != end - start + 1:
+                raise DownloadError(f'The download of {url} ended early, at {start + written} of {total} bytes')
+
+            with lock:
+                state['pending'] = [item for item in state['pending'] if item != byte_range]
+                Downloader.save_state(state_file, state)
+
+        with ThreadPoolExecutor(max_workers=self.max_parts) as executor:
+            futures = [
+                executor.submit(fetch, byte_range, first_response if num == 0 and first_response else None)
+                for num, byte_range in enumerate(list(pending))
+            ]
+
+            # Raise the first error, if any, after all ranges have finished
+            for future in [future for future in futures if future.exception() is not None]:
+                raise future.exception()
+
+        os.remove(state_file)
+        return total, resumed_bytes, len(futures)
+
+    def download_all(
+            self,
+            files: List[Tuple[str, str, Optional[str]]],
+            max_workers: int = 4
+    ) -> List[Any]:
+        """
+        Download several files at the same time over the shared session.
+
+        :param files: The URL, the file name, and the expected SHA-256 hash, if any, of each file.
+        :param max_workers: The maximum number of files downloaded at the same time.
+        :return: The outcome of each download, either a `DownloadResult` or the error, in order.
+        """
+
+        import requests
+
+        def download_one(url: str, file_name: str, sha256: Optional[str]) -> Any:
+            try:
+                return self.download(url, file_name, sha256)
+            except (DownloadError, requests.RequestException, OSError) as ex:
+                return ex
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+            return list(executor.map(lambda args: download_one(*args), files))
@@ -0,0 +1,318 @@
+import collections
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class ExecutionLimits(object):
+    """
+    The resources a program may use. A value of zero means no limit.
+    """
+
+    def __init__(
+            self,
+            timeout: float = 60.0,
+            cpu_time: int = 0,
+            memory_mb: int = 0,
+            max_output_chars: int = 20000
+    ):
+        """
+        :param timeout: The maximum wall-clock time, in seconds, after which the program is killed.
+        :param cpu_time: The maximum CPU time, in seconds.
+        :param memory_mb: The maximum size of the program's address space, in MB.
+        :param max_output_chars: The maximum number of characters kept from each of the standard
+         output and error; the middle of a longer output is dropped.
+        """
+
+        self.timeout = timeout
+        self.cpu_time = cpu_time
+        self.memory_mb = memory_mb
+        self.max_output_chars = max_output_chars
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'timeout': self.timeout,
+            'cpu_time': self.cpu_time,
+            'memory_mb': self.memory_mb,
+            'max_output_chars': self.max_output_chars,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'ExecutionLimits':
+        return ExecutionLimits(**data)
+
+    def apply(self, pid: int = 0):
+        """
+        Apply the CPU time and memory limits to a process.
+
+        :param pid: The process; the current process by default.
+        """
+
+        if resource is None:
+            return
+
+        limits = []
+        if self.cpu_time:
+            # The program gets SIGXCPU at the soft limit
+            limits.append((resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time + 1)))
+        if self.memory_mb:
+            memory = self.memory_mb * 1024 * 1024
+            limits.append((resource.RLIMIT_AS, (memory, memory)))
+
+        for limit, values in limits:
+            if pid:
+                resource.prlimit(pid, limit, values)
+            else:
+                resource.setrlimit(limit, values)
+
+
+class BoundedOutput(object):
+    """
+    Capture a stream of bytes in bounded memory. The beginning of the stream is kept as is,
+    and a ring buffer keeps its most recent end; anything in between is dropped.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.head_size = max_bytes // 2
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.tail_max = max_bytes - self.head_size
+        self.total = 0
+
+    def write(self, data: bytes):
+        self.total += len(data)
+
+        if len(self.head) < self.head_size:
+            room = self.head_size - len(self.head)
+            self.head.extend(data[:room])
+            data = data[room:]
+
+        if data:
+            self.tail.append(data)
+            self.tail_size += len(data)
+
+            while self.tail and self.tail_size - len(self.tail[0]) >= self.tail_max:
+                self.tail_size -= len(self.tail.popleft())
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > len(self.head) + min(self.tail_size, self.tail_max)
+
+    def getvalue(self) -> str:
+        tail = b''.join(self.tail)
+        tail = tail[len(tail) - min(len(tail), self.tail_max):]
+
+        if not self.truncated:
+            return (bytes(self.head) + tail).decode('utf-8', errors='replace')
+
+        dropped = self.total - len(self.head) - len(tail)
+        return (
+            bytes(self.head).decode('utf-8', errors='replace')
+            + f'\n... [{dropped} bytes truncated] ...\n'
+            + tail.decode('utf-8', errors='replace')
+        )
+
+
+def read_bounded_file(file_name: str, max_bytes: int) -> BoundedOutput:
+    """
+    Read a file that may be very large into bounded memory, keeping only its head and tail.
+
+    :param file_name: The file.
+    :param max_bytes: The maximum number of bytes to keep.
+    :return: The captured content.
+    """
+
+    output = BoundedOutput(max_bytes)
+
+    with open(file_name, 'rb') as in_file:
+        size = os.fstat(in_file.fileno()).st_size
+        output.write(in_file.read(output.head_size))
+
+        if size > max_bytes:
+            output.total = size - output.tail_max
+            in_file.seek(size - output.tail_max)
+
+        output.write(in_file.read())
+
+    return output
+
+
+def to_kb(max_rss: int) -> Optional[int]:
+    """
+    Get the peak resident set size of a child process in KB, if it can be told apart from that
+    of its parent. A child inherits the peak of its parent when forked, so a peak that does not
+    exceed the parent's own says nothing about the child.
+
+    :param max_rss: The `ru_maxrss` of the child, as reported by `wait4`.
+    :return: The peak in KB, or `None`.
+    """
+
+    if max_rss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+
+    # macOS reports the peak resident set size in bytes, others in KB
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+class ExecutionResult(object):
+    """
+    The outcome of running a program.
+    """
+
+    def __init__(
+            self,
+            exit_code: int,
+            stdout: str,
+            stderr: str,
+            duration: float,
+            max_rss_kb: Optional[int] = None,
+            truncated: bool = False,
+            timed_out: bool = False
+    ):
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.max_rss_kb = max_rss_kb
+        self.truncated = truncated
+        self.timed_out = timed_out
+
+    def to_text(self) -> str:
+        """
+        Describe the outcome for the model.
+
+        :return: The description.
+        """
+
+        if self.timed_out:
+            status = 'Killed after exceeding the time limit'
+        elif self.exit_code < 0 and -self.exit_code == getattr(signal, 'SIGXCPU', None):
+            status = 'Killed after exceeding the CPU time limit'
+        elif self.exit_code < 0:
+            status = f'Killed by signal {-self.exit_code}'
+        else:
+            status = f'Exit code {self.exit_code}'
+
+        lines = [
+            f'Status: {status}',
+            f'Duration: {self.duration:.2f} s',
+        ]
+        if self.max_rss_kb is not None:
+            lines.append(f'Peak memory: {self.max_rss_kb / 1024:.1f} MB')
+        if self.truncated:
+            lines.append('Output truncated: yes (only the beginning and the end are shown)')
+
+        lines.append(f'Output:\n{self.stdout}')
+        if self.stderr:
+            lines.append(f'Errors:\n{self.stderr}')
+
+        return '\n'.join(lines)
+
+
+def kill_process_group(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_process(args: List[str], cwd: Optional[str], limits: ExecutionLimits) -> ExecutionResult:
+    """
+    Run a program in a new process within the limits, streaming its output into bounded buffers.
+
+    :param args: The command.
+    :param cwd: The working directory.
+    :param limits: The limits.
+    :return: The outcome.
+    """
+
+    posix = os.name == 'posix'
+    # Where possible, avoid `preexec_fn`, which is unsafe when other threads are running
+    use_prlimit = posix and hasattr(resource, 'prlimit')
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        args,
+        shell=False,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        preexec_fn=limits.apply if posix and not use_prlimit else None,
+        # Put the program and anything it starts into a new process group to kill them all at once
+        start_new_session=posix,
+    )
+
+    if use_prlimit:
+        try:
+            limits.apply(process.pid)
+        except ProcessLookupError:  # Already finished
+            pass
+
+    max_bytes = limits.max_output_chars or sys.maxsize
+    outputs = [BoundedOutput(max_bytes), BoundedOutput(max_bytes)]
+
+    def pump(stream, output: BoundedOutput):
+        for chunk in iter(lambda: stream.read1(65536), b''):
+            output.write(chunk)
+
+    readers = [
+        threading.Thread(target=pump, args=(stream, output), daemon=True)
+        for stream, output in zip((process.stdout, process.stderr), outputs)
+    ]
+    for reader in readers:
+        reader.start()
+
+    timed_out = False
+    max_rss_kb = None
+
+    if posix:
+        # Reap the process with `wait4` to get the resources used by this very process
+        exit_status = {}
+
+        def reap():
+            _, status, usage = os.wait4(process.pid, 0)
+            exit_status['code'] = os.waitstatus_to_exitcode(status)
+            exit_status['max_rss'] = usage.ru_maxrss
+
+        reaper = threading.Thread(target=reap, daemon=True)
+        reaper.start()
+        reaper.join(timeout=limits.timeout or None)
+
+        if reaper.is_alive():
+            timed_out = True
+            kill_process_group(process.pid)
+            reaper.join()
+
+        process.returncode = exit_status['code']
+        max_rss_kb = to_kb(exit_status['max_rss'])
+        # Any processes left behind by the program would keep the pipes open
+        kill_process_group(process.pid)
+    else:
+        try:
+            process.wait(timeout=limits.timeout or None)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            process.kill()
+            process.wait()
+
+    for reader in readers:
+        reader.join()
+
+    return ExecutionResult(
+        exit_code=process.returncode,
+        stdout=outputs[0].getvalue(),
+        stderr=outputs[1].getvalue(),
+        duration=time.perf_counter() - start_time,
+        max_rss_kb=max_rss_kb,
+        truncated=outputs[0].truncated or outputs[1].truncated,
+        timed_out=timed_out,
+    )
@@ -1,26 +1,36 @@
-import codecs
-import io
+import itertools
 import os
-import re
 
-from typing import Dict
-from pylint.lint import Run
-from pylint.reporters.text import TextReporter
-from vertexai.preview.generative_models import FunctionDeclaration
+from typing import Any, Dict, Optional
 
 from ai_assistant.tools.base import ToolInterface
+from ai_assistant.tools.code_lint import PythonLinter
+from ai_assistant.tools.normalizer import normalize_content
+from ai_assistant.tools.paging import describe_entry, format_size, iter_entries, read_bytes, read_lines
+from ai_assistant.tools.patching import (
+    PatchError,
+    apply_unified_diff,
+    atomic_write,
+    filter_lint_messages,
+    number_lines,
+    replace_lines,
+)
+from ai_assistant.workspace import WORKSPACE
 
 
 class WriteFileTool(ToolInterface):
     name: str = 'WriteFileTool'
     description: str = (
-        'Use only when you need to create, write, or append to a file with a given name and content.'
+        'Use only when you need to create, write, append to, or change a part of a file with a given name and content.'
+        ' To fix a few lines of an existing file, change only those lines instead of writing the whole file again.'
         ' Returns the file writing status. In case of .py files, it also returns Pylint errors if found.'
     )
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    concurrent_safe: bool = True
+    tracks_workspace: bool = True
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'file_name': {
@@ -31,101 +41,33 @@ class WriteFileTool(ToolInterface):
                 },
                 'file_write_mode': {
                     'type': 'string',
-                    'description': 'File writing modes: `w` for write; `a` for append'
-                }
+                    'description': (
+                        'File writing modes: `w` for write; `a` for append;'
+                        ' `r` to replace the lines from `start_line` to `end_line` with the content;'
+                        ' `p` to apply the content as a unified diff patch'
+                    )
+                },
+                'start_line': {
+                    'type': 'integer', 'description': 'The first line to replace in the `r` mode, starting from 1'
+                },
+                'end_line': {
+                    'type': 'integer',
+                    'description': (
+                        'The last line to replace in the `r` mode;'
+                        ' one less than `start_line` to insert the content before `start_line`'
+                    )
+                },
             },
         },
-    )
+    }
 
     @staticmethod
-    def fix_fstring_expressions(content) -> str:
-        """
-        Try and fix potential mismatch in quotes inside f-strings.
-        Courtesy: Bing Copilot
-
-        :param content: The code.
-        :return: The code with f-strings fixed.
-        """
-
-        # Regular expression pattern to match f-string expressions
-        pattern = r"f'{.*?}'|f\"{.*?}\""
-
-        # Function to replace single quotes with double quotes in f-string expressions
-        def replacer(match):
-            s = match.group(0)
-            if s.startswith("f'"):
-                # Replace single quotes with double quotes and escape existing double quotes
-                print('Replacing 1:', 'f"' + s[2:-1].replace('"', '\\"') + '"')
-                return 'f"' + s[2:-1].replace('"', '\\"') + '"'
-            # Else
-            # Replace double quotes with single quotes and escape existing single quotes
-            print('Replacing 2:', "f'" + s[2:-1].replace("'", "\\'") + "'")
-            return "f'" + s[2:-1].replace("'", "\\'") + "'"
-
-        # Replace f-string expressions in the content
-        return re.sub(pattern, replacer, content)
+    def get_resource(params: Dict[str, str]) -> Optional[str]:
+        return params.get('file_name', '').strip() or None
 
     @staticmethod
-    def decode_until_no_escaped_newlines(text) -> str:
-        """
-        Perform repeated unicode decoding to potentially handle long escape sequences.
-        This usually works but sometimes may break source code.
-
-        :param text: The text.
-        :return: The text with escape sequences decoded.
-        """
-
-        # This pattern matches an escaped newline sequence that is not preceded by a backslash
-        # pattern = re.compile(r'(?<!\\)\\n')
-        #
-        # while re.search(pattern, text):
-        #     text = codecs.decode(text, 'unicode_escape')
-
-        old_text = text
-
-        # Try at most 10 times -- even a lower value should be sufficient
-        for _ in range(10):
-            text = codecs.decode(text, 'unicode_escape')
-            if text == old_text:
-                break
-            old_text = text
-
-        return text
-
-    @staticmethod
-    def run_code_lint(file_name: str) -> str:
-        """
-        Run Pylint on a .py file.
-
-        :param file_name: The source file name.
-        :return: The result of Pylint scan.
-        """
-
-        pylint_output = io.StringIO()
-        reporter = TextReporter(pylint_output)
-        Run(['--errors-only', file_name], reporter=reporter, exit=False)
-        result = pylint_output.getvalue()
-        return result
-
-    @staticmethod
-    def fix_unterminated_string_literal(file_name: str, line_number: int, col_number: int):
-        """
-        Try to fix the unterminated string literal error from Pylint
-        by replacing a newline with the \\n escape sequence.
-
-        :param file_name: The file to fix.
-        :param line_number: The line number in error.
-        :param col_number: The character position in the line.
-        """
-
-        with open(file_name, 'r+', encoding='utf-8') as in_file:
-            lines = in_file.readlines()
-            lines[line_number - 1] = (
-                    lines[line_number - 1][:col_number] + '\\n' + lines[line_number - 1][col_number + 1:]
-            )
-            in_file.seek(0)
-            in_file.writelines(lines)
-            in_file.truncate()
+    def is_failure(output: str) -> bool:
+        return output.startswith('* Error') or 'Pylint throws the following error' in output
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
@@ -146,31 +88,38 @@ class WriteFileTool(ToolInterface):
             )
 
         file_name = params['file_name'].strip()
-        content = params['content'].strip()
         mode = params['file_write_mode'].strip()
+        # The indentation of the first line matters when changing a part of a file
+        content = params['content'].rstrip() if mode in ('r', 'p') else params['content'].strip()
         file_extension = file_name.split('.')[-1]
 
         # The problem:
         # Gemini may generate content with arbitrary number of escape sequences, e.g., \\\\n
         # These lead to syntax error in code. Such code cannot be executed.
-        # The idea here is to decode all escape sequences until any is left.
-        # This usually works but can lead to another problem: when a string contains
-        # a newline literal ('\n'), it can get replaced with an actual newline, which
-        # again would lead to syntax error. At this point the applications asks Gemini
-        # to regenerate correct code or hopes the user would fix it!
-        # The `decode_until_no_escaped_newlines` with regex-based implementation is generated by Bing Copilot.
-        # Said implementation has been replaced with a finite loop.
-        # TODO: Investigate this problem again in the future for a hopefully better solution
-        content = WriteFileTool.decode_until_no_escaped_newlines(content)
-
-        if file_extension and file_extension == 'py':
-            content = WriteFileTool.fix_fstring_expressions(content)
-
-        if mode not in ('w', 'a'):
+        # Decoding all escape sequences until none is left also turns the newline literals
+        # in strings ('\n') into actual newlines, which again leads to syntax errors. Instead,
+        # only the levels of escaping of the whole content are undone, in a single pass each,
+        # and f-strings with nested quotes are fixed after tokenizing the code once.
+        content = normalize_content(content, is_python=file_extension == 'py')
+
+        if mode not in ('w', 'a', 'r', 'p'):
             return (
                 f'* Error:: Failed to write to file {file_name} because'
                 f' an incorrect file open mode is specified: {mode}.'
-                f' The supported file opening modes are: "w" for write; "a" for append.'
+                f' The supported file opening modes are: "w" for write; "a" for append;'
+                f' "r" for replacing lines; "p" for applying a patch.'
+            )
+
+        if mode in ('r', 'p') and not os.path.isfile(file_name):
+            return (
+                f'* Error:: Failed to change the file {file_name} because it does not exist.'
+                f' Please write the whole file with the "w" mode instead.'
+            )
+
+        if mode == 'r' and ('start_line' not in params or 'end_line' not in params):
+            return (
+                '* Error: The `start_line` and `end_line` keys are required in the "r" mode!'
+                ' Please use the function based on the description provided.'
             )
 
         try:
@@ -178,48 +127,86 @@ class WriteFileTool(ToolInterface):
             if dir_name:
                 MakeDirectoryTool.use({'dir_name': dir_name})
 
-            with open(file_name, mode, encoding='utf-8') as out_file:
-                out_file.write(content)
+            is_python = file_extension and file_extension == 'py'
+            # The lines changed in the `r` and `p` modes
+            changed_lines = None
 
-            msg = f'Successfully wrote to the file: {file_name}'
+            if mode in ('r', 'p'):
+                with open(file_name, 'r', encoding='utf-8') as in_file:
+                    old_content = in_file.read()
+
+                if mode == 'r':
+                    content, changed_range = replace_lines(
+                        old_content, int(params['start_line']), int(params['end_line']), content
+                    )
+                    changed_lines = [changed_range]
+                else:
+                    content, changed_lines = apply_unified_diff(old_content, content)
+            elif mode == 'a' and os.path.exists(file_name):
+                with open(file_name, 'r', encoding='utf-8') as in_file:
+                    content = in_file.read() + content
+
+            if is_python:
+                # Fix all potential errors because of strings split into two lines, in a single pass,
+                # before the file is written
+                content, num_fixes = PythonLinter.fix_unterminated_string_literals(content, file_name)
+                if num_fixes:
+                    print(f'Fixed {num_fixes} unterminated string literal(s) in {file_name}')
+
+            unchanged = WORKSPACE.is_unchanged(file_name, content)
+
+            if not unchanged:
+                # Write the whole file at once, so that it is never left half-written
+                atomic_write(file_name, content)
+                WORKSPACE.record_write(file_name, content)
+
+            if unchanged:
+                msg = f'The file {file_name} already has this content: this action is complete'
+            elif changed_lines is None:
+                msg = f'Successfully wrote to the file: {file_name}'
+            else:
+                ranges = [f'{start}-{end}' if end > start else f'{start}' for start, end in changed_lines]
+                msg = f'Successfully changed the file: {file_name}, line(s) {", ".join(ranges)}'
 
             # Perform a static analysis of Python code to catch early errors
             # often arising due to wrong formatting or encoding
-            if file_extension and file_extension == 'py':
-                # Run in a loop and try to fix all potential errors because of string split into two lines
-                while True:
-                    result = WriteFileTool.run_code_lint(file_name).strip()
-
+            if is_python:
+                # An unchanged file is not linted again unless another module has changed
+                result = WORKSPACE.get_lint_result(file_name)
+                if result is None:
+                    result = PythonLinter.lint(file_name, content).strip()
+                    WORKSPACE.record_lint(file_name, result)
+
+                if result and changed_lines is not None:
+                    # Only report on the changed lines, and show only those lines
+                    result, num_others = filter_lint_messages(result, changed_lines)
                     if result:
-                        # Try to fix the unterminated string literal errors
-                        pattern = r"(\d+):(\d+): E0001: Parsing failed: 'unterminated string literal"
-                        match = re.search(pattern, result, re.UNICODE | re.DOTALL)
-
-                        if match:
-                            # Extract the line number and column number from the match
-                            line_number = int(match.group(1))
-                            column_number = int(match.group(2))
-                            WriteFileTool.fix_unterminated_string_literal(file_name, line_number, column_number)
-                        else:  # Do not try to fix any other kind of error
-                            break
-                    else:  # Empty result -- no error
-                        break
-
-                with open(file_name, 'r', encoding='utf-8') as in_file:
-                    code = in_file.read().strip()
-
-                if result:
+                        lines = [
+                            msg,
+                            f'Pylint throws the following error for the changed lines of {file_name}:\n',
+                            result,
+                        ]
+                        if num_others:
+                            lines.append(f'\n({num_others} other error(s) found elsewhere in the file)')
+                        lines.extend([
+                            '\nPlease change the code again to fix the error. The changed lines are:',
+                            number_lines(content, changed_lines)
+                        ])
+                        msg = '\n'.join(lines)
+                elif result:
                     msg = '\n'.join([
                         msg,
                         f'Pylint throws the following error for {file_name}:\n',
                         result,
                         '\nPlease regenerate the code to fix the error. The concerned code is:',
-                        code
+                        content.strip()
                     ])
 
                 print(f'Pylint result for {file_name}: {result}')
 
             return msg
+        except PatchError as pe:
+            return f'* Error:: Failed to change the file {file_name} because of the following error: {pe}'
         except Exception as ex:
             return f'* Error:: Failed to write to the file {file_name} because of the following error: {ex}'
 
@@ -227,29 +214,85 @@ class WriteFileTool(ToolInterface):
 class ReadFileTool(ToolInterface):
     name: str = 'ReadFileTool'
     description: str = (
-        'Use only when you need to read from a file with a given.'
-        ' Returns the file content or error message.'
+        'Use only when you need to read from a file with a given name.'
+        ' Returns the file content or error message. A large file is returned in parts:'
+        ' read more of it by lines with `start_line` and `num_lines`, or by bytes with `start_byte` and `num_bytes`.'
     )
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    concurrent_safe: bool = True
+    tracks_workspace: bool = True
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'file_name': {
                     'type': 'string', 'description': 'Name of the file'
                 },
+                'start_line': {
+                    'type': 'integer', 'description': 'The first line to read, starting from 1'
+                },
+                'num_lines': {
+                    'type': 'integer', 'description': 'The number of lines to read'
+                },
+                'start_byte': {
+                    'type': 'integer',
+                    'description': 'The first byte to read, starting from 0, to read by bytes instead of lines'
+                },
+                'num_bytes': {
+                    'type': 'integer', 'description': 'The number of bytes to read'
+                },
             },
         },
-    )
+    }
+    # The most lines and bytes returned at once
+    max_lines: int = 500
+    max_bytes: int = 32000
+
+    @staticmethod
+    def configure(params: Dict[str, Any]):
+        ReadFileTool.max_lines = params.get('max_lines', ReadFileTool.max_lines)
+        ReadFileTool.max_bytes = params.get('max_bytes', ReadFileTool.max_bytes)
+
+    @staticmethod
+    def get_resource(params: Dict[str, str]) -> Optional[str]:
+        return params.get('file_name', '').strip() or None
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
         file_name = params['file_name'].strip()
 
         try:
-            with open(file_name, 'r', encoding='utf-8') as in_file:
-                return in_file.read()
+            if params.get('start_byte') is not None:
+                num_bytes = min(int(params.get('num_bytes') or ReadFileTool.max_bytes), ReadFileTool.max_bytes)
+                page = read_bytes(file_name, int(params['start_byte']), num_bytes)
+                header = f'Bytes {page.start}-{page.end - 1} of {file_name} ({format_size(page.size)}):'
+                more = f'start_byte={page.next_start}'
+            else:
+                num_lines = min(int(params.get('num_lines') or ReadFileTool.max_lines), ReadFileTool.max_lines)
+                page = read_lines(file_name, int(params.get('start_line') or 1), num_lines, ReadFileTool.max_bytes)
+
+                # A file read whole is returned as it is
+                if page.start == 1 and page.next_start is None:
+                    return page.text
+
+                if page.end >= page.start:
+                    header = f'Lines {page.start}-{page.end} of {file_name} ({format_size(page.size)}):'
+                    more = f'start_line={page.next_start}'
+                elif page.next_start is not None:
+                    header = (
+                        f'Line {page.start} of {file_name} ({format_size(page.size)}) is too long;'
+                        f' its first {ReadFileTool.max_bytes} bytes are:'
+                    )
+                    more = f'start_byte={page.next_start}'
+                else:
+                    return f'The file {file_name} has fewer than {page.start} lines'
+
+            lines = [header, page.text.rstrip('\n')]
+            if page.next_start is not None:
+                lines.append(f'... The file goes on; to read more of it, use {more}')
+
+            return '\n'.join(lines)
         except Exception as ex:
             return f'* Error:: Failed to read from the file {file_name} because of the following error: {ex}'
 
@@ -257,10 +300,12 @@ class ReadFileTool(ToolInterface):
 class MakeDirectoryTool(ToolInterface):
     name: str = 'MakeDirectoryTool'
     description: str = 'Use only when you need to create a directory. Returns the dir creation status.'
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    concurrent_safe: bool = True
+    tracks_workspace: bool = True
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'dir_name': {
@@ -268,18 +313,33 @@ class MakeDirectoryTool(ToolInterface):
                 },
             },
         },
-    )
+    }
+
+    @staticmethod
+    def get_resource(params: Dict[str, str]) -> Optional[str]:
+        return params.get('dir_name', '').strip() or None
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
         dir_name = params['dir_name'].strip()
 
         try:
-            if not os.path.exists(dir_name):
-                os.mkdir(dir_name)
+            exists = WORKSPACE.is_dir(dir_name)
+            if exists is None:
+                exists = os.path.exists(dir_name)
+
+            if not exists:
+                os.makedirs(dir_name, exist_ok=True)
+                WORKSPACE.record_dir(dir_name)
                 return f'Successfully created the directory: {dir_name}'
 
             return f'Directory {dir_name} already exists: this action is complete'
+        except FileExistsError as ex:
+            # Not a directory as per the index, but a file with the same name, as `os.path.exists` finds
+            if os.path.exists(dir_name):
+                return f'Directory {dir_name} already exists: this action is complete'
+
+            return f'* Error:: Failed to write to the file {dir_name} because of the following error: {ex}'
         except Exception as ex:
             return f'* Error:: Failed to write to the file {dir_name} because of the following error: {ex}'
 
@@ -288,28 +348,68 @@ class ListDirectoryTool(ToolInterface):
     name: str = 'ListDirectoryTool'
     description: str = (
         'Use only when you need to list the contents of a directory.'
-        ' Returns the names of files and subdirectories, each separated by a newline.'
+        ' Returns the names of files, with their sizes and modification times, and subdirectories,'
+        ' each in a separate line. A long listing is returned in parts: list more of it with `offset`.'
     )
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    concurrent_safe: bool = True
+    tracks_workspace: bool = True
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'dir_name': {
                     'type': 'string', 'description': 'Name of the directory (must not contain any space)'
                 },
+                'pattern': {
+                    'type': 'string', 'description': 'List only the entries whose names match this pattern, e.g., *.csv'
+                },
+                'depth': {
+                    'type': 'integer',
+                    'description': 'The number of levels of subdirectories to list; 1, the default, for none'
+                },
+                'offset': {
+                    'type': 'integer', 'description': 'The number of entries to skip'
+                },
+                'limit': {
+                    'type': 'integer', 'description': 'The number of entries to list'
+                },
             },
         },
-    )
+    }
+    # The most entries returned at once
+    max_entries: int = 200
+
+    @staticmethod
+    def configure(params: Dict[str, Any]):
+        ListDirectoryTool.max_entries = params.get('max_entries', ListDirectoryTool.max_entries)
+
+    @staticmethod
+    def get_resource(params: Dict[str, str]) -> Optional[str]:
+        return params.get('dir_name', '').strip() or None
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
         dir_name = params['dir_name'].strip()
 
         try:
-            items = os.listdir(dir_name)
-            return '\n'.join(items)
+            offset = max(int(params.get('offset') or 0), 0)
+            limit = min(int(params.get('limit') or ListDirectoryTool.max_entries), ListDirectoryTool.max_entries)
+            entries = iter_entries(
+                dir_name or '.', max(int(params.get('depth') or 1), 1), params.get('pattern', '').strip() or None
+            )
+            # One more than asked for, to know whether any are left
+            page = list(itertools.islice(entries, offset, offset + limit + 1))
+            lines = [describe_entry(path, item) for path, item in page[:limit]]
+
+            if not lines:
+                return f'No entries found in {dir_name}' + (f' after the first {offset}' if offset else '')
+
+            if len(page) > limit:
+                lines.append(f'... More entries follow; to list them, use offset={offset + limit}')
+
+            return '\n'.join(lines)
         except NotADirectoryError as nde:
             return f'* Error:: {dir_name} is not a directory. Use this tool only with a directory: {nde}'
         except Exception as ex:
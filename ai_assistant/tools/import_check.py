@@ -0,0 +1,202 @@
+import ast
+import importlib
+import importlib.machinery
+import importlib.metadata
+import importlib.util
+import os
+import pkgutil
+import sys
+import threading
+from typing import FrozenSet, List, Optional, Tuple
+
+
+# The exceptions whose handlers make the imports in a `try` block optional
+OPTIONAL_IMPORT_ERRORS = ('ImportError', 'ModuleNotFoundError', 'Exception', 'BaseException')
+
+
+def is_optional(node: ast.Try) -> bool:
+    """
+    Check whether a `try` block handles a failed import, so that its imports are optional.
+    """
+
+    for handler in node.handlers:
+        if handler.type is None:
+            return True
+
+        types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+        names = [getattr(exc_type, 'id', getattr(exc_type, 'attr', None)) for exc_type in types]
+        if any(name in OPTIONAL_IMPORT_ERRORS for name in names):
+            return True
+
+    return False
+
+
+def is_main_check(node: ast.If) -> bool:
+    """
+    Check whether a condition is `__name__ == '__main__'`.
+    """
+
+    test = node.test
+    return (
+        isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == '__name__'
+        and len(test.comparators) == 1 and getattr(test.comparators[0], 'value', None) == '__main__'
+    )
+
+
+def extract_imports(source: str) -> List[Tuple[str, int]]:
+    """
+    Find the top-level modules a program imports whenever it runs: those imported at the module
+    level, in a class body, or under `if __name__ == '__main__'`. The imports in functions, in other
+    conditional blocks, or guarded by a `try` block handling `ImportError` may not be needed, so they
+    are left out; so are the relative imports.
+
+    :param source: The source code of the program.
+    :return: The name and the line of every module, in the order of the imports.
+    """
+
+    imports = []
+
+    def visit(statements: List[ast.stmt]):
+        for node in statements:
+            if isinstance(node, ast.Import):
+                imports.extend((alias.name.split('.')[0], node.lineno) for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                if node.level == 0 and node.module and node.module != '__future__':
+                    imports.append((node.module.split('.')[0], node.lineno))
+            elif isinstance(node, ast.ClassDef):
+                visit(node.body)
+            elif isinstance(node, ast.If) and is_main_check(node):
+                visit(node.body)
+            elif isinstance(node, ast.Try) and not is_optional(node):
+                visit(node.body)
+                visit(node.finalbody)
+            elif isinstance(node, (ast.With, ast.AsyncWith)):
+                visit(node.body)
+
+    visit(ast.parse(source).body)
+
+    # Only the first import of every module
+    first_imports = {}
+    for name, line in imports:
+        first_imports.setdefault(name, line)
+
+    return list(first_imports.items())
+
+
+def is_local_module(name: str, dir_name: str) -> bool:
+    """
+    Check whether a module is found next to a program, i.e., is a module or a package of its own.
+
+    :param name: The module.
+    :param dir_name: The directory of the program.
+    :return: True if found there.
+    """
+
+    if os.path.isdir(os.path.join(dir_name, name)):
+        return True
+
+    return any(
+        os.path.isfile(os.path.join(dir_name, name + suffix)) for suffix in importlib.machinery.all_suffixes()
+    )
+
+
+class ModuleIndex(object):
+    """
+    The top-level modules installed in the environment of the interpreter that runs the programs,
+    i.e., this one: the built-in and the standard modules, those found on the path, and those of
+    the installed distributions. The index is built when first needed, and built again whenever
+    any directory on the path changes, e.g., after a package is installed.
+    """
+
+    def __init__(self):
+        self.names: FrozenSet[str] = frozenset()
+        # The modification times of the directories on the path when the index was built
+        self.fingerprint: Optional[Tuple] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_paths() -> List[str]:
+        # The first entry is the directory of the assistant, not that of the program run
+        return [path for path in sys.path[1:] if path and os.path.isdir(path)]
+
+    @staticmethod
+    def get_fingerprint() -> Tuple:
+        fingerprint = []
+
+        for path in ModuleIndex.get_paths():
+            try:
+                fingerprint.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                continue
+
+        return tuple(fingerprint)
+
+    def refresh(self):
+        """
+        Build the index, unless built since the directories on the path last changed.
+        """
+
+        fingerprint = ModuleIndex.get_fingerprint()
+
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+
+            names = set(sys.builtin_module_names) | set(getattr(sys, 'stdlib_module_names', ()))
+            names.update(module.name for module in pkgutil.iter_modules(ModuleIndex.get_paths()))
+
+            try:
+                # Also the namespace packages, e.g., `google`, which `iter_modules` misses
+                names.update(importlib.metadata.packages_distributions())
+            except Exception:
+                pass
+
+            importlib.invalidate_caches()
+            self.names = frozenset(names)
+            self.fingerprint = fingerprint
+
+    def is_installed(self, name: str) -> bool:
+        """
+        Check whether a module can be imported. A module not in the index is looked for once more,
+        so that a module installed in an unusual way, e.g., via an import hook, is not reported as missing.
+
+        :param name: The top-level module.
+        :return: True if installed.
+        """
+
+        self.refresh()
+
+        if name in self.names:
+            return True
+
+        try:
+            return importlib.util.find_spec(name) is not None
+        except (ImportError, ValueError):
+            return True
+
+
+# The modules installed in this environment
+MODULE_INDEX = ModuleIndex()
+
+
+def find_missing_imports(file_name: str) -> List[Tuple[str, int]]:
+    """
+    Find the modules a program imports whenever it runs that are not installed, without running it.
+
+    :param file_name: The program.
+    :return: The name and the line of every missing module; none if the program cannot be parsed,
+     since running it reports the syntax error better.
+    """
+
+    try:
+        with open(file_name, 'r', encoding='utf-8') as in_file:
+            imports = extract_imports(in_file.read())
+    except (OSError, SyntaxError, ValueError):
+        return []
+
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+
+    return [
+        (name, line) for name, line in imports
+        if not is_local_module(name, dir_name) and not MODULE_INDEX.is_installed(name)
+    ]
@@ -0,0 +1,205 @@
+import io
+import re
+import tokenize
+from typing import Dict, List, Optional, Tuple
+
+
+# The most levels of escaping undone
+MAX_ESCAPE_LEVELS = 10
+# What may still be wrong with unescaped Python code: escaped quotes, or an f-string with
+# the same quotes inside its braces, e.g., `f"{data["key"]}"`
+PYTHON_HAZARDS = re.compile(r'''\\["']|[fF][rR]?(["'])(?:(?!\1)[^\n])*\{[^}\n]*\1''')
+
+
+def decode_escapes(text: str) -> str:
+    """
+    Decode one level of backslash escape sequences, e.g., `\\n` into a newline. Unlike decoding
+    with `unicode_escape` alone, any non-Latin-1 character, e.g., in a comment, is preserved.
+
+    :param text: The text.
+    :return: The decoded text, or the text itself if it contains an invalid escape sequence.
+    """
+
+    try:
+        return text.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+    except UnicodeDecodeError:
+        return text
+
+
+def is_escaped(text: str) -> bool:
+    """
+    Whether a whole text looks escaped: its lines are separated with `\\n` escape sequences
+    rather than actual newlines.
+    """
+
+    return '\n' not in text and '\\n' in text
+
+
+def compiles(code: str) -> bool:
+    try:
+        compile(code, '<content>', 'exec', dont_inherit=True)
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+
+def unescape(text: str) -> str:
+    """
+    Undo any levels of escaping of a whole text, one level at a time, as long as the text looks
+    escaped. The escape sequences inside the string literals of code, e.g., the `\\n` in
+    `print('Hello\\n')`, are thus kept once the code is no longer escaped, rather than turned into
+    actual newlines.
+
+    :param text: The text.
+    :return: The unescaped text.
+    """
+
+    for _ in range(MAX_ESCAPE_LEVELS):
+        if not is_escaped(text):
+            break
+
+        decoded = decode_escapes(text)
+        if decoded == text:
+            break
+        text = decoded
+
+    return text
+
+
+def fix_nested_quotes(line: str, start: int) -> Optional[Tuple[int, str]]:
+    """
+    Fix an f-string whose expressions contain strings with the same quotes as the f-string itself,
+    e.g., `f"{data["key"]}"`, which is valid only since Python 3.12, by using the other quotes for
+    the inner strings, e.g., `f"{data['key']}"`.
+
+    :param line: The line containing the f-string.
+    :param start: The position of the f-string, including its prefix, in the line.
+    :return: The position after the end of the f-string and the fixed f-string, if fixed.
+    """
+
+    i = start
+    while i < len(line) and line[i] not in '\'"':
+        i += 1
+    if i >= len(line) or line[i:i + 3] == line[i] * 3:
+        return None
+
+    quote = line[i]
+    other = '"' if quote == "'" else "'"
+    fixed = [line[start:i + 1]]
+    depth = 0
+    i += 1
+
+    while i < len(line):
+        char = line[i]
+
+        if depth == 0:
+            if char == '\\':
+                fixed.append(line[i:i + 2])
+                i += 2
+                continue
+            if char == quote:
+                fixed.append(char)
+                return i + 1, ''.join(fixed)
+            if char in '{}' and line[i + 1:i + 2] == char:
+                fixed.append(char * 2)
+                i += 2
+                continue
+            if char == '{':
+                depth = 1
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char in '\'"':
+            # A string inside an expression; one with the same quotes gets the other quotes
+            end = line.find(char, i + 1)
+            if end < 0 or (char == quote and other in line[i + 1:end]):
+                return None
+
+            delimiter = other if char == quote else char
+            fixed.append(delimiter + line[i + 1:end] + delimiter)
+            i = end + 1
+            continue
+
+        fixed.append(char)
+        i += 1
+
+    return None
+
+
+def fix_fstring_quotes(code: str) -> str:
+    """
+    Fix the f-strings containing strings with the same quotes, which older versions of Python
+    cannot parse. The code is tokenized once, and only the f-strings are changed.
+
+    :param code: The code.
+    :return: The fixed code.
+    """
+
+    lowered = code.lower()
+    if "f'" not in lowered and 'f"' not in lowered:
+        return code
+
+    # Before Python 3.12, such an f-string is split into several string tokens at the inner quotes,
+    # the first of which has unbalanced braces
+    starts: List[Tuple[int, int]] = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type != tokenize.STRING:
+                continue
+
+            prefix = token.string[:len(token.string) - len(token.string.lstrip('rRbBuUfF'))]
+            braces = token.string.replace('{{', '').replace('}}', '')
+            if 'f' in prefix.lower() and braces.count('{') > braces.count('}'):
+                starts.append(token.start)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+
+    if not starts:
+        return code
+
+    lines = code.splitlines(keepends=True)
+    fixes: Dict[int, List[Tuple[int, int, str]]] = {}
+
+    for row, col in starts:
+        result = fix_nested_quotes(lines[row - 1], col)
+        if result is not None:
+            fixes.setdefault(row - 1, []).append((col, result[0], result[1]))
+
+    for idx, line_fixes in fixes.items():
+        line = lines[idx]
+        for col, end, fixed in sorted(line_fixes, reverse=True):
+            line = line[:col] + fixed + line[end:]
+        lines[idx] = line
+
+    return ''.join(lines)
+
+
+def normalize_content(text: str, is_python: bool) -> str:
+    """
+    Normalize the content of a file as generated by a model, which may be escaped an arbitrary
+    number of times, e.g., with `\\\\n` instead of newlines, and, for Python code, contain
+    f-strings valid only in newer versions of Python. Only Python code with any of the hazards
+    found by a single scan is compiled and fixed further, so that the common case is cheap.
+
+    :param text: The content.
+    :param is_python: Whether the content is Python code.
+    :return: The normalized content.
+    """
+
+    text = unescape(text)
+
+    if not is_python or not PYTHON_HAZARDS.search(text) or compiles(text):
+        return text
+
+    # Some escaping may be left in code that has actual newlines, e.g., `\\"` for the quotes;
+    # decode further only if that fixes the code
+    decoded = text
+    for _ in range(MAX_ESCAPE_LEVELS):
+        previous, decoded = decoded, decode_escapes(decoded)
+        if decoded == previous:
+            break
+        if compiles(decoded):
+            return decoded
+
+    return fix_fstring_quotes(text)
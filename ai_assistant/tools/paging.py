@@ -0,0 +1,204 @@
+import datetime
+import fnmatch
+import mmap
+import os
+from typing import Iterator, Optional, Tuple
+
+
+class FilePage(object):
+    """
+    A part of a file, read without loading the rest of the file.
+    """
+
+    def __init__(self, text: str, start: int, end: int, size: int, next_start: Optional[int]):
+        """
+        :param text: The content of the part.
+        :param start: The first line, or byte, of the part, starting from 1, or 0 for bytes.
+        :param end: The last line, or the byte after the last one.
+        :param size: The size of the whole file, in bytes.
+        :param next_start: Where the next part starts, if the file goes on.
+        """
+
+        self.text = text
+        self.start = start
+        self.end = end
+        self.size = size
+        self.next_start = next_start
+
+
+def format_size(num_bytes: int) -> str:
+    """
+    Format a size in bytes in a human-readable way, e.g., `12.3 KB`.
+
+    :param num_bytes: The size.
+    :return: The formatted size.
+    """
+
+    size = float(num_bytes)
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{int(size)} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+def find_line(data: mmap.mmap, size: int, line: int, chunk_size: int = 1024 * 1024) -> Optional[int]:
+    """
+    Find where a line starts, counting the newlines of whole chunks at once.
+
+    :param data: The content of the file.
+    :param size: The size of the file.
+    :param line: The line, starting from 1.
+    :param chunk_size: The number of bytes counted at once.
+    :return: The position of the line, or `None` if the file has fewer lines.
+    """
+
+    remaining = line - 1
+    position = 0
+
+    while remaining > 0:
+        if position >= size:
+            return None
+
+        chunk = data[position:position + chunk_size]
+        count = chunk.count(b'\n')
+
+        if count < remaining:
+            remaining -= count
+            position += len(chunk)
+            continue
+
+        # The line starts in this chunk
+        offset = -1
+        for _ in range(remaining):
+            offset = chunk.find(b'\n', offset + 1)
+        return position + offset + 1
+
+    return 0
+
+
+def read_lines(file_name: str, start_line: int, num_lines: int, max_bytes: int) -> FilePage:
+    """
+    Read a range of lines of a file. The file is memory-mapped, so that only the pages up to
+    the last line read are loaded, however large the file is.
+
+    :param file_name: The file.
+    :param start_line: The first line to read, starting from 1.
+    :param num_lines: The maximum number of lines to read.
+    :param max_bytes: The maximum number of bytes to read; a line longer than this is cut short.
+    :return: The lines read.
+    """
+
+    size = os.path.getsize(file_name)
+
+    if size == 0:
+        return FilePage('', start_line, start_line - 1, 0, None)
+
+    with open(file_name, 'rb') as in_file, mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = find_line(data, size, start_line)
+        if position is None:
+            return FilePage('', start_line, start_line - 1, size, None)
+
+        start_position = position
+        end_line = start_line - 1
+
+        while end_line - start_line + 1 < num_lines and position < size:
+            line_end = data.find(b'\n', position)
+            line_end = size if line_end == -1 else line_end + 1
+
+            if line_end - start_position > max_bytes:
+                if end_line < start_line:
+                    # A single line longer than allowed; the rest can be read by bytes
+                    position = start_position + max_bytes
+                break
+
+            position = line_end
+            end_line += 1
+
+        text = data[start_position:position].decode('utf-8', errors='replace')
+
+    if position >= size:
+        next_start = None
+    elif end_line < start_line:
+        next_start = position
+    else:
+        next_start = end_line + 1
+
+    return FilePage(text, start_line, end_line, size, next_start)
+
+
+def read_bytes(file_name: str, start_byte: int, num_bytes: int) -> FilePage:
+    """
+    Read a range of bytes of a file, memory-mapped. A character split at either end of the
+    range is shown as a replacement character.
+
+    :param file_name: The file.
+    :param start_byte: The first byte to read, starting from 0.
+    :param num_bytes: The maximum number of bytes to read.
+    :return: The bytes read, decoded.
+    """
+
+    size = os.path.getsize(file_name)
+    start_byte = min(max(start_byte, 0), size)
+    end_byte = min(start_byte + num_bytes, size)
+
+    if start_byte == end_byte:
+        return FilePage('', start_byte, end_byte, size, None)
+
+    with open(file_name, 'rb') as in_file, mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        text = data[start_byte:end_byte].decode('utf-8', errors='replace')
+
+    return FilePage(text, start_byte, end_byte, size, end_byte if end_byte < size else None)
+
+
+def iter_entries(dir_name: str, max_depth: int, pattern: str = None) -> Iterator[Tuple[str, os.DirEntry]]:
+    """
+    Iterate over the entries of a directory and, up to a depth, of its subdirectories, in
+    sorted order, with every directory followed by its contents. Hidden directories and
+    `__pycache__` are listed but not descended into. The directories are scanned only when
+    reached, so that the first entries of a large tree are found without scanning all of it.
+
+    :param dir_name: The directory.
+    :param max_depth: The number of levels to list; 1 for only the directory itself.
+    :param pattern: If specified, only the entries whose name matches this glob pattern,
+     e.g., `*.csv`, are yielded.
+    :return: The path of every entry relative to the directory, and the entry.
+    """
+
+    with os.scandir(dir_name) as items:
+        entries = sorted(items, key=lambda item: item.name)
+
+    for item in entries:
+        if pattern is None or fnmatch.fnmatch(item.name, pattern):
+            yield item.name, item
+
+        if (
+                max_depth > 1 and item.is_dir(follow_symlinks=False)
+                and not item.name.startswith('.') and item.name != '__pycache__'
+        ):
+            try:
+                for path, nested_item in iter_entries(item.path, max_depth - 1, pattern):
+                    yield os.path.join(item.name, path), nested_item
+            except OSError:
+                continue
+
+
+def describe_entry(path: str, item: os.DirEntry) -> str:
+    """
+    Describe an entry of a directory: its path, and for a file, its size and modification time.
+
+    :param path: The path to show.
+    :param item: The entry.
+    :return: The description.
+    """
+
+    if item.is_dir(follow_symlinks=False):
+        return f'{path}/'
+
+    try:
+        stat = item.stat()
+    except OSError:
+        return path
+
+    modified = datetime.datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M')
+    return f'{path}  {format_size(stat.st_size)}  {modified}'
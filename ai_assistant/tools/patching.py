@@ -0,0 +1,248 @@
+import os
+import re
+import tempfile
+from typing import List, Optional, Tuple
+
+
+# A range of lines, 1-based and inclusive
+LineRange = Tuple[int, int]
+
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class PatchError(Exception):
+    """
+    Raised when a change cannot be applied to a file.
+    """
+
+
+def split_lines(text: str) -> Tuple[List[str], bool]:
+    """
+    Split a text into lines.
+
+    :param text: The text.
+    :return: The lines, without the line endings, and whether the text ended with a newline.
+    """
+
+    return text.splitlines(), text.endswith('\n')
+
+
+def join_lines(lines: List[str], trailing_newline: bool) -> str:
+    text = '\n'.join(lines)
+    return text + '\n' if trailing_newline and lines else text
+
+
+def replace_lines(text: str, start_line: int, end_line: int, content: str) -> Tuple[str, LineRange]:
+    """
+    Replace a range of lines of a text. An `end_line` of `start_line - 1` inserts the content
+    before `start_line` without replacing anything; a `start_line` past the last line appends.
+
+    :param text: The text.
+    :param start_line: The first line to replace, starting from 1.
+    :param end_line: The last line to replace.
+    :param content: The new lines.
+    :return: The new text and the range of the new lines in it.
+    """
+
+    lines, trailing_newline = split_lines(text)
+
+    if start_line < 1 or start_line > len(lines) + 1:
+        raise PatchError(f'The start line {start_line} is outside the file, which has {len(lines)} lines')
+    if end_line < start_line - 1 or end_line > len(lines):
+        raise PatchError(f'The end line {end_line} is invalid for the start line {start_line} and {len(lines)} lines')
+
+    new_lines = content.splitlines()
+    lines[start_line - 1:end_line] = new_lines
+
+    return join_lines(lines, trailing_newline or not text), (start_line, start_line + len(new_lines) - 1)
+
+
+def parse_hunks(diff: str) -> List[Tuple[int, List[str], List[str]]]:
+    """
+    Parse the hunks of a unified diff of a single file.
+
+    :param diff: The diff.
+    :return: For each hunk, the line where it starts in the old file, the old lines, and the new lines.
+    """
+
+    hunks = []
+    current = None
+
+    for line in diff.splitlines():
+        match = HUNK_HEADER.match(line)
+
+        if match:
+            current = (int(match.group(1)), [], [])
+            hunks.append(current)
+        elif current is None or line.startswith(('--- ', '+++ ', 'diff ', 'index ', '\\')):
+            continue
+        elif line.startswith('-'):
+            current[1].append(line[1:])
+        elif line.startswith('+'):
+            current[2].append(line[1:])
+        else:
+            # A context line; models often drop the leading space of blank lines
+            line = line[1:] if line.startswith(' ') else line
+            current[1].append(line)
+            current[2].append(line)
+
+    return hunks
+
+
+def find_lines(lines: List[str], block: List[str], expected: int, strict: bool) -> Optional[int]:
+    """
+    Find where a block of lines occurs in the lines, nearest to the expected position.
+
+    :return: The index of the first line of the block, if found.
+    """
+
+    def matches(position: int) -> bool:
+        if strict:
+            return lines[position:position + len(block)] == block
+
+        return [line.rstrip() for line in lines[position:position + len(block)]] == [line.rstrip() for line in block]
+
+    last = len(lines) - len(block)
+    expected = min(max(expected, 0), max(last, 0))
+
+    for distance in range(0, max(expected, last - expected) + 1):
+        for position in (expected - distance, expected + distance):
+            if 0 <= position <= last and matches(position):
+                return position
+
+    return None
+
+
+def apply_unified_diff(text: str, diff: str) -> Tuple[str, List[LineRange]]:
+    """
+    Apply a unified diff to a text. Each hunk is located by its context and removed lines,
+    searching outward from the line numbers in its header, so that slightly wrong line numbers,
+    as often generated by models, are tolerated.
+
+    :param text: The text.
+    :param diff: The unified diff.
+    :return: The new text and the ranges of the changed lines in it.
+    """
+
+    hunks = parse_hunks(diff)
+    if not hunks:
+        raise PatchError('The patch contains no hunks; each hunk must start with a header like `@@ -1,3 +1,4 @@`')
+
+    lines, trailing_newline = split_lines(text)
+    changed = []
+    offset = 0
+
+    for old_start, old_lines, new_lines in hunks:
+        expected = max(old_start - 1, 0) + offset
+        position = find_lines(lines, old_lines, expected, strict=True)
+        if position is None:
+            position = find_lines(lines, old_lines, expected, strict=False)
+        if position is None:
+            raise PatchError(
+                f'Could not find the lines of the hunk starting at line {old_start} in the file:\n'
+                + '\n'.join(old_lines[:5])
+            )
+
+        lines[position:position + len(old_lines)] = new_lines
+        offset = position + len(new_lines) - (max(old_start - 1, 0) + len(old_lines))
+
+        # Only the lines that differ, not the context, count as changed
+        prefix = 0
+        while prefix < min(len(old_lines), len(new_lines)) and old_lines[prefix] == new_lines[prefix]:
+            prefix += 1
+        suffix = 0
+        while (
+                suffix < min(len(old_lines), len(new_lines)) - prefix
+                and old_lines[len(old_lines) - 1 - suffix] == new_lines[len(new_lines) - 1 - suffix]
+        ):
+            suffix += 1
+
+        changed.append((position + prefix + 1, position + len(new_lines) - suffix))
+
+    return join_lines(lines, trailing_newline or not text), changed
+
+
+def atomic_write(file_name: str, content: str):
+    """
+    Write a file so that it is either fully updated or left as it was, never half-written.
+    The content is written to a temporary file in the same directory, which then replaces the file.
+
+    :param file_name: The file.
+    :param content: The new content.
+    """
+
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_file = tempfile.mkstemp(dir=dir_name, prefix=f'.{os.path.basename(file_name)}.', suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out_file:
+            out_file.write(content)
+
+        if os.path.exists(file_name):
+            os.chmod(temp_file, os.stat(file_name).st_mode & 0o7777)
+
+        os.replace(temp_file, file_name)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def number_lines(text: str, line_ranges: List[LineRange], context: int = 2) -> str:
+    """
+    Show the given ranges of lines of a text, with line numbers and a few lines of context.
+
+    :param text: The text.
+    :param line_ranges: The ranges of lines to show.
+    :param context: The number of lines to show before and after each range.
+    :return: The numbered lines.
+    """
+
+    lines = text.splitlines()
+    shown = set()
+
+    for start, end in line_ranges:
+        shown.update(range(max(start - context, 1), min(max(end, start) + context, len(lines)) + 1))
+
+    output = []
+    previous = 0
+
+    for number in sorted(shown):
+        if previous and number > previous + 1:
+            output.append('...')
+        output.append(f'{number:>5}: {lines[number - 1]}')
+        previous = number
+
+    return '\n'.join(output)
+
+
+def filter_lint_messages(lint_output: str, line_ranges: List[LineRange], margin: int = 2) -> Tuple[str, int]:
+    """
+    Keep only the Pylint messages about the given ranges of lines; syntax errors are always kept.
+
+    :param lint_output: The output of Pylint.
+    :param line_ranges: The ranges of lines.
+    :param margin: The number of lines around each range also considered.
+    :return: The messages kept and the number of messages dropped.
+    """
+
+    kept = []
+    dropped = 0
+
+    for line in lint_output.splitlines():
+        parts = line.split(':', 3)
+
+        if len(parts) < 4 or not parts[1].strip().isdigit():
+            # The module headers and any other text
+            kept.append(line)
+            continue
+
+        number = int(parts[1])
+        if 'E0001' in parts[3] or any(start - margin <= number <= max(end, start) + margin for start, end in line_ranges):
+            kept.append(line)
+        else:
+            dropped += 1
+
+    # Drop the module headers left without any message
+    messages = [line for line in kept if not line.startswith('*************')]
+    return ('\n'.join(kept) if messages else ''), dropped
@@ -0,0 +1,43 @@
+import importlib
+from typing import Dict, List, Type, Union
+
+from ai_assistant.tools.base import ToolInterface
+
+
+# The module of every tool, which is imported only when the tool is asked for
+TOOL_MODULES: Dict[str, str] = {
+    'FinalAnswerTool': 'ai_assistant.tools.base',
+    'WriteFileTool': 'ai_assistant.tools.file_system',
+    'ReadFileTool': 'ai_assistant.tools.file_system',
+    'MakeDirectoryTool': 'ai_assistant.tools.file_system',
+    'ListDirectoryTool': 'ai_assistant.tools.file_system',
+    'CodeExecutionTool': 'ai_assistant.tools.code_execution',
+    'DownloadFileTool': 'ai_assistant.tools.web_tools',
+    'DownloadFilesTool': 'ai_assistant.tools.web_tools',
+    'RollbackTool': 'ai_assistant.tools.rollback',
+}
+
+
+def get_tool(name: str) -> Type[ToolInterface]:
+    """
+    Get a tool by its name, importing its module if not done yet.
+
+    :param name: The name of the tool, e.g., `WriteFileTool`.
+    :return: The tool.
+    """
+
+    if name not in TOOL_MODULES:
+        raise ValueError(f'Unknown tool `{name}`; the available tools are: {", ".join(TOOL_MODULES)}')
+
+    return getattr(importlib.import_module(TOOL_MODULES[name]), name)
+
+
+def get_tools(tools: List[Union[str, Type[ToolInterface]]]) -> List[Type[ToolInterface]]:
+    """
+    Get the tools given either by their names or as classes.
+
+    :param tools: The tools.
+    :return: The tool classes.
+    """
+
+    return [get_tool(tool) if isinstance(tool, str) else tool for tool in tools]
@@ -0,0 +1,62 @@
+from typing import Any, Dict
+
+from ai_assistant.snapshots import SNAPSHOTS
+from ai_assistant.tools.base import ToolInterface
+from ai_assistant.workspace import WORKSPACE
+
+
+class RollbackTool(ToolInterface):
+    name: str = 'RollbackTool'
+    description: str = (
+        'Use only when the files were left broken by the earlier steps and it is easier to start over from an'
+        ' earlier step than to fix them. Restores all files of the working directory to how they were before'
+        ' the given step, removing the files created since. Returns the files changed.'
+    )
+    tracks_workspace: bool = True
+    # The snapshots are of the working directory itself, not of any copy of it
+    sandboxed: bool = False
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'step': {
+                    'type': 'integer', 'description': 'The step to go back to, starting from 1'
+                },
+            },
+        },
+    }
+
+    @staticmethod
+    def use(params: Dict[str, Any]) -> str:
+        if 'step' not in params:
+            return (
+                '* Error: The `step` key is missing!'
+                ' Please use the function based on the description provided.'
+            )
+
+        steps = SNAPSHOTS.steps()
+
+        try:
+            step = int(params['step'])
+        except (TypeError, ValueError):
+            return f'* Error:: The step must be a number, not {params["step"]}.'
+
+        if step not in steps:
+            return (
+                f'* Error:: There is no snapshot of the files before step {step}.'
+                + (f' The steps that can be gone back to are: {", ".join(map(str, steps))}.' if steps else '')
+            )
+
+        try:
+            changes = SNAPSHOTS.rollback(step)
+        except Exception as ex:
+            return f'* Error:: Failed to restore the files before step {step} because of the following error: {ex}'
+        finally:
+            WORKSPACE.scan()
+
+        if not changes:
+            return f'The files are already as they were before step {step}: this action is complete'
+
+        return f'Restored the files to how they were before step {step}: {", ".join(changes)}'
@@ -0,0 +1,325 @@
+import atexit
+import json
+import os
+import queue
+import runpy
+import select
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from ai_assistant.tools.execution_limits import (
+    ExecutionLimits,
+    ExecutionResult,
+    kill_process_group,
+    read_bounded_file,
+    to_kb,
+)
+
+
+def run_script(file_name: str, cwd: str, stdout_file: str, stderr_file: str, limits: ExecutionLimits):
+    """
+    Run a Python program like `python file_name` would, but inside an already running,
+    forked interpreter. The program gets a fresh `__main__` namespace and its own working
+    directory, and its output is redirected to the given files. As at the end of a normal run,
+    the threads the program started are waited for, and its `atexit` handlers are run, before
+    the process exits. This never returns.
+
+    :param file_name: The program, relative to `cwd`.
+    :param cwd: The working directory.
+    :param stdout_file: The file to receive the standard output.
+    :param stderr_file: The file to receive the standard error.
+    :param limits: The CPU time and memory limits of the program.
+    """
+
+    exit_code = 0
+    # The handlers registered by the server, e.g., by the modules preloaded, are not the program's
+    atexit._clear()
+
+    try:
+        # Put the program and anything it starts into a new process group to kill them all at once
+        os.setsid()
+        limits.apply()
+
+        for fd, out_file in ((1, stdout_file), (2, stderr_file)):
+            out_fd = os.open(out_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.dup2(out_fd, fd)
+            os.close(out_fd)
+
+        in_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(in_fd, 0)
+        os.close(in_fd)
+
+        sys.stdin = open(0, 'r', encoding='utf-8', closefd=False)
+        sys.stdout = open(1, 'w', encoding='utf-8', closefd=False)
+        sys.stderr = open(2, 'w', encoding='utf-8', closefd=False)
+
+        os.chdir(cwd)
+        sys.argv = [file_name]
+        sys.path[0] = os.path.dirname(os.path.abspath(file_name))
+
+        runpy.run_path(file_name, run_name='__main__')
+    except SystemExit as se:
+        if se.code is None:
+            exit_code = 0
+        elif isinstance(se.code, int):
+            exit_code = se.code
+        else:
+            print(se.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException as ex:
+        # Hide the frames of this runner so that the traceback looks like that of a normal run
+        tb = ex.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename in (__file__, runpy.__file__, '<frozen runpy>'):
+            tb = tb.tb_next
+
+        traceback.print_exception(type(ex), ex, tb)
+        exit_code = 1
+    finally:
+        try:
+            # Like the interpreter does when it exits: wait for the non-daemon threads, then run the handlers
+            threading._shutdown()
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def serve(preload_modules: List[str]):
+    """
+    Run a fork server: import the modules to preload, then run every program requested on the
+    standard input in a forked child process and report its outcome on the standard output,
+    one JSON object per line.
+
+    :param preload_modules: The modules to import once, in advance.
+    """
+
+    # Keep the protocol channel away from anything printed while importing
+    channel = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2, 1)
+
+    for module_name in preload_modules:
+        try:
+            __import__(module_name)
+        except Exception as ex:
+            print(f'Could not preload {module_name}: {ex}', file=sys.stderr)
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        limits = ExecutionLimits.from_dict(request['limits'])
+        sys.stderr.flush()
+        start_time = time.perf_counter()
+        pid = os.fork()
+
+        if pid == 0:
+            channel.close()
+            run_script(request['file_name'], request['cwd'], request['stdout_file'], request['stderr_file'], limits)
+
+        timed_out = not wait_for_exit(pid, limits.timeout)
+        if timed_out:
+            kill_process_group(pid)
+
+        _, status, usage = os.wait4(pid, 0)
+        # Any processes left behind by the program
+        kill_process_group(pid)
+
+        channel.write(json.dumps({
+            'exit_code': os.waitstatus_to_exitcode(status),
+            'max_rss_kb': to_kb(usage.ru_maxrss),
+            'duration': time.perf_counter() - start_time,
+            'timed_out': timed_out,
+        }))
+        channel.write('\n')
+        channel.flush()
+
+
+def wait_for_exit(pid: int, timeout: float) -> bool:
+    """
+    Wait for a child process to exit without reaping it.
+
+    :param pid: The child process.
+    :param timeout: The maximum time to wait, in seconds; zero to wait indefinitely.
+    :return: False if the process was still running after the timeout.
+    """
+
+    if not timeout:
+        return True
+
+    if hasattr(os, 'pidfd_open'):
+        pid_fd = os.pidfd_open(pid)
+        try:
+            ready, _, _ = select.select([pid_fd], [], [], timeout)
+            return bool(ready)
+        finally:
+            os.close(pid_fd)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+            return True
+        time.sleep(0.01)
+
+    return False
+
+
+class WarmInterpreter(object):
+    """
+    A client of a single fork server.
+    """
+
+    def __init__(self, preload_modules: List[str]):
+        package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'ai_assistant.tools.warm_pool'] + preload_modules,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            env=env,
+        )
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(
+            self,
+            file_name: str,
+            cwd: str,
+            stdout_file: str,
+            stderr_file: str,
+            limits: ExecutionLimits
+    ) -> Dict[str, Any]:
+        """
+        Run a program in a process forked from the server.
+
+        :return: The `exit_code`, negative if the program was killed by a signal, the peak resident
+         set size of the program in KB, `max_rss_kb`, if known, its `duration`, and whether it
+         `timed_out`.
+        """
+
+        request = {
+            'file_name': file_name,
+            'cwd': cwd,
+            'stdout_file': stdout_file,
+            'stderr_file': stderr_file,
+            'limits': limits.to_dict(),
+        }
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        response = self.process.stdout.readline()
+
+        if not response:
+            raise RuntimeError('The warm interpreter has stopped')
+
+        return json.loads(response)
+
+    def stop(self):
+        if self.is_alive():
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class WarmInterpreterPool(object):
+    """
+    Run Python programs in warm interpreters rather than starting a new one every time.
+    Each interpreter of the pool is a fork server that imports the configured modules,
+    e.g., `pandas`, once; every program then runs in a process forked from it. Thus, the
+    programs are isolated from each other yet pay neither the interpreter startup nor the
+    cost of the preloaded imports. Only available where `os.fork` is.
+    """
+
+    def __init__(self, preload_modules: List[str] = None, size: int = 2):
+        """
+        :param preload_modules: The modules to import once, in advance.
+        :param size: The number of warm interpreters, i.e., programs that can run at the same time.
+        """
+
+        self.preload_modules = list(preload_modules or [])
+        self.size = size
+        self.idle: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(os, 'fork') and hasattr(os, 'wait4')
+
+    def start(self):
+        """
+        Start all interpreters of the pool. They preload the modules in the background.
+        """
+
+        with self.lock:
+            if not self.started:
+                for _ in range(self.size):
+                    self.idle.put(WarmInterpreter(self.preload_modules))
+                self.started = True
+
+    def stop(self):
+        with self.lock:
+            while not self.idle.empty():
+                self.idle.get().stop()
+            self.started = False
+
+    def run(self, file_name: str, cwd: str, limits: ExecutionLimits) -> Optional[ExecutionResult]:
+        """
+        Run a Python program in a warm interpreter.
+
+        :param file_name: The program, relative to `cwd`.
+        :param cwd: The working directory; the current directory if not specified.
+        :param limits: The limits of the program.
+        :return: The outcome of the program, or `None` if the program could not be run or was
+         killed by a signal other than for exceeding its limits, e.g., because it crashed the
+         interpreter; such a program should be run in a new interpreter instead.
+        """
+
+        self.start()
+        interpreter = self.idle.get()
+        stdout_fd, stdout_file = tempfile.mkstemp(prefix='senpai_out_')
+        stderr_fd, stderr_file = tempfile.mkstemp(prefix='senpai_err_')
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+
+        try:
+            result = interpreter.run(file_name, os.path.abspath(cwd or '.'), stdout_file, stderr_file, limits)
+            exit_code = result['exit_code']
+
+            if exit_code < 0 and not result['timed_out'] and -exit_code != getattr(signal, 'SIGXCPU', None):
+                return None
+
+            # The output files can be huge; only their beginning and end are read
+            max_bytes = limits.max_output_chars or sys.maxsize
+            stdout = read_bounded_file(stdout_file, max_bytes)
+            stderr = read_bounded_file(stderr_file, max_bytes)
+
+            return ExecutionResult(
+                exit_code=exit_code,
+                stdout=stdout.getvalue(),
+                stderr=stderr.getvalue(),
+                duration=result['duration'],
+                max_rss_kb=result['max_rss_kb'],
+                truncated=stdout.truncated or stderr.truncated,
+                timed_out=result['timed_out'],
+            )
+        except (OSError, ValueError, RuntimeError):
+            return None
+        finally:
+            if not interpreter.is_alive():
+                interpreter.stop()
+                interpreter = WarmInterpreter(self.preload_modules)
+
+            self.idle.put(interpreter)
+            os.remove(stdout_file)
+            os.remove(stderr_file)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1:])
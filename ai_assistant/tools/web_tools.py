@@ -1,10 +1,9 @@
 import os
-from typing import Dict
+from typing import Any, Dict, Optional
 
-import requests
-from vertexai.preview.generative_models import FunctionDeclaration
 
 from ai_assistant.tools.base import ToolInterface
+from ai_assistant.tools.downloader import DownloadError, Downloader
 from ai_assistant.tools.file_system import MakeDirectoryTool
 
 
@@ -14,10 +13,13 @@ class DownloadFileTool(ToolInterface):
         'Use only when you need to download a file from the Internet.'
         ' Returns the file download status or error message.'
     )
-    function_declaration: FunctionDeclaration = FunctionDeclaration(
-        name=name,
-        description=description,
-        parameters={
+    concurrent_safe: bool = True
+    # Shared by all downloads, so that the connections are reused
+    downloader: Downloader = Downloader()
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
             'type': 'object',
             'properties': {
                 'url': {
@@ -26,12 +28,36 @@ class DownloadFileTool(ToolInterface):
                 'file_name': {
                     'type': 'string', 'description': 'The name of the file used to save on the disk'
                 },
+                'sha256': {
+                    'type': 'string', 'description': 'The SHA-256 checksum of the file, if known'
+                },
             },
         },
-    )
+    }
+
+    @staticmethod
+    def configure(params: Dict[str, Any]):
+        DownloadFileTool.downloader.close()
+        DownloadFileTool.downloader = Downloader(
+            timeout=params.get('timeout', 15.0),
+            chunk_size=params.get('chunk_size_kb', 1024) * 1024,
+            max_parts=params.get('max_parts', 4),
+            part_size=params.get('part_size_mb', 8) * 1024 * 1024,
+            max_connections=params.get('max_connections', 16),
+        )
+
+    @staticmethod
+    def get_resource(params: Dict[str, str]) -> Optional[str]:
+        return params.get('file_name', '').strip() or None
+
+    @staticmethod
+    def after_fork():
+        DownloadFileTool.downloader.after_fork()
 
     @staticmethod
     def use(params: Dict[str, str]) -> str:
+        import requests
+
         url = params['url'].strip()
         file_name = params['file_name'].strip()
 
@@ -40,20 +66,72 @@ class DownloadFileTool(ToolInterface):
             if dir_name:
                 MakeDirectoryTool.use({'dir_name': dir_name})
 
-            response = requests.get(url, timeout=15)
-            # Check if the request was successful
-            if response.status_code == 200:
-                # Open the file in write mode
-                with open(file_name, 'wb') as file:
-                    # Write the contents of the response to the file
-                    for chunk in response.iter_content(chunk_size=1024):
-                        if chunk:
-                            file.write(chunk)
-
-                return f'Successfully downloaded the file and saved it as: {file_name}'
-            # Else
-            return f'* Error:: Failed to download file {url}. HTTP response code: {response.status_code}'
+            result = DownloadFileTool.downloader.download(url, file_name, params.get('sha256'))
+            return f'Successfully downloaded the file and saved it as: {result.to_text()}'
         except requests.exceptions.Timeout:
             return f'* Error: The request timed out for {url}'
+        except DownloadError as de:
+            return f'* Error:: {de}'
         except Exception as ex:
             return f'* Error:: Failed to download {url} because of the following error: {ex}'
+
+
+class DownloadFilesTool(ToolInterface):
+    name: str = 'DownloadFilesTool'
+    description: str = (
+        'Use only when you need to download several files from the Internet at once.'
+        ' Returns the download status or error message of each file.'
+    )
+    # The number of files downloaded at the same time
+    max_workers: int = 4
+    function_declaration: Dict[str, Any] = {
+        'name': name,
+        'description': description,
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'urls': {
+                    'type': 'array', 'items': {'type': 'string'}, 'description': 'URLs of the files'
+                },
+                'file_names': {
+                    'type': 'array',
+                    'items': {'type': 'string'},
+                    'description': 'The names of the files used to save on the disk, in the same order as the URLs'
+                },
+            },
+        },
+    }
+
+    @staticmethod
+    def configure(params: Dict[str, Any]):
+        DownloadFilesTool.max_workers = params.get('max_workers', 4)
+
+    @staticmethod
+    def use(params: Dict[str, Any]) -> str:
+        urls = [url.strip() for url in params.get('urls', [])]
+        file_names = [file_name.strip() for file_name in params.get('file_names', [])]
+
+        if not urls or len(urls) != len(file_names):
+            return (
+                '* Error: The `urls` and `file_names` must be non-empty and of the same length!'
+                ' Please use the function based on the description provided.'
+            )
+
+        for dir_name in {os.path.dirname(file_name) for file_name in file_names}:
+            if dir_name:
+                MakeDirectoryTool.use({'dir_name': dir_name})
+
+        results = DownloadFileTool.downloader.download_all(
+            [(url, file_name, None) for url, file_name in zip(urls, file_names)], DownloadFilesTool.max_workers
+        )
+
+        lines = []
+        for url, result in zip(urls, results):
+            if isinstance(result, DownloadError):
+                lines.append(f'* Error:: {result}')
+            elif isinstance(result, Exception):
+                lines.append(f'* Error:: Failed to download {url} because of the following error: {result}')
+            else:
+                lines.append(f'Successfully downloaded the file and saved it as: {result.to_text()}')
+
+        return '\n'.join(lines)
@@ -0,0 +1,194 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class Span(object):
+    """
+    A timed section of the work, e.g., a step, a model call, or a tool use.
+    """
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, category: str, attributes: Dict[str, Any]):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+
+    def set(self, **attributes):
+        """
+        Add attributes to the span, e.g., the number of tokens of a model call.
+        """
+
+        self.attributes.update(attributes)
+
+
+class NullSpan(Span):
+    """
+    The span given out while tracing is disabled; it records nothing.
+    """
+
+    def __init__(self):
+        super().__init__(0, None, '', '', {})
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """
+    Record nested, timed spans of the agent's work, to be exported as JSON Lines or in the
+    Chrome trace format (viewable in `chrome://tracing` or Perfetto) and summarized per category.
+    The nesting follows the context, so the spans of the tools run in worker threads by
+    `asyncio.to_thread` are children of their step. While disabled, tracing costs almost nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: List[Span] = []
+        self.origin = time.perf_counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._current: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = 'other', **attributes) -> Iterator[Span]:
+        """
+        Time the enclosed code as a span.
+
+        :param name: The name of the span, e.g., the name of a tool.
+        :param category: The kind of the span, e.g., `model` or `tool`, used to group the summary.
+        :param attributes: Any details to record with the span.
+        :return: The span, to add attributes to.
+        """
+
+        if not self.enabled:
+            yield NULL_SPAN
+            return
+
+        parent = self._current.get()
+        span = Span(next(self._ids), parent.span_id if parent else None, name, category, attributes)
+        token = self._current.set(span)
+
+        try:
+            yield span
+        except BaseException as ex:
+            span.set(error=type(ex).__name__)
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            self._current.reset(token)
+
+            with self._lock:
+                self.spans.append(span)
+
+    def to_records(self) -> List[Dict[str, Any]]:
+        """
+        Get the spans as dictionaries, in the order they started. Times are in seconds since
+        the tracer started.
+
+        :return: The records.
+        """
+
+        with self._lock:
+            spans = sorted(self.spans, key=lambda item: item.start)
+
+        return [
+            {
+                'id': span.span_id,
+                'parent': span.parent_id,
+                'name': span.name,
+                'category': span.category,
+                'start': round(span.start - self.origin, 6),
+                'duration': round(span.duration, 6),
+                'thread': span.thread_id,
+                'attributes': span.attributes,
+            }
+            for span in spans
+        ]
+
+    def export_jsonl(self, file_name: str):
+        with open(file_name, 'w', encoding='utf-8') as out_file:
+            for record in self.to_records():
+                out_file.write(json.dumps(record, default=str))
+                out_file.write('\n')
+
+    def export_chrome_trace(self, file_name: str):
+        pid = os.getpid()
+        events = [
+            {
+                'name': record['name'],
+                'cat': record['category'],
+                'ph': 'X',
+                'ts': round(record['start'] * 1e6, 1),
+                'dur': round(record['duration'] * 1e6, 1),
+                'pid': pid,
+                'tid': record['thread'],
+                'args': record['attributes'],
+            }
+            for record in self.to_records()
+        ]
+
+        with open(file_name, 'w', encoding='utf-8') as out_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out_file, default=str)
+
+    def summary(self) -> str:
+        """
+        Get a human-readable summary of the time spent, per category and name of the spans.
+        The share is relative to the wall time, so spans running concurrently can add up to more.
+
+        :return: The summary.
+        """
+
+        groups: Dict[tuple, List[float]] = {}
+        with self._lock:
+            for span in self.spans:
+                groups.setdefault((span.category, span.name), []).append(span.duration)
+
+        sessions = groups.get(('session', 'session'), [])
+        wall_time = sum(sessions) or (time.perf_counter() - self.origin)
+
+        lines = [
+            f'Trace summary (wall time: {wall_time:.2f} s)',
+            f'{"category":<10} {"name":<24} {"count":>6} {"total s":>9} {"mean s":>8} {"p95 s":>8} {"max s":>8} {"share":>6}',
+        ]
+
+        for (category, name), durations in sorted(groups.items(), key=lambda item: -sum(item[1])):
+            durations = sorted(durations)
+            total = sum(durations)
+            p95 = durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+            lines.append(
+                f'{category:<10} {name[:24]:<24} {len(durations):>6} {total:>9.3f} {total / len(durations):>8.3f}'
+                f' {p95:>8.3f} {durations[-1]:>8.3f} {100 * total / wall_time:>5.1f}%'
+            )
+
+        return '\n'.join(lines)
+
+
+# The tracer used throughout the package
+TRACER = Tracer()
+
+
+def trace(name: str, category: str = 'other', **attributes):
+    """
+    Time the enclosed code as a span of the package's tracer, e.g.,
+    `with trace('pylint', 'lint', file_name=file_name): ...`.
+    """
+
+    return TRACER.span(name, category, **attributes)
@@ -0,0 +1,549 @@
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import struct
+import sys
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from ai_assistant.cache import hash_text
+from ai_assistant.tools.paging import format_size
+
+
+# The inotify events that change the files of a directory
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_hidden(name: str) -> bool:
+    return name.startswith('.') or name == '__pycache__'
+
+
+def is_senpai_state(name: str) -> bool:
+    # The checkpoint, the snapshots, and the temporary files of the assistant itself
+    return name.startswith('.senpai') or name == '__pycache__'
+
+
+def walk_tree(
+        root: str,
+        include_hidden: bool = False
+) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+    """
+    List the directories and files of a directory tree, other than the hidden ones and `__pycache__`.
+
+    :param root: The directory.
+    :param include_hidden: Whether to also list the hidden ones, e.g., `.env`, other than the state
+     of the assistant itself, such as its checkpoint and snapshots.
+    :return: The path of every directory relative to the directory, and of every file, with its status.
+    """
+
+    dirs, files = [], []
+    is_skipped = is_senpai_state if include_hidden else is_hidden
+
+    for dir_name, dir_names, file_names in os.walk(root):
+        dir_names[:] = [name for name in dir_names if not is_skipped(name)]
+        dirs.extend(os.path.relpath(os.path.join(dir_name, name), root) for name in dir_names)
+
+        for name in file_names:
+            if is_skipped(name):
+                continue
+
+            path = os.path.join(dir_name, name)
+            try:
+                files.append((os.path.relpath(path, root), os.stat(path)))
+            except OSError:
+                continue
+
+    return dirs, files
+
+
+class FileInfo(object):
+    """
+    What is known about a file of the workspace.
+    """
+
+    __slots__ = ('size', 'mtime_ns', 'digest', 'lint_result', 'lint_generation')
+
+    def __init__(self, size: int, mtime_ns: int, digest: Optional[str] = None):
+        """
+        :param size: The size, in bytes.
+        :param mtime_ns: The modification time.
+        :param digest: The hash of the content, if known.
+        """
+
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+        # The result of the last lint of a .py file, and the generation of the Python files then
+        self.lint_result: Optional[str] = None
+        self.lint_generation = -1
+
+
+class InotifyWatcher(object):
+    """
+    Watch directories for changes made by anything, e.g., by the programs run, via Linux's inotify,
+    so that only the changed paths need to be checked again. It is used via `ctypes`.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'Failed to initialize inotify')
+
+        self.dirs: Dict[int, str] = {}
+
+    @staticmethod
+    def is_supported() -> bool:
+        return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def watch(self, dir_name: str):
+        """
+        Watch a directory, but not its subdirectories.
+
+        :param dir_name: The absolute path of the directory.
+        """
+
+        wd = self._add_watch(self.fd, os.fsencode(dir_name), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Failed to watch {dir_name}')
+
+        self.dirs[wd] = dir_name
+
+    def read(self) -> Optional[Set[str]]:
+        """
+        Get the paths changed since the last read, without waiting.
+
+        :return: The absolute paths, or `None` if some events were lost, so that everything must be checked.
+        """
+
+        paths = set()
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return paths
+
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + name_length
+
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if mask & IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+
+                dir_name = self.dirs.get(wd)
+                if dir_name is not None:
+                    paths.add(os.path.join(dir_name, os.fsdecode(name)) if name else dir_name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WorkspaceIndex(object):
+    """
+    An in-memory index of the files and directories of the working directory: the size, the
+    modification time, the hash of the content, and the lint result of every file. The file
+    tools keep it up to date as they work; the changes made otherwise, e.g., by the programs
+    run, are found via inotify where supported, and by checking the sizes and modification
+    times of all the files otherwise. Hidden files and directories and `__pycache__` are not indexed.
+    """
+
+    def __init__(self):
+        # The absolute path of the working directory, if indexed
+        self.root: Optional[str] = None
+        self.files: Dict[str, FileInfo] = {}
+        self.dirs: Set[str] = set()
+        # Whether every file is indexed, i.e., there are not too many
+        self.complete = False
+        self.max_files = 2000
+        self.watcher: Optional[InotifyWatcher] = None
+        # The paths not to index, relative to the working directory, e.g., a log file
+        self.exclude: Set[str] = set()
+        # Incremented on every change, and on every change of a .py file, respectively
+        self.version = 0
+        self.python_generation = 0
+        self.summary_version = -1
+        self._lock = threading.RLock()
+
+    def reset(self, root: Optional[str], watch: bool = True, max_files: int = 2000, exclude: Iterable[str] = ()):
+        """
+        Index a directory afresh, or stop indexing.
+
+        :param root: The directory, or `None` to stop indexing.
+        :param watch: Whether to watch the directory for changes via inotify, if supported.
+        :param max_files: The maximum number of files to index.
+        :param exclude: The paths not to index, relative to the directory.
+        """
+
+        with self._lock:
+            self.close()
+            self.root = os.path.abspath(root) if root is not None else None
+            self.files, self.dirs = {}, set()
+            self.max_files = max_files
+            self.exclude = {os.path.normpath(path) for path in exclude}
+            self.summary_version = -1
+
+            if self.root is None:
+                return
+
+            if watch and InotifyWatcher.is_supported():
+                try:
+                    self.watcher = InotifyWatcher()
+                except OSError:
+                    self.watcher = None
+
+            self.scan()
+
+    def close(self):
+        with self._lock:
+            if self.watcher is not None:
+                self.watcher.close()
+                self.watcher = None
+
+    def get_key(self, path: str) -> Optional[str]:
+        """
+        Get the key of a path: its path relative to the working directory.
+
+        :param path: The path.
+        :return: The key, `''` for the working directory itself, or `None` if the path is not indexed,
+         i.e., outside the working directory, hidden, or excluded.
+        """
+
+        if self.root is None:
+            return None
+
+        key = os.path.relpath(os.path.abspath(path), self.root)
+
+        if key == '.':
+            return ''
+        if key.startswith('..') or key in self.exclude or any(is_hidden(name) for name in key.split(os.sep)):
+            return None
+
+        return key
+
+    def _watch(self, dir_name: str):
+        if self.watcher is None:
+            return
+
+        try:
+            self.watcher.watch(dir_name)
+        except OSError:
+            # E.g., too many directories; fall back to checking all the files
+            self.close()
+
+    def _scan_dir(self, key: str, files: Dict[str, FileInfo], dirs: Set[str]) -> bool:
+        """
+        Index a directory and its subdirectories.
+
+        :return: Whether all of the files could be indexed.
+        """
+
+        pending = [key]
+
+        while pending:
+            current = pending.pop()
+            dir_name = os.path.join(self.root, current) if current else self.root
+            dirs.add(current)
+            self._watch(dir_name)
+
+            try:
+                with os.scandir(dir_name) as items:
+                    for item in items:
+                        item_key = os.path.join(current, item.name) if current else item.name
+
+                        if is_hidden(item.name) or item_key in self.exclude:
+                            continue
+                        if item.is_dir(follow_symlinks=False):
+                            pending.append(item_key)
+                            continue
+
+                        if len(files) >= self.max_files:
+                            return False
+
+                        stat = item.stat()
+                        old = self.files.get(item_key)
+
+                        if old is not None and old.size == stat.st_size and old.mtime_ns == stat.st_mtime_ns:
+                            files[item_key] = old
+                        else:
+                            files[item_key] = FileInfo(stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+
+        return True
+
+    def scan(self):
+        """
+        Check all the files again, keeping what is known of those unchanged.
+        """
+
+        with self._lock:
+            if self.root is None:
+                return
+
+            files, dirs = {}, set()
+            self.complete = self._scan_dir('', files, dirs)
+            self._set_all(files, dirs)
+
+    def _set_all(self, files: Dict[str, FileInfo], dirs: Set[str]):
+        changed = [
+            key for key in set(files) | set(self.files) if files.get(key) is not self.files.get(key)
+        ]
+
+        if changed or dirs != self.dirs:
+            self.version += 1
+        if any(key.endswith('.py') for key in changed):
+            self.python_generation += 1
+
+        self.files, self.dirs = files, dirs
+
+    def _update_path(self, path: str):
+        key = self.get_key(path)
+        if not key:
+            return
+
+        try:
+            stat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            stat = None
+
+        if stat is not None and os.path.isdir(path):
+            files, dirs = dict(self.files), set(self.dirs)
+            self.complete = self._scan_dir(key, files, dirs) and self.complete
+            self._set_all(files, dirs)
+            return
+
+        old = self.files.get(key)
+
+        if stat is None:
+            removed = [name for name in self.files if name == key or name.startswith(key + os.sep)]
+            removed_dirs = {name for name in self.dirs if name == key or name.startswith(key + os.sep)}
+            if removed or removed_dirs:
+                self._set_all(
+                    {name: info for name, info in self.files.items() if name not in removed},
+                    self.dirs - removed_dirs
+                )
+        elif old is None or old.size != stat.st_size or old.mtime_ns != stat.st_mtime_ns:
+            if old is None and len(self.files) >= self.max_files:
+                self.complete = False
+                return
+
+            self.files[key] = FileInfo(stat.st_size, stat.st_mtime_ns)
+            self.version += 1
+            if key.endswith('.py'):
+                self.python_generation += 1
+
+    def refresh(self):
+        """
+        Find the changes made since the last refresh by anything other than the file tools.
+        """
+
+        with self._lock:
+            if self.root is None:
+                return
+
+            paths = self.watcher.read() if self.watcher is not None else None
+
+            if paths is None:
+                self.scan()
+                return
+
+            for path in sorted(paths):
+                self._update_path(path)
+
+    def get(self, path: str) -> Optional[FileInfo]:
+        """
+        Get what is known about a file.
+
+        :param path: The file.
+        :return: The information, or `None` if the file is not indexed.
+        """
+
+        with self._lock:
+            key = self.get_key(path)
+            return self.files.get(key) if key else None
+
+    def is_dir(self, path: str) -> Optional[bool]:
+        """
+        Check whether a directory exists, as per the index.
+
+        :param path: The directory.
+        :return: Whether it exists, or `None` if unknown, i.e., the path is not indexed.
+        """
+
+        with self._lock:
+            key = self.get_key(path)
+
+            if key is None:
+                return None
+            if key in self.dirs:
+                return True
+
+            return False if self.complete else None
+
+    def record_dir(self, path: str):
+        """
+        Record a directory created by a tool, together with any of its parents.
+        """
+
+        with self._lock:
+            key = self.get_key(path)
+
+            while key and key not in self.dirs:
+                self.dirs.add(key)
+                self._watch(os.path.join(self.root, key))
+                self.version += 1
+                key = os.path.dirname(key)
+
+    def record_write(self, path: str, content: str):
+        """
+        Record a file written by a tool.
+
+        :param path: The file.
+        :param content: The content written.
+        """
+
+        with self._lock:
+            key = self.get_key(path)
+            if not key:
+                return
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return
+
+            self.files[key] = FileInfo(stat.st_size, stat.st_mtime_ns, hash_text(content))
+            self.record_dir(os.path.dirname(path) or '.')
+            self.version += 1
+            if key.endswith('.py'):
+                self.python_generation += 1
+
+    def is_unchanged(self, path: str, content: str) -> bool:
+        """
+        Check whether a file already has the given content, and has not been changed since it was
+        indexed, in which case writing the content again is unnecessary.
+
+        :param path: The file.
+        :param content: The new content.
+        :return: True if the file already has this content.
+        """
+
+        with self._lock:
+            info = self.get(path)
+            if info is None:
+                return False
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+
+            if stat.st_size != info.size or stat.st_mtime_ns != info.mtime_ns:
+                return False
+
+            if info.digest is None:
+                try:
+                    with open(path, 'rb') as in_file:
+                        info.digest = hashlib.sha256(in_file.read()).hexdigest()
+                except OSError:
+                    return False
+
+            return info.digest == hash_text(content)
+
+    def get_lint_result(self, path: str) -> Optional[str]:
+        """
+        Get the result of the last lint of a .py file, if neither it nor any other .py file has changed since.
+
+        :param path: The file.
+        :return: The result, or `None` if unknown.
+        """
+
+        with self._lock:
+            info = self.get(path)
+            if info is None or info.lint_generation != self.python_generation:
+                return None
+
+            return info.lint_result
+
+    def record_lint(self, path: str, result: str):
+        """
+        Record the result of linting a .py file.
+        """
+
+        with self._lock:
+            info = self.get(path)
+            if info is not None:
+                info.lint_result = result
+                info.lint_generation = self.python_generation
+
+    def summary(self, max_entries: int = 40) -> str:
+        """
+        Get a compact summary of the files, with their sizes and, for the .py files, whether Pylint
+        found any errors in them.
+
+        :param max_entries: The maximum number of files to list.
+        :return: The summary.
+        """
+
+        with self._lock:
+            keys = sorted(self.files)
+            entries = []
+
+            for key in keys[:max_entries]:
+                info = self.files[key]
+                details = format_size(info.size)
+                if info.lint_result is not None:
+                    details += ', lint: ' + ('errors' if info.lint_result else 'ok')
+                entries.append(f'{key} ({details})')
+
+            if len(keys) > max_entries:
+                entries.append(f'... and {len(keys) - max_entries} more')
+            if not self.complete:
+                entries.append('... and possibly more, not indexed')
+
+            return f'Files in the working directory: {"; ".join(entries) if entries else "none"}'
+
+    def get_changed_summary(self, max_entries: int = 40) -> Optional[str]:
+        """
+        Get the summary of the files, only if they changed since the last summary.
+
+        :param max_entries: The maximum number of files to list.
+        :return: The summary, or `None` if unchanged.
+        """
+
+        with self._lock:
+            if self.root is None or self.version == self.summary_version:
+                return None
+
+            self.summary_version = self.version
+            return self.summary(max_entries)
+
+
+# The index of the current working directory, shared by the tools
+WORKSPACE = WorkspaceIndex()
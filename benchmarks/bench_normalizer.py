@@ -0,0 +1,145 @@
+"""
+Micro-benchmark the normalization of the file contents generated by a model, as done by
+`WriteFileTool`, on large synthetic Python modules, comparing it with the earlier approach of
+decoding all escape sequences repeatedly and fixing f-strings with a regular expression.
+
+The earlier approach turns the `\\n` in string literals into actual newlines, which
+`PythonLinter.fix_unterminated_string_literals` then repairs by compiling the module again once
+per broken literal, so both are timed together with that repair, as `WriteFileTool` runs them.
+For each kind and size of module and level of escaping, the time taken and whether the result
+is the original module, or at least compiles, are reported. The earlier approach is quick on the
+`mixed` modules only because the repair gives up at the first error it cannot fix.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_normalizer
+    python -m benchmarks.bench_normalizer --lines 100 500 --levels 1 --repeat 5
+"""
+import argparse
+import codecs
+import contextlib
+import io
+import re
+import time
+import warnings
+from typing import Callable, Tuple
+
+from ai_assistant.tools.code_lint import PythonLinter
+from ai_assistant.tools.normalizer import compiles, normalize_content
+
+
+# The kinds of synthetic modules: with newline escape sequences in string literals only, and also
+# with non-ASCII comments and Windows paths, which decoding with `unicode_escape` mangles
+TEMPLATES = {
+    'plain': '''
+def process_{num}(records, separator='\\n'):
+    """
+    Process the records of batch {num}: join them with the separator.
+    """
+
+    text = separator.join(str(record) for record in records)
+    print(f'Batch {num}:\\n{{text}}')
+    return text
+''',
+    'mixed': '''
+def process_{num}(records, separator='\\n'):
+    """
+    Process the records of batch {num}: join them with the separator.
+    """
+
+    # Totals par catégorie, 合計 {num}
+    label = f'{{records[0]}}: {{len(records)}}'
+    text = separator.join(str(record) for record in records)
+    print(f"Batch {num}:\\t{{label}}\\n{{text}}")
+    return {{'batch': {num}, 'text': text, 'path': 'C:\\\\data\\\\{num}.csv'}}
+''',
+}
+
+
+def make_module(template: str, num_lines: int) -> str:
+    num_functions = max(1, num_lines // template.count('\n'))
+    return 'import os\n' + ''.join(template.format(num=num) for num in range(num_functions))
+
+
+def escape(text: str, levels: int) -> str:
+    for _ in range(levels):
+        text = text.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    return text
+
+
+def legacy_normalize(content: str, is_python: bool) -> str:
+    """
+    The earlier normalization, kept here for comparison.
+    """
+
+    old_text = content
+    for _ in range(10):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            content = codecs.decode(content, 'unicode_escape')
+        if content == old_text:
+            break
+        old_text = content
+
+    if is_python:
+        def replacer(match):
+            s = match.group(0)
+            if s.startswith("f'"):
+                print('Replacing 1:', 'f"' + s[2:-1].replace('"', '\\"') + '"')
+                return 'f"' + s[2:-1].replace('"', '\\"') + '"'
+            print('Replacing 2:', "f'" + s[2:-1].replace("'", "\\'") + "'")
+            return "f'" + s[2:-1].replace("'", "\\'") + "'"
+
+        content = re.sub(r"f'{.*?}'|f\"{.*?}\"", replacer, content)
+
+    return content
+
+
+def measure(normalize: Callable[[str, bool], str], content: str, repeat: int) -> Tuple[float, str]:
+    """
+    :return: The best time of the runs, in seconds, and the result.
+    """
+
+    best = float('inf')
+    result = content
+
+    for _ in range(repeat):
+        # The earlier approach prints every f-string it replaces
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = normalize(content, True)
+            result, _ = PythonLinter.fix_unterminated_string_literals(result, 'module.py')
+            best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark the normalization of generated file contents.')
+    parser.add_argument('--lines', type=int, nargs='+', default=[100, 500, 1000], help='The sizes of the modules')
+    parser.add_argument('--levels', type=int, nargs='+', default=[0, 1, 2], help='The levels of escaping')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each case')
+    args = parser.parse_args()
+
+    print(f'{"module":<7} {"lines":>7} {"levels":>6} {"legacy s":>10} {"new s":>10} {"speedup":>8} {"legacy ok":>10} {"new ok":>8}')
+
+    for kind, num_lines in [(kind, num_lines) for kind in TEMPLATES for num_lines in args.lines]:
+        module = make_module(TEMPLATES[kind], num_lines)
+
+        for levels in args.levels:
+            content = escape(module, levels)
+            results = [measure(normalize, content, args.repeat) for normalize in (legacy_normalize, normalize_content)]
+            (legacy_time, legacy_result), (new_time, new_result) = results
+
+            def status(result: str) -> str:
+                return 'yes' if result == module else 'compiles' if compiles(result) else 'no'
+
+            print(
+                f'{kind:<7} {module.count(chr(10)):>7} {levels:>6} {legacy_time:>10.4f} {new_time:>10.4f}'
+                f' {legacy_time / max(new_time, 1e-9):>7.1f}x {status(legacy_result):>10} {status(new_result):>8}'
+            )
+
+
+if __name__ == '__main__':
+    main()
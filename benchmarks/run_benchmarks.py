@@ -0,0 +1,286 @@
+"""
+Benchmark the assistant end to end on the bundled prompts, without any model endpoint.
+
+Each `prompts/prompt_*.txt` scenario is run through `Assistant.run` and the real tools, with the
+model's responses replayed from `benchmarks/recordings/<prompt name>.json`. Every run takes place
+in a new process and a new working directory. The steps, the wall time, the time spent in the
+model, the tools, linting, and program execution, and the peak memory are reported, and compared
+with a stored baseline.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run_benchmarks                   # Run and compare with the baseline
+    python -m benchmarks.run_benchmarks --save-baseline   # Run and store the results as the baseline
+"""
+import argparse
+import functools
+import glob
+import http.server
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(ROOT_DIR, 'benchmarks')
+# Replaced in the recordings with the URL of a local server of the `fixtures` directory
+SERVER_PLACEHOLDER = '${BENCHMARK_SERVER}'
+
+# The metrics compared with the baseline, and the smallest change of each that counts
+TIME_METRICS = ('wall_time', 'model_time', 'tool_time', 'lint_time', 'execution_time')
+MIN_TIME_CHANGE = 0.05
+MEMORY_METRICS = ('peak_memory_mb', 'programs_peak_memory_mb')
+MIN_MEMORY_CHANGE = 10.0
+
+
+def run_scenario(prompt_file: str, recording_file: str, settings_file: str) -> Dict[str, Any]:
+    """
+    Run a single scenario in the current process and working directory.
+
+    :param prompt_file: The prompt.
+    :param recording_file: The model's responses to replay.
+    :param settings_file: The settings of the assistant.
+    :return: The metrics.
+    """
+
+    from ai_assistant.assistant import Assistant
+    from ai_assistant.tracing import TRACER
+
+    assistant = Assistant(
+        tools=[
+            'WriteFileTool', 'CodeExecutionTool', 'FinalAnswerTool', 'MakeDirectoryTool',
+            'ReadFileTool', 'ListDirectoryTool', 'DownloadFileTool',
+        ],
+        verbose=False,
+        settings_file=settings_file,
+        settings_overrides={
+            'Assistant': {'backend': 'replay', 'prompt_file': prompt_file, 'verbose': False},
+            'Replay': {'recording_file': recording_file, 'latency': 0.0},
+            'Tracing': {'enabled': True, 'summary': False, 'jsonl_file': 'trace.jsonl'},
+            # The files of the benchmark itself
+            'Workspace': {'exclude': ['session.log', 'recording.json', 'metrics.json', 'trace.jsonl']},
+        }
+    )
+    result = assistant.run()
+
+    records = TRACER.to_records()
+
+    def total_time(category: str) -> float:
+        return round(sum(record['duration'] for record in records if record['category'] == category), 4)
+
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # The programs inherit the peak of this process when forked, so only a larger peak is theirs
+    programs_peak_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if programs_peak_memory <= peak_memory:
+        programs_peak_memory = 0
+
+    return {
+        'status': result['status'],
+        'steps': result['steps'],
+        'wall_time': total_time('session'),
+        'model_time': total_time('model'),
+        'tool_time': total_time('tool'),
+        'lint_time': total_time('lint'),
+        'execution_time': total_time('execution'),
+        'peak_memory_mb': round(peak_memory / 1024, 1),
+        'programs_peak_memory_mb': round(programs_peak_memory / 1024, 1),
+    }
+
+
+class FixtureRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_fixture_server() -> http.server.ThreadingHTTPServer:
+    """
+    Serve the `fixtures` directory on a free local port, standing in for the Internet.
+
+    :return: The server, running in a background thread.
+    """
+
+    handler = functools.partial(FixtureRequestHandler, directory=os.path.join(BENCHMARKS_DIR, 'fixtures'))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def prepare_recording(recording_file: str, work_dir: str, server_url: str) -> str:
+    with open(recording_file, 'r', encoding='utf-8') as in_file:
+        text = in_file.read()
+
+    file_name = os.path.join(work_dir, 'recording.json')
+    with open(file_name, 'w', encoding='utf-8') as out_file:
+        out_file.write(text.replace(SERVER_PLACEHOLDER, server_url))
+
+    return file_name
+
+
+def run_in_process(prompt_file: str, recording_file: str, settings_file: str, server_url: str) -> Dict[str, Any]:
+    """
+    Run a single scenario in a new process and a new working directory.
+
+    :return: The metrics.
+    """
+
+    work_dir = tempfile.mkdtemp(prefix='senpai_bench_')
+
+    try:
+        metrics_file = os.path.join(work_dir, 'metrics.json')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+
+        with open(os.path.join(work_dir, 'session.log'), 'w', encoding='utf-8') as log_file:
+            process = subprocess.run(
+                [
+                    sys.executable, '-m', 'benchmarks.run_benchmarks', '--scenario',
+                    prompt_file, prepare_recording(recording_file, work_dir, server_url), settings_file, metrics_file,
+                ],
+                cwd=work_dir,
+                env=env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+
+        if process.returncode != 0 or not os.path.exists(metrics_file):
+            with open(os.path.join(work_dir, 'session.log'), 'r', encoding='utf-8') as log_file:
+                raise RuntimeError(f'The scenario failed:\n{log_file.read()[-2000:]}')
+
+        with open(metrics_file, 'r', encoding='utf-8') as in_file:
+            return json.load(in_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def aggregate(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine the metrics of several runs of a scenario, taking the median of each number.
+    """
+
+    metrics = dict(runs[0])
+    for key in TIME_METRICS + MEMORY_METRICS:
+        metrics[key] = round(statistics.median(run[key] for run in runs), 4)
+
+    return metrics
+
+
+def compare(name: str, metrics: Dict[str, Any], baseline: Optional[Dict[str, Any]], threshold: float) -> List[str]:
+    """
+    Find the regressions of a scenario with respect to its baseline.
+
+    :return: The regressions, if any.
+    """
+
+    if baseline is None:
+        return []
+
+    regressions = []
+
+    for key in ('status', 'steps'):
+        if metrics[key] != baseline.get(key):
+            regressions.append(f'{name}: {key} changed from {baseline.get(key)} to {metrics[key]}')
+
+    for keys, min_change in ((TIME_METRICS, MIN_TIME_CHANGE), (MEMORY_METRICS, MIN_MEMORY_CHANGE)):
+        for key in keys:
+            old, new = baseline.get(key), metrics[key]
+            if old is not None and new > old * (1 + threshold) and new - old > min_change:
+                regressions.append(f'{name}: {key} went up from {old} to {new} ({100 * (new - old) / max(old, 1e-9):+.0f}%)')
+
+    return regressions
+
+
+def format_table(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]]) -> str:
+    columns = ('steps', 'wall_time', 'model_time', 'tool_time', 'lint_time', 'execution_time', 'peak_memory_mb')
+    headers = ('steps', 'wall s', 'model s', 'tools s', 'lint s', 'exec s', 'peak MB')
+    lines = [f'{"scenario":<36} {"status":<10}' + ''.join(f'{header:>16}' for header in headers)]
+
+    for name, metrics in results.items():
+        cells = []
+        for key in columns:
+            value = metrics[key]
+            old = baseline.get(name, {}).get(key)
+            text = f'{value:.1f}' if key in MEMORY_METRICS else f'{value:.3f}' if key in TIME_METRICS else f'{value}'
+
+            if old is not None and key in TIME_METRICS + MEMORY_METRICS:
+                text += f' ({100 * (value - old) / old:+.0f}%)' if old else ' (n/a)'
+
+            cells.append(f'{text:>16}')
+
+        lines.append(f'{name[:36]:<36} {metrics["status"]:<10}' + ''.join(cells))
+
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the assistant on the bundled prompts with replayed responses.')
+    parser.add_argument('--prompts', default=os.path.join(ROOT_DIR, 'prompts', 'prompt_*.txt'), help='The prompt files')
+    parser.add_argument('--recordings', default=os.path.join(BENCHMARKS_DIR, 'recordings'), help='The recordings directory')
+    parser.add_argument('--settings', default=os.path.join(ROOT_DIR, 'settings.toml'), help='The settings file')
+    parser.add_argument('--baseline', default=os.path.join(BENCHMARKS_DIR, 'baseline.json'), help='The baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each scenario')
+    parser.add_argument('--threshold', type=float, default=0.3, help='The relative slowdown counted as a regression')
+    parser.add_argument('--scenario', nargs=4, metavar=('PROMPT', 'RECORDING', 'SETTINGS', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        prompt_file, recording_file, settings_file, output_file = args.scenario
+        metrics = run_scenario(prompt_file, recording_file, settings_file)
+
+        with open(output_file, 'w', encoding='utf-8') as out_file:
+            json.dump(metrics, out_file)
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as in_file:
+            baseline = json.load(in_file)['scenarios']
+
+    server = start_fixture_server()
+    server_url = f'http://127.0.0.1:{server.server_address[1]}'
+    results = {}
+    regressions = []
+
+    for prompt_file in sorted(glob.glob(args.prompts)):
+        name = os.path.splitext(os.path.basename(prompt_file))[0]
+        recording_file = os.path.join(args.recordings, f'{name}.json')
+
+        if not os.path.exists(recording_file):
+            print(f'Skipping {name}: no recording found at {recording_file}')
+            continue
+
+        print(f'Running {name} {args.repeat} time(s)...')
+        runs = [
+            run_in_process(os.path.abspath(prompt_file), recording_file, os.path.abspath(args.settings), server_url)
+            for _ in range(args.repeat)
+        ]
+        results[name] = aggregate(runs)
+        regressions.extend(compare(name, results[name], baseline.get(name), args.threshold))
+
+    server.shutdown()
+    print()
+    print(format_table(results, baseline))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as out_file:
+            json.dump({'python': sys.version.split()[0], 'platform': sys.platform, 'scenarios': results}, out_file, indent=2)
+            out_file.write('\n')
+        print(f'\nThe baseline was saved to {args.baseline}')
+    elif not baseline:
+        print('\nNo baseline to compare with; run with --save-baseline to store one')
+    elif regressions:
+        print('\nRegressions:\n' + '\n'.join(regressions))
+        sys.exit(1)
+    else:
+        print('\nNo regressions')
+
+
+if __name__ == '__main__':
+    main()
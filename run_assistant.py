@@ -1,19 +1,110 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
 from ai_assistant.assistant import Assistant
-from ai_assistant.tools.base import FinalAnswerTool
-from ai_assistant.tools.file_system import WriteFileTool, MakeDirectoryTool
-from ai_assistant.tools.code_execution import CodeExecutionTool
-# from ai_assistant.tools.web_tools import DownloadFileTool
+
+
+# The tools of the assistant, by name, so that only their modules are imported
+TOOLS = ['WriteFileTool', 'CodeExecutionTool', 'FinalAnswerTool', 'MakeDirectoryTool', ]  # 'DownloadFileTool'
+# The dependencies that take long to import, which should be imported only when needed
+HEAVY_MODULES = ('vertexai', 'pylint', 'requests')
+
+
+def start_only(settings_file: str):
+    """
+    Create the assistant without running it, and report the time taken and the heavy modules imported.
+
+    :param settings_file: The settings file.
+    """
+
+    start_time = time.perf_counter()
+    Assistant(tools=TOOLS, verbose=False, settings_file=settings_file)
+    duration = time.perf_counter() - start_time
+
+    print()
+    print(json.dumps({
+        'create_time': duration,
+        'modules': [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+def measure_startup(settings_file: str, repeat: int):
+    """
+    Measure the time taken to start the assistant, from launching the interpreter until the
+    assistant is ready to send the prompt, over several new processes.
+
+    :param settings_file: The settings file.
+    :param repeat: The number of processes to start.
+    """
+
+    total_times, create_times = [], []
+    modules = []
+
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, __file__, '--start-only', '--settings', settings_file], capture_output=True, text=True
+        )
+        total_times.append(time.perf_counter() - start_time)
+
+        if process.returncode != 0:
+            print(f'* Error: The assistant failed to start:\n{(process.stdout + process.stderr)[-2000:]}')
+            sys.exit(1)
+
+        report = json.loads(process.stdout.strip().splitlines()[-1])
+        create_times.append(report['create_time'])
+        modules = report['modules']
+
+    total_time, create_time = statistics.median(total_times), statistics.median(create_times)
+    print(f'Startup time, median of {repeat} run(s): {total_time:.3f} s')
+    print(f'  Interpreter and imports: {total_time - create_time:.3f} s')
+    print(f'  Settings, backend, and tools: {create_time:.3f} s')
+    print(f'Heavy modules imported at startup: {", ".join(modules) or "none"}')
 
 
 def main():
     """
     Create an assistant. Provide it with a set of tools. Then run it.
-    The prompt file to use is specified in `settings.toml`.
+    The prompt file to use is specified in `settings.toml`, or the settings file given.
     """
 
+    parser = argparse.ArgumentParser(description='Run the AI assistant on the prompt given in settings.toml.')
+    parser.add_argument(
+        '--measure-startup', type=int, nargs='?', const=5, metavar='RUNS',
+        help='Only measure the time taken to start the assistant, over this many runs (default: 5)'
+    )
+    parser.add_argument('--settings', default=Assistant.SETTINGS_FILE_NAME, help='The settings file')
+    parser.add_argument(
+        '--resume', action='store_true', help='Continue an interrupted session from its checkpoint, if any'
+    )
+    parser.add_argument(
+        '--rollback', type=int, metavar='STEP',
+        help='Only restore the files to how they were before this step of the last session, if snapshotted'
+    )
+    parser.add_argument('--start-only', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.start_only:
+        start_only(args.settings)
+        return
+
+    if args.measure_startup:
+        measure_startup(args.settings, args.measure_startup)
+        return
+
+    if args.rollback is not None:
+        assistant = Assistant(tools=TOOLS, verbose=False, settings_file=args.settings)
+        sys.exit(0 if assistant.rollback(args.rollback) else 1)
+
     assistant = Assistant(
-        tools=[WriteFileTool, CodeExecutionTool, FinalAnswerTool, MakeDirectoryTool, ],
-        verbose=False
+        tools=TOOLS,
+        verbose=False,
+        settings_file=args.settings,
+        settings_overrides={'Checkpoint': {'enabled': True, 'resume': True}} if args.resume else None
     )
     assistant.run()
 
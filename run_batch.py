@@ -0,0 +1,39 @@
+import argparse
+import asyncio
+import os
+import time
+
+from ai_assistant.batch import load_jobs, run_batch, summarize
+
+
+def main():
+    """
+    Run many independent assistant sessions concurrently, one per prompt file, each in
+    its own working directory. The other settings are taken from `settings.toml`.
+    """
+
+    parser = argparse.ArgumentParser(description='Run the assistant on a batch of prompts.')
+    parser.add_argument('prompts', help='A directory of prompt (.txt) files or a JSON manifest of jobs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Maximum concurrent sessions')
+    parser.add_argument('--work-dir', default='batch_runs', help='Where the working directories are created')
+    parser.add_argument('--settings', default='settings.toml', help='The settings file shared by all jobs')
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.prompts)
+    print(f'Running {len(jobs)} jobs with {args.workers} workers...')
+
+    start_time = time.perf_counter()
+    results = asyncio.run(
+        run_batch(
+            jobs,
+            tools=['WriteFileTool', 'CodeExecutionTool', 'FinalAnswerTool', 'MakeDirectoryTool', ],
+            settings_file=args.settings,
+            work_root=args.work_dir,
+            max_workers=args.workers
+        )
+    )
+    print(summarize(results, time.perf_counter() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import os
+
+from ai_assistant.server import AssistantServer, serve
+
+
+def main():
+    """
+    Run the assistant as a long-running server, which keeps its workers warm and runs every job
+    submitted via HTTP in its own working directory. The other settings are taken from `settings.toml`.
+    """
+
+    parser = argparse.ArgumentParser(description='Run the assistant as a server accepting jobs via HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='The port to listen on')
+    parser.add_argument('--socket', help='A Unix socket to listen on instead of the address')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='Maximum concurrent jobs')
+    parser.add_argument('--max-queue', type=int, default=100, help='Maximum jobs waiting for a worker')
+    parser.add_argument('--work-dir', default='server_runs', help='Where the working directories are created')
+    parser.add_argument('--settings', default='settings.toml', help='The settings file shared by all jobs')
+    args = parser.parse_args()
+
+    server = AssistantServer(
+        tools=['WriteFileTool', 'CodeExecutionTool', 'FinalAnswerTool', 'MakeDirectoryTool', ],
+        settings_file=args.settings,
+        work_root=args.work_dir,
+        num_workers=args.workers,
+        max_queue=args.max_queue
+    )
+    server.start()
+
+    print(
+        f'Serving with {args.workers} workers on '
+        + (f'the Unix socket {args.socket}' if args.socket else f'http://{args.host}:{args.port}')
+    )
+
+    try:
+        serve(server, args.host, args.port, args.socket)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
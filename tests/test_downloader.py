@@ -0,0 +1,158 @@
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from ai_assistant.tools.downloader import Downloader, DownloadError
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the content of the server, with a strong ETag, honoring `Range` and `If-Range`.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.content
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        self.server.requests.append((byte_range, if_range))
+
+        if byte_range and (if_range is None or if_range == etag):
+            start, end = byte_range.split('=', 1)[1].split('-')
+            start = int(start)
+            end = min(int(end) if end else len(body) - 1, len(body) - 1)
+            data = body[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        else:
+            data = body
+            self.send_response(200)
+
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class DownloaderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/data.bin'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.content = bytes(range(256)) * 40
+        self.server.requests = []
+        self.dir_name = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir_name, 'data.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_name, ignore_errors=True)
+
+    def get_etag(self) -> str:
+        return f'"{hashlib.md5(self.server.content).hexdigest()}"'
+
+    def start_partial_download(self, num_bytes: int, validator: str):
+        with open(self.file_name + '.part', 'wb') as out_file:
+            out_file.write(self.server.content[:num_bytes])
+        with open(self.file_name + '.part.validator', 'w', encoding='utf-8') as out_file:
+            out_file.write(validator)
+
+    def read(self) -> bytes:
+        with open(self.file_name, 'rb') as in_file:
+            return in_file.read()
+
+    def test_download(self):
+        result = Downloader(max_parts=1).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(result.size, len(self.server.content))
+        self.assertEqual(os.listdir(self.dir_name), ['data.bin'])
+
+    def test_resumes_unchanged_file(self):
+        self.start_partial_download(4000, self.get_etag())
+        result = Downloader(max_parts=1).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(result.resumed_bytes, 4000)
+        self.assertEqual(self.server.requests, [('bytes=4000-', self.get_etag())])
+
+    def test_restarts_changed_file(self):
+        self.start_partial_download(4000, self.get_etag())
+        self.server.content = bytes(reversed(self.server.content))
+        result = Downloader(max_parts=1).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(result.resumed_bytes, 0)
+
+    def test_restarts_without_validator(self):
+        with open(self.file_name + '.part', 'wb') as out_file:
+            out_file.write(b'stale')
+        Downloader(max_parts=1).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(self.server.requests, [(None, None)])
+
+    def test_downloads_parts(self):
+        result = Downloader(max_parts=3, part_size=1000).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(result.parts, 11)
+        self.assertTrue(all(byte_range is not None for byte_range, _ in self.server.requests))
+
+    def test_resumes_parts(self):
+        total = len(self.server.content)
+        with open(self.file_name + '.part', 'wb') as out_file:
+            out_file.write(self.server.content[:5000] + b'\0' * (total - 5000))
+        with open(self.file_name + '.part.json', 'w', encoding='utf-8') as out_file:
+            json.dump(
+                {'total': total, 'pending': [[5000, 7999], [8000, total - 1]], 'validator': self.get_etag()}, out_file
+            )
+
+        result = Downloader(max_parts=2, part_size=3000).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(result.resumed_bytes, 5000)
+        self.assertEqual(
+            sorted(self.server.requests),
+            [('bytes=5000-7999', self.get_etag()), (f'bytes=8000-{total - 1}', self.get_etag())]
+        )
+
+    def test_restarts_parts_of_changed_file(self):
+        total = len(self.server.content)
+        with open(self.file_name + '.part', 'wb') as out_file:
+            out_file.write(self.server.content[:5000] + b'\0' * (total - 5000))
+        with open(self.file_name + '.part.json', 'w', encoding='utf-8') as out_file:
+            json.dump({'total': total, 'pending': [[5000, total - 1]], 'validator': self.get_etag()}, out_file)
+
+        self.server.content = bytes(reversed(self.server.content))
+        result = Downloader(max_parts=2, part_size=3000).download(self.url, self.file_name)
+
+        self.assertEqual(self.read(), self.server.content)
+        self.assertEqual(result.resumed_bytes, 0)
+        self.assertEqual(os.listdir(self.dir_name), ['data.bin'])
+
+    def test_checks_hash(self):
+        with self.assertRaises(DownloadError):
+            Downloader(max_parts=1).download(self.url, self.file_name, sha256='0' * 64)
+
+        self.assertFalse(os.path.exists(self.file_name))
+
+
+if __name__ == '__main__':
+    unittest.main()
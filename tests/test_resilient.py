@@ -0,0 +1,123 @@
+import contextlib
+import io
+import threading
+import time
+import unittest
+
+from ai_assistant.backends.base import ModelBackend
+from ai_assistant.backends.replay import ReplayBackend, ReplayError
+from ai_assistant.backends.resilient import ModelCallError, ResilientBackend
+
+
+def make_replay(*responses) -> ReplayBackend:
+    return ReplayBackend(list(responses))
+
+
+def text(value: str):
+    return {'parts': [{'text': value}]}
+
+
+def error(code: int, message: str = 'Failed'):
+    return {'error': {'code': code, 'message': message}}
+
+
+class SlowFirstBackend(ModelBackend):
+    """
+    A stateless backend whose first call is slow, to exercise hedging.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.replay = make_replay()
+
+    def make_content(self, role, text):
+        return self.replay.make_content(role, text)
+
+    def generate(self, contents):
+        with self._lock:
+            self.calls += 1
+            num = self.calls
+
+        if num == 1:
+            time.sleep(self.delay)
+
+        return make_replay(text(f'call {num}')).generate(contents)
+
+
+class ResilientBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.contents = [make_replay().make_content('user', 'Hello')]
+
+    def test_retries_transient_errors(self):
+        backend = ResilientBackend(
+            make_replay(error(429), error(503), text('Done')), backoff_base=0, verbose=False
+        )
+
+        self.assertEqual(backend.generate(self.contents).text, 'Done')
+        self.assertEqual(backend.stats['attempts'], 3)
+        self.assertEqual(backend.stats['retries'], 2)
+
+    def test_gives_up_after_max_retries(self):
+        backend = ResilientBackend(
+            make_replay(error(429), error(429), error(429)), max_retries=2, backoff_base=0, verbose=False
+        )
+
+        with self.assertRaises(ModelCallError):
+            backend.generate(self.contents)
+        self.assertEqual(backend.stats['attempts'], 3)
+
+    def test_does_not_retry_other_errors(self):
+        backend = ResilientBackend(make_replay(error(400), text('Unused')), backoff_base=0, verbose=False)
+
+        with self.assertRaises(ReplayError):
+            backend.generate(self.contents)
+        self.assertEqual(backend.stats['retries'], 0)
+
+    def test_prints_retries_only_if_verbose(self):
+        for verbose in (False, True):
+            output = io.StringIO()
+            backend = ResilientBackend(make_replay(error(429), text('Done')), backoff_base=0, verbose=verbose)
+
+            with contextlib.redirect_stdout(output):
+                backend.generate(self.contents)
+
+            self.assertEqual('retrying' in output.getvalue(), verbose)
+
+    def test_retries_streams_until_first_chunk(self):
+        backend = ResilientBackend(make_replay(error(503), text('Done')), backoff_base=0, verbose=False)
+        chunks = list(backend.generate_stream(self.contents))
+
+        self.assertEqual(''.join(chunk.text for chunk in chunks), 'Done')
+        self.assertEqual(backend.stats['retries'], 1)
+
+    def test_no_timeout_for_stateful_backends(self):
+        # A call abandoned after its timeout would use up the next recorded response
+        replay = make_replay(text('First'), text('Second'))
+        replay.latency = 0.2
+        backend = ResilientBackend(replay, timeout=0.05, verbose=False)
+
+        self.assertEqual(backend.generate(self.contents).text, 'First')
+        self.assertEqual(backend.generate(self.contents).text, 'Second')
+        self.assertEqual(backend.stats['timeouts'], 0)
+
+    def test_times_out_stateless_backends(self):
+        backend = ResilientBackend(SlowFirstBackend(1.0), timeout=0.05, max_retries=1, backoff_base=0, verbose=False)
+
+        self.assertEqual(backend.generate(self.contents).text, 'call 2')
+        self.assertEqual(backend.stats['timeouts'], 1)
+
+    def test_hedges_slow_calls(self):
+        backend = ResilientBackend(SlowFirstBackend(1.0), hedge_percentile=50, hedge_min_samples=1, verbose=False)
+        backend.latencies.append(0.05)
+
+        start_time = time.perf_counter()
+        self.assertEqual(backend.generate(self.contents).text, 'call 2')
+        self.assertLess(time.perf_counter() - start_time, 0.5)
+        self.assertEqual(backend.stats['hedged'], 1)
+        self.assertEqual(backend.stats['hedges_won'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()